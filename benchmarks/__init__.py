@@ -0,0 +1,8 @@
+"""
+Benchmarks for treecompare: synthetic trees of various shapes and sizes,
+diffed with time, peak memory and nodes visited recorded for each, and
+compared against a stored baseline to catch regressions.
+
+    python -m benchmarks --save     # record a baseline
+    python -m benchmarks            # compare against it
+"""
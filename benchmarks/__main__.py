@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+
+from benchmarks import run
+from benchmarks.scenarios import SCENARIOS
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmarks', description="Run the treecompare benchmarks.")
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help="scenarios to run (default: all of %s)" % ', '.join(s.name for s in SCENARIOS))
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply the size of every scenario")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each scenario (the best time counts)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline file (default: %(default)s)")
+    parser.add_argument('--save', action='store_true', help="save the results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=run.TOLERANCE,
+                        help="fraction worse than the baseline that counts as a regression")
+    parser.add_argument('--in-process', action='store_true',
+                        help="run all scenarios in this process (peak memory is then only approximate)")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    calibration = run.calibrate()
+    results = run.run_scenarios(args.scenarios or None, args.scale, args.repeat, not args.in_process)
+    if args.save:
+        print run.format_results(results)
+        run.save_baseline(args.baseline, args.scale, calibration, results)
+        print "Saved baseline to %s" % args.baseline
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        scale, baseline_calibration, baseline = run.load_baseline(args.baseline)
+        if scale != args.scale:
+            print >> sys.stderr, "Baseline was recorded at scale %s, not comparing" % scale
+            baseline = {}
+        elif baseline_calibration is not None:
+            baseline = run.adjust_for_speed(baseline, calibration, baseline_calibration)
+            print "Baseline times scaled by %.2f for this machine's speed" % (calibration / baseline_calibration)
+    print run.format_results(results, baseline)
+    regressions = run.compare(results, baseline, args.tolerance)
+    for name, metric, base, value in regressions:
+        print "REGRESSION %s: %s went from %s to %s" % (name, metric, base, value)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Generators of synthetic trees. Each returns an (expected, actual) pair of
+the given size, with `changes` differences spread evenly through actual.
+"""
+import copy
+import random
+from collections import OrderedDict
+
+
+def spread(size, changes):
+    """The indexes of `changes` evenly spread items out of size"""
+    if not changes or not size:
+        return set()
+    step = max(1, size // changes)
+    return set(range(step // 2, size, step)[:changes])
+
+
+def record(i):
+    return {'id': i, 'name': 'item %d' % i, 'tags': ['tag%d' % (i % 7), 'tag%d' % (i % 11)], 'value': i * 1.5}
+
+
+def wide_dict(size, changes=10):
+    """A dict of size records"""
+    expected = dict(('key%d' % i, record(i)) for i in range(size))
+    actual = copy.deepcopy(expected)
+    for i in spread(size, changes):
+        actual['key%d' % i]['name'] = 'changed %d' % i
+    return expected, actual
+
+
+def deep_nesting(depth, changes=1):
+    """Lists nested depth levels deep, changed at the bottom"""
+    expected, actual = 'bottom', 'bottom' if not changes else 'changed'
+    for i in range(depth):
+        expected, actual = [i, expected], [i, actual]
+    return expected, actual
+
+
+def deep_records(depth, changes=1, width=20):
+    """
+    OrderedDicts (as json.load(object_pairs_hook=OrderedDict) gives) nested
+    depth levels deep, each level also holding width records, changed at the
+    bottom. OrderedDict == runs in Python, and goes over every level below
+    once for each level above.
+    """
+    def level(i, child):
+        records = [OrderedDict(sorted(record(i * width + j).items())) for j in range(width)]
+        return OrderedDict([('records', records), ('child', child)])
+    expected, actual = 'bottom', 'bottom' if not changes else 'changed'
+    for i in range(depth):
+        expected, actual = level(i, expected), level(i, actual)
+    return expected, actual
+
+
+def ordered_list(size, changes=10):
+    """A list of records with some removed and some inserted, shifting the rest"""
+    expected = [record(i) for i in range(size)]
+    actual = copy.deepcopy(expected)
+    for i in sorted(spread(size, changes), reverse=True):
+        if i % 2:
+            del actual[i]
+        else:
+            actual.insert(i, record(size + i))
+    return expected, actual
+
+
+def unordered_list(size, changes=10, seed=0):
+    """A shuffled list of records, for matching with ignore_key"""
+    expected, actual = [record(i) for i in range(size)], [record(i) for i in range(size)]
+    for i in spread(size, changes):
+        actual[i]['value'] = -1
+    random.Random(seed).shuffle(actual)
+    return expected, actual
+
+
+def text_blob(lines, changes=3):
+    """A long text with a few changed lines"""
+    expected = ['line %d: %s' % (i, 'lorem ipsum dolor sit amet ' * (1 + i % 4)) for i in range(lines)]
+    actual = list(expected)
+    for i in spread(lines, changes):
+        actual[i] = actual[i].upper()
+    return '\n'.join(expected), '\n'.join(actual)
+
+
+def scoped_options(patterns):
+    """An options spec with many scoped patterns, most of which never match"""
+    spec = dict((r"\['key%d'\]\['unused%d'\]" % (i, i), 'ignore_case') for i in range(patterns))
+    spec[r"\['name'\]$"] = 'ignore_case'
+    return spec
+
+
+def xml_document(size, changes=10):
+    """An XML document of size elements with attributes and text"""
+    def document(changed):
+        items = ''.join(
+            '<item id="%d" kind="k%d"><name>%s %d</name><value>%d</value></item>\n'
+                % (i, i % 5, 'changed' if i in changed else 'item', i, i)
+            for i in range(size))
+        return '<?xml version="1.0"?>\n<feed>\n%s</feed>' % items
+    return document(set()), document(spread(size, changes))
@@ -0,0 +1,139 @@
+"""
+Running scenarios and comparing their results with a baseline.
+"""
+import copy
+import gc
+import json
+import multiprocessing
+import resource
+import time
+
+from .scenarios import BY_NAME, SCENARIOS
+
+# How much worse than the baseline a result may be before it is flagged,
+# as a fraction of the baseline...
+TOLERANCE = 0.25
+# ...and at least this much worse, as small values are noisy
+NOISE = {'seconds': 0.05, 'peak_kb': 2048, 'nodes': 0}
+METRICS = ('seconds', 'peak_kb', 'nodes')
+
+
+def counting(differ):
+    """A copy of differ counting the nodes it visits in its visits[0]"""
+    base = differ.__class__
+    class CountingDiffer(base):
+        def steps(self, expected, actual, options, path):
+            self.visits[0] += 1
+            return base.steps(self, expected, actual, options, path)
+    counted = copy.copy(differ)
+    counted.__class__ = CountingDiffer
+    counted.visits = [0]
+    return counted
+
+
+def calibrate(repeat=5):
+    """
+    The best time this machine takes for a fixed workload of plain Python
+    (building and comparing dicts, lists and strings, as diffing does).
+    Baselines store it, so that their times can be scaled to another
+    machine's speed (see adjust_for_speed()).
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        tree = dict(('key%d' % n, [n, str(n), {'n': n}]) for n in xrange(20000))
+        copied = dict((key, [value[0], value[1], dict(value[2])]) for key, value in tree.iteritems())
+        sum(1 for key in tree if tree[key] == copied[key])
+        times.append(time.time() - start)
+    return min(times)
+
+
+def adjust_for_speed(baseline, calibration, baseline_calibration):
+    """The baseline's results with their times scaled from its machine's calibration to this one's"""
+    speed = calibration / baseline_calibration
+    return dict((name, dict(result, seconds=result['seconds'] * speed)) for name, result in baseline.iteritems())
+
+
+def peak_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(name, scale=1.0, repeat=3):
+    """
+    Run the named scenario repeat times, returning the best time, the
+    growth of peak memory, the nodes visited and differences found
+    """
+    scenario = BY_NAME[name]
+    expected, actual = scenario.prepare(scale)
+    differ = counting(scenario.differ)
+    gc.collect()
+    peak_before = peak_kb()
+    times = []
+    for i in range(repeat):
+        differ.visits[0] = 0
+        start = time.time()
+        differences = scenario.run(differ, expected, actual)
+        times.append(time.time() - start)
+    return {
+        'seconds': min(times),
+        'peak_kb': peak_kb() - peak_before,
+        'nodes': differ.visits[0],
+        'differences': len(differences),
+    }
+
+
+def measure_isolated(name, scale=1.0, repeat=3):
+    """measure() in a fresh process, so that peak memory is the scenario's own"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(measure, (name, scale, repeat))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_scenarios(names=None, scale=1.0, repeat=3, isolate=True):
+    """Return {scenario name: result} for the named scenarios (or all)"""
+    measure_scenario = measure_isolated if isolate else measure
+    return dict((scenario.name, measure_scenario(scenario.name, scale, repeat))
+                    for scenario in SCENARIOS if names is None or scenario.name in names)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Return (scenario name, metric, baseline value, value) for each metric
+    that got worse than the baseline by more than the tolerance
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric in METRICS:
+            value, base = results[name][metric], baseline[name][metric]
+            if value > base * (1 + tolerance) and value - base > NOISE[metric]:
+                regressions.append((name, metric, base, value))
+    return regressions
+
+
+def load_baseline(path):
+    """Return the scale, calibration (None if not recorded) and results stored in a baseline file"""
+    with open(path) as f:
+        stored = json.load(f)
+    results = dict((str(name), result) for name, result in stored['results'].iteritems())
+    return stored['scale'], stored.get('calibration'), results
+
+
+def save_baseline(path, scale, calibration, results):
+    with open(path, 'w') as f:
+        json.dump({'scale': scale, 'calibration': calibration, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def format_results(results, baseline={}):
+    lines = ["%-24s %10s %10s %10s %8s" % ('scenario', 'seconds', 'peak kB', 'nodes', 'diffs')]
+    for name in sorted(results):
+        result = results[name]
+        line = "%-24s %10.3f %10d %10d %8d" % (name, result['seconds'], result['peak_kb'], result['nodes'], result['differences'])
+        if name in baseline:
+            line += "   (baseline %.3fs, %d kB, %d nodes)" % tuple(baseline[name][metric] for metric in METRICS)
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,58 @@
+"""
+The benchmark scenarios: a generated pair of trees, the differ and the
+options to diff them with.
+"""
+import xml.dom.minidom as dom
+
+from treecompare import diff
+from treecompare.differ import make_differ
+from treecompare.xml import StreamedDocument, streaming_xml_differ, xml_differ
+
+from . import generators
+
+iterative_diff = make_differ(iterative=True)
+fingerprint_diff = make_differ(use_fingerprints=True)
+
+
+class Scenario(object):
+    """
+    Diffs generate(size) with differ. convert, if given, is applied to
+    both trees as part of the timed run (e.g. to parse documents).
+    """
+    def __init__(self, name, generate, size, differ=diff, options={}, convert=None):
+        self.name = name
+        self.generate = generate
+        self.size = size
+        self.differ = differ
+        self.options = options
+        self.convert = convert
+
+    def prepare(self, scale=1.0):
+        """Return the (expected, actual) pair to diff, at the given scale"""
+        return self.generate(max(1, int(self.size * scale)))
+
+    def run(self, differ, expected, actual):
+        if self.convert is not None:
+            expected, actual = self.convert(expected), self.convert(actual)
+        return differ(expected, actual, self.options)
+
+
+SCENARIOS = [
+    Scenario('wide_dict', generators.wide_dict, 50000),
+    Scenario('wide_dict_fingerprints', generators.wide_dict, 50000, differ=fingerprint_diff),
+    Scenario('deep_nesting', generators.deep_nesting, 5000, differ=iterative_diff),
+    # Fingerprinting costs more than == on wide trees, and pays off on deep ones with a slow ==
+    Scenario('deep_records', generators.deep_records, 150),
+    Scenario('deep_records_fingerprints', generators.deep_records, 150, differ=fingerprint_diff),
+    Scenario('ordered_list', generators.ordered_list, 20000),
+    Scenario('ordered_list_align', generators.ordered_list, 20000, options='align'),
+    Scenario('unordered_list', generators.unordered_list, 2000, options={r'^\[\d+\]$': 'ignore_key'}),
+    Scenario('text_blob', generators.text_blob, 50000),
+    Scenario('scoped_options', generators.wide_dict, 10000, options=generators.scoped_options(200)),
+    Scenario('xml', generators.xml_document, 10000, differ=xml_differ, convert=dom.parseString),
+    Scenario('xml_stream', generators.xml_document, 10000, differ=streaming_xml_differ, convert=StreamedDocument),
+    Scenario('xml_identity', generators.xml_document, 10000, differ=xml_differ, convert=dom.parseString,
+             options={'<feed>$': 'match_identity'}),
+]
+
+BY_NAME = dict((scenario.name, scenario) for scenario in SCENARIOS)
@@ -12,6 +12,9 @@ setup(name='treecompare',
       author_email='ruyasan@gmail.com',
       url='https://github.com/rubyruy/treecompare',
       install_requires=['distribute'],
+      entry_points={
+      	'console_scripts': ['treecompare = treecompare.__main__:main'],
+      },
       classifiers=[
       	"Programming Language :: Python",
       	"License :: OSI Approved :: BSD License",
@@ -1,15 +1,26 @@
 import unittest
 
 from treecompare import diff
+from treecompare.differ import make_differ
 from treecompare.difference import Difference
+from treecompare.options import compile_options
+from treecompare.path import ROOT, as_path
+from treecompare.xml import diff_xml, diff_xml_stream
+from StringIO import StringIO
+import os
 import pprint
+import re
+import shutil
+import sys
+import tempfile
 
 ANY_DIFFERENCE = object()
 
 class TestTreeCompare(unittest.TestCase):
+    diff = staticmethod(diff)
     
     def assertNotDifferent(self, expected, actual, options={}):
-        diffs = diff(expected, actual, options)
+        diffs = self.diff(expected, actual, options)
         if diffs:
             message = """Expected object
 %s
@@ -22,7 +33,7 @@ should be considered equal, but the the following differences were reported:
             self.fail(message)
     
     def assertDifferent(self, expected_diffs, expected, actual, options={}):
-        diffs = diff(expected, actual, options)
+        diffs = self.diff(expected, actual, options)
 
         if expected_diffs is ANY_DIFFERENCE:
             if not diffs:
@@ -395,7 +406,718 @@ you are logged  \tin as< bobo>
     \t\tyou are logged   in as <bobo>.  
                 """
             )
-    
-        
+
+    def test_large_text_diff(self):
+        expected = ''.join("line %d\n" % i for i in range(20000))
+        actual = expected.replace("line 12345\n", "line 12346\n")
+        message = self.diff(expected, actual)[0].message
+        self.assertTrue(len(message) < 1000)
+        self.assertTrue("(208890 characters)" in message)
+        self.assertTrue("@@ -12343,7 +12343,7 @@" in message)
+        self.assertTrue("\n-line 12345\n?         ^\n+line 12346\n" in message)
+        self.assertTrue("\n line 12342\n" in message)
+        self.assertFalse("\n line 12341\n" in message)
+        message = self.diff(expected, actual, 'text_context=0')[0].message
+        self.assertTrue("@@ -12346,1 +12346,1 @@" in message)
+
+        shuffled = ''.join("line %d\n" % (i * 7919 % 20000) for i in range(20000))
+        message = self.diff(expected, shuffled, 'text_diff_cost=1000')[0].message
+        self.assertTrue(message.endswith("diff skipped: Alignment cost limit exceeded"))
+        message = self.diff(expected[:3000], shuffled[:3000], 'text_diff_lines=10')[0].message
+        self.assertTrue(message.endswith("more lines in this hunk)"))
+        self.assertEqual(message.count("\n"), 11)
+
+    def test_compiled_options(self):
+        options = compile_options({
+            r'\[\'papaya\'\]': 'ignore',
+            r'^\[\'banana\'\]': ('ignore_case', 'ignore_spacing'),
+        })
+        self.assertEqual(options.resolve("['papaya'][0]"), ('ignore',))
+        self.assertEqual(set(options.resolve("['banana']")), set(['ignore_case', 'ignore_spacing']))
+        self.assertEqual(options.resolve("['cherry']"), ())
+        self.assertTrue("['cherry']" in options.resolved)
+        self.assertNotDifferent(
+            options = options,
+            expected = {'banana': 'Re public', 'papaya': [1]},
+            actual = {'banana': 'RE PUBLIC', 'papaya': [2]}
+        )
+        self.assertTrue(compile_options(options) is options)
+        self.assertFalse(compile_options({}))
+
+    def test_fingerprinting(self):
+        fingerprint_diff = make_differ(use_fingerprints=True)
+        class ComparedDict(dict):
+            comparisons = 0
+            def __eq__(self, other):
+                ComparedDict.comparisons += 1
+                return dict.__eq__(self, other)
+        expected = ComparedDict(a=[1, 2.0, u'three', None], b=ComparedDict(c=True))
+        actual = ComparedDict(a=[1L, 2, 'three', None], b=ComparedDict(c=1))
+        self.assertEqual(fingerprint_diff(expected, actual), [])
+        self.assertEqual(ComparedDict.comparisons, 0)
+
+        diffs = fingerprint_diff(
+            dict(a=1, b=[dict(x=10, y=11)], c='same'),
+            dict(a=1, b=[dict(x=10, y=12)], c='same'),
+        )
+        self.assertEqual([(d.path_string, d.message) for d in diffs], [
+            ("['b'][0]['y']", "expected 11, got 12")
+        ])
+        self.assertEqual(fingerprint_diff([-1], [-2], 'ignore_case')[0].message, "expected -1, got -2")
+        self.assertEqual(fingerprint_diff([('a', 'b')], ['a'], 'assert_includes'), [])
+
+        # Hashed as what diff() tells them apart by, not as their exact types
+        from collections import OrderedDict
+        run = fingerprint_diff.begin()
+        self.assertEqual(run.fingerprint({'a': [1]}), run.fingerprint(OrderedDict(a=[1])))
+        self.assertNotEqual(run.fingerprint([1, 2]), run.fingerprint((1, 2)))
+
+    def test_ignore_key_option_with_canonical_matches(self):
+        self.assertNotDifferent(
+            options = {
+                r'^\[\d+\]$': 'ignore_key',
+                r'\[\'name\'\]$': ('ignore_case', 'ignore_spacing'),
+                r'\[\'updated\'\]$': 'ignore',
+            },
+            expected = [dict(id=i, name='Item  %d' % i, updated=i) for i in range(50)],
+            actual = [dict(id=i, name='ITEM %d' % i, updated=-i) for i in reversed(range(50))]
+        )
+        self.assertDifferent({
+                "[0]['name']": "expected 'Item 49', got 'Item 50'"
+            },
+            options = {r'^\[\d+\]$': 'ignore_key'},
+            expected = [dict(id=i, name='Item %d' % i) for i in range(50)],
+            actual = [dict(id=49, name='Item 50')] + [dict(id=i, name='Item %d' % i) for i in range(49)]
+        )
+
+    def test_ignore_key_option_pairs_similar_elements(self):
+        self.assertDifferent({
+                "[0]['name']": "expected 'beta', got 'BETA'",
+                "[1]['name']": "expected 'alpha', got 'ALPHA'",
+                "[2]": "unexpected value: 'gamma'",
+            },
+            options = {r'^\[\d+\]$': 'ignore_key'},
+            expected = [dict(id=1, name='alpha', tags=['x']), dict(id=2, name='beta', tags=['y'])],
+            actual = [dict(id=2, name='BETA', tags=['y']), dict(id=1, name='ALPHA', tags=['x']), 'gamma']
+        )
+
+    def test_unkeyed_subclasses(self):
+        from collections import OrderedDict
+        # Hashed differently, but equal as far as diff goes
+        self.assertNotDifferent(
+            options = {r'^\[\d+\]$': 'ignore_key'},
+            expected = [{'a': 1, 'b': 1}, {'a': 1, 'b': 2}],
+            actual = [OrderedDict([('a', 1), ('b', 2)]), OrderedDict([('a', 1), ('b', 1)])]
+        )
+
+    def test_align_option(self):
+        self.assertDifferent({
+                "[0]": "unexpected value: 'zero'",
+                "[3][1]": "expected 4, got 5",
+                "[3]": "expected 'five', got nothing",
+            },
+            options = {r'^$': 'align'},
+            expected = ['one', 'two', [3, 4], 'five', 'six'],
+            actual = ['zero', 'one', 'two', [3, 5], 'six']
+        )
+        self.assertNotDifferent(range(1000), range(1000), 'align')
+        self.assertDifferent({
+                "[0]": "unexpected value: -1",
+            },
+            options = 'align',
+            expected = range(1000),
+            actual = [-1] + range(1000),
+        )
+        # Past its limits, alignment gives way to pairing elements by index
+        self.assertDifferent({
+                "[0][0]": "expected 1, got 2",
+                "[1][0]": "expected 2, got 1",
+            },
+            options = {r'^$': ('align', 'align_cost=1')},
+            expected = [[1], [2], [3]],
+            actual = [[2], [1], [3]],
+        )
+
+    def test_align_hashes_changes_only(self):
+        hashed = []
+        differ_class = type(self.diff)
+        class HashCountingDiffer(differ_class):
+            def canonical(run, diffable, options, path):
+                hashed.append(int(re.match(r'\[(\d+)\]', as_path(path).string).group(1)))
+                return differ_class.canonical(run, diffable, options, path)
+        expected = [[i] for i in range(100)]
+        actual = expected[:50] + [['x']] + expected[51:60] + [['new']] + expected[60:]
+        self.assertEqual(map(str, HashCountingDiffer(*self.diff.implementations)(expected, actual, 'align')), [
+            "[50][0]: expected 50, got 'x'",
+            "[60]: unexpected value: ['new']",
+        ])
+        self.assertTrue(hashed and min(hashed) >= 50 and max(hashed) <= 60, hashed)
+
+    def test_iter_diffs(self):
+        expected = [dict(id=i, name='Item %d' % i) for i in range(100)]
+        actual = [dict(id=i, name='item %d' % i) for i in range(100)]
+        diffs = diff.iter_diffs(expected, actual)
+        self.assertEqual(str(next(diffs)), "[0]['name']: expected 'Item 0', got 'item 0'")
+        self.assertEqual(len(list(diffs)), 99)
+        self.assertEqual(len(diff(expected, actual, max_diffs=20)), 20)
+        self.assertEqual(str(diff.first_difference(expected, actual)), "[0]['name']: expected 'Item 0', got 'item 0'")
+        self.assertEqual(diff.first_difference(expected, actual, {r'\[\'name\'\]': 'ignore_case'}), None)
+
+        class Unreachable(list):
+            def __iter__(self):
+                raise AssertionError("Walked past the first difference")
+        self.assertEqual(diff([[1], Unreachable([2])], [[3], Unreachable([4])], max_diffs=1)[0].message, "expected 1, got 3")
+
+    def test_parallel_diff(self):
+        expected = dict(('k%d' % i, {'a': range(5), 'b': 'text %d' % i}) for i in range(40))
+        actual = dict(('k%d' % i, {'a': range(5), 'b': 'TEXT %d' % i}) for i in range(1, 41))
+        options = {r"\['k1\d'\]": 'ignore_case'}
+        parallel_diff = make_differ(processes=2, parallel_threshold=10)
+        diffs = map(str, parallel_diff(expected, actual, options))
+        self.assertEqual(diffs, map(str, diff(expected, actual, options)))
+        self.assertEqual(len(diffs), 31)
+        self.assertEqual(map(str, parallel_diff({'a': 1}, {'a': 2})), ["['a']: expected 1, got 2"])
+        # Only the paths, kinds and messages of the differences come back
+        big = dict(expected, k0=['x'] * 100000)
+        diffs = parallel_diff(big, dict(actual, k0='x'), options)
+        self.assertEqual(map(str, diffs), map(str, diff(big, dict(actual, k0='x'), options)))
+        self.assertEqual([(d.kind, d.expected, d.actual) for d in diffs if d.path_string == "['k0']"],
+                         [('changed', None, None)])
+
+    def test_paths(self):
+        parent = as_path(['[0]', "['a']"])
+        child = parent.child('[1]')
+        self.assertTrue(child.parent is parent)
+        self.assertEqual(child.string, "[0]['a'][1]")
+        self.assertEqual(child, ['[0]', "['a']", '[1]'])
+        self.assertEqual(len(child), 3)
+        self.assertEqual(''.join(child), "[0]['a'][1]")
+        self.assertEqual((parent + ['[2]', '[3]']).string, "[0]['a'][2][3]")
+        self.assertEqual(as_path(''), ROOT)
+        self.assertEqual(diff([{'a': [1]}], [{'a': [2]}])[0].path, ['[0]', "['a']", '[0]'])
+        self.assertRaises(AttributeError, setattr, Difference('', ''), 'extra', 1)
+
+    def test_custom_primitives_unkeyed(self):
+        import datetime
+        from treecompare import implementations as impl
+        class DiffDates(impl.DiffPrimitives):
+            diffs_types = datetime.date
+        d1, d2 = datetime.date(2020, 1, 1), datetime.date(2021, 1, 1)
+        options = {r'^\[\d+\]$': 'ignore_key'}
+        for settings in ({}, {'use_fingerprints': True}):
+            date_diff = make_differ(DiffDates, **settings)
+            self.assertEqual(date_diff([d1, d2], [d2, d1], options), [])
+            self.assertEqual(len(date_diff([d1, d2], [d2, d2], options)), 1)
+
+    def test_dispatch_cache(self):
+        from treecompare import implementations as impl
+        custom_diff = make_differ()
+        self.assertEqual(custom_diff('a', 'b')[0].message, "expected 'a', got 'b'")
+        self.assertTrue(custom_diff.dispatch[str] is impl.DiffText)
+        self.assertTrue(Difference('', '').__diff_implementation__ is Difference('', '').__diff_implementation__)
+
+        class DiffShouting(impl.DiffText):
+            def diff(self, expected, actual):
+                return self.different("%s != %s" % (expected.upper(), actual.upper()))
+        custom_diff.implementations = (DiffShouting,) + custom_diff.implementations
+        self.assertEqual(custom_diff('a', 'b')[0].message, "A != B")
+
+        class DiffEvens(impl.DiffNumbers):
+            @classmethod
+            def can_diff(cls, number):
+                return isinstance(number, int) and number % 2 == 0
+            def diff(self, expected, actual):
+                return self.different("even")
+        custom_diff.implementations = (DiffEvens,) + custom_diff.implementations
+        self.assertEqual(custom_diff(1, 2)[0].message, "even")
+        self.assertEqual(custom_diff(2, 3)[0].message, "expected 2, got 3")
+        self.assertFalse(int in custom_diff.dispatch)
+
+    def test_xml_stream(self):
+        expected = """<?xml version="1.0" encoding="UTF-8" standalone="no"?><!--menu-->
+            <menu id="file" value="File">
+              <popup>Items<![CDATA[ <here> ]]>
+                <menuitem value="New" onclick="CreateNewDoc()" />
+                <menuitem value="Open" onclick="OpenDoc()" />
+              </popup>
+              <b>1</b><b>2</b><c/>
+            </menu>"""
+        actual = expected.replace('OpenDoc', 'OpenDuck').replace('1.0', '1.1').replace('<c/>', '<d/>')
+        actual = actual.replace('<here>', '<there>').replace('<b>1</b><b>2</b>', '<b>2</b><b>1</b>')
+        def messages(diffs):
+            return [re.sub(r' at 0x[0-9a-f]+', '', str(d)) for d in diffs]
+        for options in ({}, {'<b>': 'ignore_key'}, {'<popup>': 'ignore'}):
+            diffs = messages(diff_xml(expected, actual, options))
+            self.assertEqual(messages(diff_xml_stream(StringIO(expected), actual, options)), diffs)
+        self.assertEqual(diffs, [
+            "?xml@version: expected u'1.0', got u'1.1'",
+            "/1<menu>/3<b>/0:text: expected u'1', got u'2'",
+            "/1<menu>/4<b>/0:text: expected u'2', got u'1'",
+            "/1<menu>/5<d>: unexpected value: <DOM Element: d>",
+            "/1<menu>/5<c>: expected <DOM Element: c>, got nothing",
+        ])
+        deep = '<a>' * 2000 + '<b/>' + '</a>' * 2000
+        self.assertEqual(diff_xml_stream(deep, deep.replace('<b/>', '<b x="1"/>'))[0].message, "unexpected value: u'1'")
+
+    def test_xml_identity(self):
+        expected = '<feed>%s</feed>' % ''.join('<item sku="%d"><n>%d</n></item>' % (i, i) for i in range(10))
+        actual = '<feed>%s</feed>' % ''.join('<item sku="%d"><n>%d</n></item>' % (i, i + (i == 7))
+                                                for i in [0, 1, 2, 8, 3, 4, 5, 6, 7, 9, 10])
+        diffs = [re.sub(r' at 0x[0-9a-f]+', '', str(d)) for d in diff_xml(expected, actual, 'match_identity=@sku')]
+        self.assertEqual(diffs, [
+            "/0<feed>/<item[@sku='7']>/0<n>/0:text: expected u'7', got u'8'",
+            "/0<feed>/<item[@sku='10']>: unexpected value: <DOM Element: item>",
+            "/0<feed>/<item[@sku='8']>: moved from index 8 to 3",
+        ])
+        self.assertEqual(len(diff_xml(expected, actual, {r'<feed>$': 'match_identity=@id|@sku'})), 3)
+        self.assertEqual(len(diff_xml(expected, actual)), 12)
+
+    def test_json_files(self):
+        from treecompare import jsonfile
+        from treecompare.__main__ import main
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def write(name, text):
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(text)
+            return path
+        expected = write('expected.json', '{"a": {"b": [1, 2, {"c": "x"}]}, "same": [1, 2], "old": true}')
+        actual = write('actual.json', '{"same": [1,2], "a": {"b": [1, 2, {"c": "y"}, null]}, "new": 1}\n')
+        self.assertEqual(map(str, jsonfile.diff_files(expected, actual)), [
+            "['a']['b'][2]['c']: expected 'x', got 'y'",
+            "['a']['b'][3]: unexpected value: None",
+            "['new']: unexpected value: 1",
+            "['old']: expected True, got nothing",
+        ])
+        self.assertEqual(jsonfile.diff_files(expected, expected), [])
+
+        expected = write('expected.ndjson', '{"id": 1, "v": "a"}\n{"id": 2, "v": "b"}\n{"id": 3, "v": [1]}\n')
+        actual = write('actual.ndjson', '{"id": 3, "v": [2]}\n{"id": 1, "v": "A"}\n\n')
+        self.assertEqual(map(str, jsonfile.diff_files(expected, actual, 'ignore_case', key='id')), [
+            "[3]['v'][0]: expected 1, got 2",
+            "[2]: expected {'id': 2, 'v': 'b'}, got nothing",
+        ])
+        self.assertEqual(len(jsonfile.diff_files(expected, actual, ndjson=True)), 5)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output = StringIO()
+        try:
+            self.assertEqual(main(['--key', 'id', '--max-diffs', '1', expected, actual]), 1)
+            self.assertEqual(main([expected, expected]), 0)
+            self.assertEqual(main([expected, actual]), 2)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(output.getvalue().splitlines(), [
+            "[3]['v'][0]: expected 1, got 2",
+            "treecompare: Extra data at 19",
+        ])
+
+    def test_stats(self):
+        import pstats
+        from treecompare.stats import DiffStats
+        expected = {'a': [{'x': i, 't': 'text %d' % i * 10} for i in range(20)], 'b': {'c': 1}}
+        actual = {'a': [{'x': i, 't': 'text %d' % i * 10 + ('!' if i == 7 else '')} for i in range(20)], 'b': {'c': 2}}
+        options = {r"^\['a'\]\[\d+\]$": 'ignore_key'}
+        stats = DiffStats(depth=1)
+        self.assertEqual(map(str, self.diff(expected, actual, options, stats=stats)),
+                         map(str, self.diff(expected, actual, options)))
+        report = stats.report()
+        self.assertEqual(report['implementations']['DiffLists']['calls'], 1)
+        # Once trying the changed element against the other, once diffing them
+        self.assertEqual(report['phases']['text_diff']['calls'], 2)
+        self.assertEqual(report['text_bytes'], 2 * (2 * len('text 7' * 10) + 1))
+        self.assertTrue(report['regex_searches'] > 0)
+        self.assertEqual(sorted(report['paths']), ['', "['a']", "['b']"])
+        self.assertAlmostEqual(report['paths'][''], report['seconds'])
+        self.assertTrue(all(re.match(r"^(\['[ab]'\];)?\w+ \d+$", line) for line in stats.folded()))
+        self.assertEqual(pstats.Stats(stats).total_calls, sum(stats.calls.values()))
+
+        # Unkeyed children without canonical hashes are matched up by diffing them
+        stats = DiffStats()
+        self.assertEqual(self.diff([1.0, 2.0], [2.0, 1.0], {r'^\[\d+\]$': ('ignore_key', 'approx=0.1')}, stats=stats), [])
+        self.assertTrue(stats.report()['phases']['matches']['calls'] > 0)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'diff.pstats')
+        self.addCleanup(shutil.rmtree, os.path.dirname(filename))
+        stats = DiffStats()
+        self.assertEqual(len(list(self.diff.iter_diffs(expected, actual, stats=stats))), 2)
+        self.assertEqual(stats.report()['nodes'], 6)
+        stats.dump_pstats(filename)
+        self.assertEqual(pstats.Stats(filename).total_calls, sum(stats.calls.values()))
+
+    def test_comparison_memo(self):
+        from treecompare.memo import ComparisonMemo
+        from treecompare.stats import DiffStats
+        def records(actual):
+            return [{'id': i, 'kind': 'a' if actual else ('a', 'b'),
+                     'tags': [(i * 7 + j + actual * (i % 5 == 0 and j == 0)) % 13 for j in range(4)]}
+                        for i in range(20)]
+        expected, actual = records(0), records(1)
+        actual.reverse()
+        options = {r'^\[\d+\]$': 'ignore_key', r"\['tags'\]\[\d+\]$": 'ignore_key', r"\['kind'\]$": 'assert_includes'}
+        remembered, forgetful = DiffStats(), DiffStats()
+        diffs = self.diff(expected, actual, options, stats=remembered)
+        self.assertEqual(len(diffs), 4)
+        self.assertEqual(map(str, diffs), map(str, make_differ(memo_size=0)(expected, actual, options, stats=forgetful)))
+        self.assertTrue(remembered.memo_hits > 0)
+        self.assertEqual(forgetful.memo_hits, 0)
+        self.assertTrue(remembered.report()['nodes'] < forgetful.report()['nodes'])
+
+        memo = ComparisonMemo(2)
+        for key in 'abc':
+            memo.put(key, None, None, None, key != 'b')
+        self.assertEqual(memo.get('a'), None)
+        self.assertEqual(memo.get('b'), False)
+        memo.put('d', None, None, None, True)
+        self.assertEqual([memo.get(key) for key in 'bcd'], [False, None, True])
+
+    def test_arrays(self):
+        from treecompare import arrays
+        if arrays.numpy is None:
+            self.assertFalse(arrays.DiffArrays.can_diff([1]))
+            self.skipTest("NumPy is not installed")
+        numpy = arrays.numpy
+        array_diff = arrays.array_differ
+        expected = numpy.arange(12.0).reshape(3, 4)
+        actual = expected.copy()
+        actual[1, 2] += 1
+        actual[2, 3] += 1e-9
+        self.assertEqual(map(str, array_diff({'a': [expected]}, {'a': [actual]})), [
+            "['a'][0][1][2]: expected 6.0, got 7.0",
+            "['a'][0][2][3]: expected 11.0, got 11.000000001",
+        ])
+        self.assertEqual(map(str, array_diff(expected, actual, 'atol=1e-6')), ["[1][2]: expected 6.0, got 7.0"])
+        self.assertEqual(array_diff(expected, actual, ('atol=1e-6', 'rtol=0.2')), [])
+        pairs = [numpy.array([1., 2.]), numpy.array([5., 6.])]
+        shifted = [pairs[1] + 1e-9, pairs[0] + 1e-9]
+        self.assertEqual(array_diff(pairs, shifted, {r'^\[\d+\]$': ('ignore_key', 'atol=1e-6')}), [])
+        self.assertEqual(array_diff([expected], [expected.copy()]), [])
+        self.assertEqual(map(str, array_diff(expected, actual.reshape(4, 3).astype('float32'))), [
+            ": expected dtype float64, got dtype float32",
+            ": expected shape (3, 4), got shape (4, 3)",
+        ])
+        self.assertEqual(map(str, array_diff(numpy.zeros(100000), numpy.ones(100000), 'max_array_diffs=2')), [
+            "[0]: expected 0.0, got 1.0",
+            "[1]: expected 0.0, got 1.0",
+            ": 99998 more elements differ (100000 of 100000 in all)",
+        ])
+
+    def test_bulk_primitives(self):
+        from treecompare.stats import DiffStats
+        expected = {'list': range(1000), 'dict': dict(('k%d' % i, i * 1.5) for i in range(1000)), 'text': list('abcdef')}
+        actual = {'list': range(999) + ['x', None], 'dict': dict(('k%d' % i, i * 1.5) for i in range(1, 1001)),
+                  'text': list('abCdEf')}
+        actual['dict']['k500'] += 1e-9
+        stats = DiffStats()
+        bulk = map(str, self.diff(expected, actual, stats=stats))
+        # Scoped options take the per-child path
+        self.assertEqual(bulk, map(str, self.diff(expected, actual, {'^nowhere$': 'ignore'})))
+        self.assertEqual(len(bulk), 7)
+        self.assertTrue(stats.report()['nodes'] < 10)
+        self.assertEqual(self.diff(expected['text'], actual['text'], 'ignore_case'), [])
+        self.assertEqual(len(self.diff(expected, actual, 'approx=1e-6')), 6)
+        self.assertEqual(map(str, self.diff([1.0, 100.0, 0.0], [1.001, 100.1, 1e-7], {r'\[\d\]$': 'approx=1e-6'})), [
+            "[0]: expected 1.0, got 1.001",
+            "[1]: expected 100.0, got 100.1",
+        ])
+        self.assertEqual(self.diff([1.0, 100.0], [1.001, 100.1], 'approx=0.001'), [])
+        # Unkeyed numbers pair up within the tolerance
+        unkeyed = {r'^\[\d+\]$': ('ignore_key', 'approx=1e-3')}
+        self.assertEqual(self.diff([1.0, 2.0, 3.0], [3.0000001, 1.0000001, 2.0000001], unkeyed), [])
+        self.assertEqual(map(str, self.diff([1.0, 2.0], [2.0000001, 1.5], unkeyed)), ["[1]: expected 1.0, got 1.5"])
+
+    def test_compiled_matcher(self):
+        from treecompare.stats import DiffStats
+        golden = {'items': [{'id': i, 'name': 'item %d' % i, 'tags': ['a', str(i)]} for i in range(30)], 'total': 30}
+        options = {r"^\['items'\]\[\d+\]$": 'ignore_key', r"\['name'\]$": 'ignore_case'}
+        def variant(i):
+            actual = {'items': [dict(item, tags=list(item['tags'])) for item in reversed(golden['items'])], 'total': 30}
+            actual['items'][i]['tags'][1] = 'x'
+            actual['items'][i + 1]['name'] = actual['items'][i + 1]['name'].upper()
+            actual['items'][i + 2]['id'] = -1
+            return actual
+        matcher = self.diff.compile(golden, options)
+        for i in range(3):
+            actual = variant(i)
+            diffs = map(str, matcher.diff(actual))
+            self.assertEqual(len(diffs), 2)
+            self.assertEqual(diffs, map(str, self.diff(golden, actual, options)))
+            self.assertEqual(map(str, matcher.iter_diffs(actual, max_diffs=1)), diffs[:1])
+        self.assertTrue(matcher.matches(dict(golden, items=golden['items'][::-1])))
+        self.assertFalse(matcher.matches({}))
+        stats, compiled_stats = DiffStats(), DiffStats()
+        self.diff(golden, actual, options, stats=stats)
+        matcher.diff(actual, stats=compiled_stats)
+        self.assertTrue(compiled_stats.regex_searches < stats.regex_searches)
+
+        # Paths only actual trees have are only remembered up to a point
+        matcher.options.MAX_RESOLVED = 10
+        for i in range(200):
+            items = [dict(golden['items'][0], **{'x%d' % i: i})] + golden['items'][1:]
+            self.assertEqual(len(matcher.diff(dict(golden, items=items))), 1)
+        self.assertTrue(len(matcher.options.resolved) <= len(matcher.options.pinned) + 10)
+        self.assertTrue(set(matcher.options.pinned) <= set(matcher.options.resolved))
+
+    def test_run_options_unbounded(self):
+        from treecompare.options import Options, compile_options
+        from treecompare.stats import DiffStats
+        expected = {'k%d' % i: {'v': i} for i in range(100)}
+        actual = dict(expected, k0={'v': -1})
+        options = {r"\['k1'\]": 'ignore_case'}
+        def searches():
+            stats = DiffStats()
+            self.assertEqual(len(self.diff(expected, actual, options, stats=stats)), 1)
+            return stats.regex_searches
+        unbounded = searches()
+        # A single run's options never forget paths, so don't search them again
+        self.addCleanup(setattr, Options, 'MAX_RESOLVED', Options.MAX_RESOLVED)
+        Options.MAX_RESOLVED = 10
+        self.assertEqual(searches(), unbounded)
+        # Options compiled ahead outlive the run, and are bounded
+        compiled = compile_options(options)
+        self.assertFalse(compiled.shared)
+        self.diff(expected, actual, compiled)
+        self.assertTrue(compiled.shared)
+        self.assertTrue(len(compiled.resolved) <= 10)
+
+    def test_diff_async(self):
+        from treecompare import aio
+        if aio.asyncio is None:
+            self.skipTest("Neither asyncio nor trollius is installed")
+        expected = {'a': [{'x': i} for i in range(500)], 'b': 'x' * 500}
+        actual = {'a': [{'x': i + (i % 100 == 0)} for i in range(500)], 'b': 'x' * 499 + 'y'}
+        loop = aio.asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        ticks = []
+        def tick():
+            ticks.append(loop.time())
+            if not future.done():
+                loop.call_soon(tick)
+        future = self.diff.diff_async(expected, actual, loop=loop, nodes_per_slice=50)
+        loop.call_soon(tick)
+        self.assertEqual(map(str, loop.run_until_complete(future)), map(str, self.diff(expected, actual)))
+        self.assertTrue(len(ticks) > 10)
+
+        task = aio.DiffTask(self.diff, expected, actual, loop=loop, nodes_per_slice=50)
+        def cancel_once_found():
+            if task.diffs:
+                task.cancel()
+            else:
+                loop.call_soon(cancel_once_found)
+        loop.call_soon(cancel_once_found)
+        self.assertRaises(aio.asyncio.CancelledError, loop.run_until_complete, task.future)
+        self.assertTrue(0 < len(task.diffs) < 6)
+
+        future = self.diff.diff_async(expected, actual, loop=loop, offload_size=100)
+        self.assertEqual(map(str, loop.run_until_complete(future)), map(str, self.diff(expected, actual)))
+
+        # The children of a wide node are split and hashed a slice at a time too
+        ticks = []
+        options = {r"^\['a'\]\[\d+\]$": 'ignore_key'}
+        future = self.diff.diff_async(expected, actual, options, loop=loop, nodes_per_slice=50)
+        loop.call_soon(tick)
+        self.assertEqual(map(str, loop.run_until_complete(future)), map(str, self.diff(expected, actual, options)))
+        self.assertTrue(len(ticks) > 20)
+
+        # A running differ handed in is shared with the task, not changed
+        run = self.diff.begin()
+        future = run.diff_async(expected, actual, loop=loop, nodes_per_slice=50)
+        self.assertEqual(map(str, loop.run_until_complete(future)), map(str, self.diff(expected, actual)))
+        self.assertEqual(run.progress_interval, None)
+        self.assertEqual(map(str, run.diff(expected, actual)), map(str, self.diff(expected, actual)))
+
+    def test_budgets(self):
+        import time
+        from treecompare.budget import Unexplored
+        expected = {'a': [{'x': i, 'y': [i, i + 1]} for i in range(40)], 'b': {'c': 1}}
+        actual = {'a': [{'x': i + (i % 7 == 0), 'y': [i, i + 2]} for i in reversed(range(40))], 'b': {'c': 2}}
+        options = {r"^\['a'\]\[\d+\]$": 'ignore_key'}
+        full = map(str, self.diff(expected, actual, options))
+        def resumed(budget):
+            partial = self.diff(expected, actual, options, **budget())
+            found, parts = [], 1
+            while True:
+                found += [str(d) for d in partial if not isinstance(d, Unexplored)]
+                if partial.complete:
+                    return found, parts
+                self.assertTrue(partial.unexplored and partial[-len(partial.unexplored):] == partial.unexplored)
+                partial = partial.resume(**budget())
+                parts += 1
+        for max_nodes in (1, 10, 100000):
+            found, parts = resumed(lambda: {'max_nodes': max_nodes})
+            self.assertEqual(found, full)
+            self.assertEqual(parts > 1, max_nodes < 100000)
+        self.assertEqual(resumed(lambda: {'deadline': time.time() + 0.001})[0], full)
+
+        partial = self.diff(expected, actual, options, max_nodes=5)
+        self.assertFalse(partial.complete)
+        self.assertEqual(map(repr, partial.unexplored[:2]), [
+            "Unexplored(: 'only partly compared: node budget of 5 exhausted')",
+            "Unexplored(['a']: 'only partly compared: node budget of 5 exhausted')",
+        ])
+        partial = self.diff(expected, actual, options, deadline=time.time() - 1)
+        self.assertEqual(map(repr, partial), ["Unexplored(: 'not compared: deadline passed')"])
+        self.assertEqual(map(str, partial.resume()), full)
+
+    def test_deltas(self):
+        import copy
+        from treecompare.delta import Delta, DeltaError, apply_delta, make_delta
+        def round_trip(expected, actual, options={}, json=False):
+            delta = diff.delta(expected, actual, options)
+            if json:
+                delta = Delta.loads(delta.dumps())
+            patched = apply_delta(copy.deepcopy(expected), delta)
+            self.assertEqual(diff(patched, actual, options), [])
+            return delta
+        self.assertEqual(sorted(round_trip(
+            {'a': 1, 'b': [1, 2, 3], 'c': {'x': 'y', 'z': 1}},
+            {'a': 2, 'b': [1, 2, 3, 4], 'c': {'x': 'z'}}, json=True)), [
+            ('add', ['b', 3], 4),
+            ('remove', ['c', 'z']),
+            ('replace', ['a'], 2),
+            ('replace', ['c', 'x'], 'z'),
+        ])
+        self.assertEqual(round_trip([1, 2, 3, 4], [1, 2], json=True), [('remove', [2]), ('remove', [3])])
+        # Paths and values come back as the str they were, unicode only if they must
+        delta = diff.delta({'a': {'b': 'x'}, 'c': [1]}, {'a': {'b': 'y'}, 'c': [1, u'\xe9']})
+        self.assertEqual(map(repr, sorted(Delta.loads(delta.dumps()))), map(repr, sorted(delta)))
+        self.assertEqual(round_trip(1, 'x'), [('replace', [], 'x')])
+        self.assertEqual(round_trip([[1], {'a': (1, 2)}], [[1], {'a': (1, 3)}]), [('replace', [1, 'a'], (1, 3))])
+        # Aligned lists
+        self.assertEqual(round_trip(range(10), [9] + range(9), {'': 'align'}), [('move', [0], 9)])
+        self.assertEqual(round_trip([{'a': 1}, {'b': 2}], [{'x': 0}, {'a': 1}, {'b': 3}], {'': 'align'}),
+                         [('add', [0], {'x': 0}), ('replace', [2], {'b': 3})])
+        # Unordered children are replaced along with their container
+        options = {r"^\['l'\]\[\d+\]$": 'ignore_key'}
+        self.assertEqual(round_trip({'l': [{'k': 1}, {'k': 2}], 'n': 1}, {'l': [{'k': 3}, {'k': 1}], 'n': 1}, options),
+                         [('replace', ['l'], [{'k': 3}, {'k': 1}])])
+        # Differences that don't say what changed can't be made into deltas
+        self.assertRaises(DeltaError, make_delta, diff.begin(), [Difference([], "odd")], 1, compile_options({}))
+
+    def test_lazy_messages(self):
+        from treecompare.difference import CHANGED, bounded_repr
+        big = range(10000)
+        difference = diff({'a': big}, {})[0]
+        self.assertEqual((difference.kind, difference.expected), ('missing', big))
+        self.assertEqual(len(difference.message), Difference.MAX_REPR + len("expected ..., got nothing"))
+        self.assertEqual(str(diff([(1,)], [(1,), {'b': [u'x', None]}])[0]), "[1]: unexpected value: {'b': [u'x', None]}")
+        self.assertEqual(Difference([], None, CHANGED, 1, 2).render(max_repr=5), "expected 1, got 2")
+        self.assertEqual(bounded_repr([[1, 2], (3,), {}], 100), repr([[1, 2], (3,), {}]))
+        self.assertEqual(bounded_repr([[1, 2], (3,), {}], 5), '[[1, ...')
+
+    def test_difference_table(self):
+        from treecompare.budget import Unexplored
+        from treecompare.results import DifferenceTable
+        expected = {'a': range(50) + [1] * 50, 'b': {'c': 'x', 'd': 'y'}}
+        actual = {'a': range(50) + [0] * 50, 'b': {'c': 'z'}, 'e': 1}
+        differences = diff(expected, actual) + [Unexplored(["['e']"], "not compared")]
+        table = DifferenceTable(diff.iter_diffs(expected, actual))
+        table.append(differences[-1])
+        self.assertEqual(len(table), len(differences))
+        self.assertEqual(sorted(map(repr, table)), sorted(map(repr, differences)))
+        self.assertTrue(isinstance(table[-1], Unexplored))
+        self.assertEqual(table.count_by_prefix(1), {"['a']": 50, "['b']": 2, "['e']": 2})
+        self.assertEqual(table.count_by_kind(), {'changed': 51, 'missing': 1, 'unexpected': 1, None: 1})
+        self.assertEqual(sorted(len(group) for group in table.group_by_prefix(1).values()), [2, 2, 50])
+        self.assertEqual(table.count(lambda difference: difference.path_string.startswith("['a']")), {True: 50, False: 4})
+        # Only messages given when the differences were made are stored
+        self.assertEqual(table.messages.values, [None, "not compared"])
+        self.assertEqual(len(table.unique()), 5)
+        self.assertEqual(table.message_counts()[0], ("expected 1, got 0", 50))
+
+    def test_merge(self):
+        from treecompare.merge import BOTH, CONFLICT, LEFT, RIGHT, UNCHANGED
+        def states(merge):
+            return sorted((change.path_string, change.state) for change in merge.changes)
+        base = {'a': 1, 'b': {'x': 1, 'y': 2}, 'c': [1, 2, 3], 'd': 'same', 'f': 0}
+        left = {'a': 2, 'b': {'x': 1, 'y': 3}, 'c': [1, 2, 3, 4], 'd': 'same', 'f': 5}
+        right = {'a': 1, 'b': {'x': 5, 'y': 2, 'z': 0}, 'c': [1, 2, 3], 'd': 'same', 'e': 1, 'f': 5}
+        merge = diff.merge(base, left, right)
+        self.assertEqual(merge.merged, {'a': 2, 'b': {'x': 5, 'y': 3, 'z': 0}, 'c': [1, 2, 3, 4], 'd': 'same', 'e': 1, 'f': 5})
+        self.assertTrue(merge.clean)
+        self.assertEqual(states(merge), [
+            ("['a']", LEFT), ("['b']['x']", RIGHT), ("['b']['y']", LEFT), ("['b']['z']", RIGHT),
+            ("['c']", LEFT), ("['e']", RIGHT), ("['f']", BOTH),
+        ])
+        self.assertEqual([merge.state(path) for path in ([], ["['b']", "['x']"], ["['c']", '[3]'], ["['d']"])],
+                         [None, RIGHT, LEFT, UNCHANGED])
+        # Different changes to the same node conflict, keeping the left side
+        merge = diff.merge(base, dict(base, a=7, d='x'), dict(base, a=8, d=None))
+        self.assertEqual(states(merge), [("['a']", CONFLICT), ("['d']", CONFLICT)])
+        self.assertEqual(merge.merged, dict(base, a=7, d='x'))
+        self.assertFalse(merge.clean)
+        # Aligned lists merge around the elements neither side changed
+        merge = diff.merge(range(10), [-1] + range(5) + range(6, 10), range(10) + [10], {'': 'align'})
+        self.assertEqual(merge.merged, [-1] + range(5) + range(6, 11))
+        self.assertEqual(states(merge), [('[0]', LEFT), ('[10]', RIGHT), ('[6]', LEFT)])
+        merge = diff.merge(range(5), [0, 'L', 2, 3, 4], [0, 'R', 2, 3, 4], {'': 'align'})
+        self.assertEqual(states(merge), [('[1]', CONFLICT)])
+        # Changes are reported at their index in the merged list
+        base = [{'id': i} for i in range(5)]
+        left = [{'id': 'new'}] + [{'id': i} for i in range(5)]
+        left[3]['x'] = 'L'
+        right = [{'id': i} for i in range(5)]
+        right[2]['x'] = 'R'
+        right[4]['id'] = 'R'
+        merge = diff.merge(base, left, right, {'': 'align'})
+        self.assertEqual(merge.merged, left[:5] + [{'id': 'R'}])
+        self.assertEqual(states(merge), [('[0]', LEFT), ("[3]['x']", CONFLICT), ('[5]', RIGHT)])
+        self.assertEqual(merge.merged[3], {'id': 2, 'x': 'L'})
+        # Children matched up regardless of their key merge as multisets
+        merge = diff.merge([1, 2, 3], [3, 2, 1, 4], [1, 3, 5], {r'^\[\d+\]$': 'ignore_key'})
+        self.assertEqual(merge.merged, [3, 1, 4, 5])
+        self.assertEqual(states(merge), [('[1]', RIGHT), ('[2]', RIGHT), ('[3]', LEFT)])
+        self.assertEqual(diff.merge((1, 2), (1, 3), (4, 2)).merged, (4, 3))
+
+    def test_benchmarks(self):
+        from benchmarks import run
+        results = run.run_scenarios(['wide_dict', 'unordered_list', 'xml_stream'], scale=0.01, repeat=1, isolate=False)
+        self.assertEqual(sorted(results), ['unordered_list', 'wide_dict', 'xml_stream'])
+        self.assertEqual(results['wide_dict']['differences'], 10)
+        self.assertTrue(results['wide_dict']['nodes'] > 500)
+        self.assertEqual(run.compare(results, results), [])
+        baseline = dict((name, dict(result, nodes=result['nodes'] // 2)) for name, result in results.items())
+        self.assertEqual([regression[:2] for regression in run.compare(results, baseline)],
+                         [('unordered_list', 'nodes'), ('wide_dict', 'nodes'), ('xml_stream', 'nodes')])
+        # A baseline from a machine twice as fast only allows half the time
+        faster = run.adjust_for_speed(results, 1.0, 2.0)
+        self.assertEqual(faster['wide_dict']['seconds'], results['wide_dict']['seconds'] / 2)
+        self.assertEqual(faster['wide_dict']['nodes'], results['wide_dict']['nodes'])
+        self.assertTrue(run.calibrate(repeat=1) > 0)
+
+        from benchmarks import generators
+        from benchmarks.scenarios import fingerprint_diff
+        expected, actual = generators.deep_records(10, width=2)
+        self.assertEqual(map(str, fingerprint_diff(expected, actual)), ["['child']" * 10 + ": expected 'bottom', got 'changed'"])
+        self.assertEqual(map(str, diff(expected, actual)), map(str, fingerprint_diff(expected, actual)))
+
+
+class TestIterativeTreeCompare(TestTreeCompare):
+    diff = staticmethod(make_differ(iterative=True))
+
+    def test_deep_trees(self):
+        expected, actual = [], []
+        for i in range(2000):
+            expected, actual = [i, expected], [i, actual]
+        self.assertNotDifferent(expected, actual)
+        self.assertEqual(make_differ(iterative=True, use_fingerprints=True)(expected, actual), [])
+        actual[1][1][1][0] = 'deep'
+        self.assertDifferent({
+                "[1][1][1][0]": "expected 1996, got 'deep'"
+            },
+            expected, actual
+        )
+
+    def test_deep_trees_unkeyed(self):
+        expected, actual = ['x'], ['x']
+        for i in range(3000):
+            expected, actual = [i, expected], [i, actual]
+        for option in ('ignore_key', 'align'):
+            self.assertEqual(self.diff(expected, actual, {r'\]$': option}), [])
+        actual[1][1][1][0] = 'deep'
+        self.assertEqual(map(str, self.diff(expected, actual, {r'\]$': 'ignore_key'})),
+                         ["[1][1][1][0]: expected 2996, got 'deep'"])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,9 @@ assert_includes         Instead of regular equality matching, verify that
 ignore_key              Ignore 'key' (e.g. order index for lists, string key for 
                         dicts) when comparing nodes at path
 
+align                   Align ordered list elements at path, reporting insertions
+                        and deletions at their real indexes
+
 ignore_case             When comparing strings, ignore case.
 
 ignore_spacing          Ignore absolutely all whitespace (including line endings)
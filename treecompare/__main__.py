@@ -0,0 +1,64 @@
+"""
+Command line diff of two JSON or NDJSON files:
+
+    python -m treecompare expected.json actual.json
+    python -m treecompare --key id expected.ndjson actual.ndjson
+
+Prints one difference per line, and exits with status 1 if there were
+any differences, 2 on errors.
+"""
+from __future__ import absolute_import
+
+import argparse
+import sys
+
+from treecompare import jsonfile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='treecompare', description="Diff two JSON or NDJSON files.")
+    parser.add_argument('expected')
+    parser.add_argument('actual')
+    parser.add_argument('--ndjson', action='store_true',
+                        help="the files hold one JSON value per line, matched by line")
+    parser.add_argument('--key', metavar='FIELD',
+                        help="match NDJSON records by the value of FIELD (implies --ndjson)")
+    parser.add_argument('-o', '--option', action='append', default=[], metavar='OPTION',
+                        help="a matching option (e.g. ignore_case) for the whole tree")
+    parser.add_argument('--at', action='append', nargs=2, default=[], metavar=('REGEX', 'OPTION'),
+                        help="a matching option for the paths REGEX matches")
+    parser.add_argument('--max-diffs', type=int, metavar='N', help="stop after N differences")
+    return parser.parse_args(argv)
+
+
+def options_spec(args):
+    """The diff() options spec given by the command line"""
+    if not args.at:
+        return tuple(args.option)
+    spec = {}
+    if args.option:
+        spec[''] = tuple(args.option)
+    for pattern, option in args.at:
+        spec[pattern] = spec.get(pattern, ()) + (option,)
+    return spec
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    found = False
+    try:
+        with open(args.expected, 'rb') as expected_file:
+            with open(args.actual, 'rb') as actual_file:
+                for difference in jsonfile.iter_file_diffs(expected_file, actual_file, options_spec(args),
+                                                           ndjson=args.ndjson, key=args.key,
+                                                           max_diffs=args.max_diffs):
+                    found = True
+                    print difference
+    except (IOError, jsonfile.JSONSyntaxError), e:
+        print >> sys.stderr, "treecompare: %s" % e
+        return 2
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
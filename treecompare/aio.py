@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+"""
+Diffing inside an asyncio (or trollius) event loop without blocking it.
+
+A DiffTask walks the trees like the iterative differ, but a slice of
+nodes at a time, handing control back to the loop between slices. Its
+future gives the same differences Differ.diff would. Cancelling it stops
+the walk, leaving the differences found so far in task.diffs. Subtrees
+whose actual side is at least offload_size long (by len()) can be diffed
+in an executor instead, while the loop carries on with other work.
+"""
+
+import copy
+
+from . import implementations as impl
+from .options import compile_options
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+def size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+
+class DiffTask(object):
+    NODES_PER_SLICE = 1000
+
+    def __init__(self, differ, expected, actual, options={}, path=[], loop=None,
+                 nodes_per_slice=NODES_PER_SLICE, executor=None, offload_size=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.nodes_per_slice = nodes_per_slice
+        self.executor = executor
+        self.offload_size = offload_size
+        if differ.running:
+            # A copy sharing the run's state, so as to leave the caller's
+            # differ as it was
+            self.run = copy.copy(differ)
+        else:
+            self.run = differ.begin()
+        # Have wide nodes' children counted against the slices too
+        self.run.progress_interval = nodes_per_slice
+        options = compile_options(options, shared=not differ.running)
+        self.stack = [iter(self.run.steps(expected, actual, options, path))]
+        # The differences found so far
+        self.diffs = []
+        if hasattr(loop, 'create_future'):
+            self.future = loop.create_future()
+        else:
+            self.future = asyncio.Future(loop=loop)
+        self.loop.call_soon(self.step)
+
+    def cancel(self):
+        """Stop diffing; the differences found so far stay in self.diffs"""
+        return self.future.cancel()
+
+    def offload(self, step):
+        return self.offload_size is not None and size(step.actual) >= self.offload_size
+
+    def step(self):
+        """Diff the next slice of nodes, then schedule the next one"""
+        if self.future.done():
+            return
+        run, stack = self.run, self.stack
+        nodes = 0
+        try:
+            while stack and nodes < self.nodes_per_slice:
+                try:
+                    step = next(stack[-1])
+                except StopIteration:
+                    stack.pop()
+                    continue
+                if isinstance(step, impl.Descend):
+                    if self.offload(step):
+                        job = self.loop.run_in_executor(self.executor, run.diff,
+                                                        step.expected, step.actual, step.options, step.path)
+                        job.add_done_callback(self.offloaded)
+                        return
+                    nodes += 1
+                    stack.append(iter(run.steps(step.expected, step.actual, step.options, step.path)))
+                elif isinstance(step, impl.Progress):
+                    nodes += step.nodes
+                else:
+                    self.diffs.append(step)
+        except Exception, e:
+            self.future.set_exception(e)
+            return
+        if stack:
+            self.loop.call_soon(self.step)
+        else:
+            self.future.set_result(self.diffs)
+
+    def offloaded(self, job):
+        if self.future.done():
+            return
+        if job.exception() is not None:
+            self.future.set_exception(job.exception())
+            return
+        self.diffs += job.result()
+        self.step()
+
+
+def diff_async(differ, expected, actual, options={}, path=[], **kw):
+    """
+    Return a future of the differences between expected and actual, found
+    by differ a slice of nodes at a time (see DiffTask for the keyword
+    arguments)
+    """
+    return DiffTask(differ, expected, actual, options, path, **kw).future
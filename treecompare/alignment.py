@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+"""
+Sequence alignment using Myers' O(ND) difference algorithm, in its linear
+space (middle snake) form. Elements only need to support ==; they are
+usually hashes standing in for whole subtrees or lines of text.
+"""
+
+import time
+
+
+class TooExpensive(Exception):
+    """Raised when an alignment would exceed its cost or time limit"""
+
+
+class Limits(object):
+    """
+    Bounds the work done by one alignment: max_cost is the number of
+    diagonals explored, deadline a time.time() value.
+    """
+    def __init__(self, max_cost=None, deadline=None):
+        self.remaining = max_cost
+        self.deadline = deadline
+
+    def spend(self, cost):
+        if self.remaining is not None:
+            self.remaining -= cost
+            if self.remaining < 0:
+                raise TooExpensive("Alignment cost limit exceeded")
+        if self.deadline is not None and time.time() > self.deadline:
+            raise TooExpensive("Alignment time limit exceeded")
+
+
+def _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi, limits):
+    """
+    Find the middle snake of the shortest edit script between a[a_lo:a_hi]
+    and b[b_lo:b_hi]. Returns the edit distance and the snake's start and
+    end points (relative to a_lo, b_lo).
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    delta = n - m
+    odd = delta % 2
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        if limits is not None:
+            limits.spend(2 * d + 1)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            reverse_k = delta - k
+            if odd and -(d - 1) <= reverse_k <= d - 1 and x + backward[offset + reverse_k] >= n:
+                return 2 * d - 1, (start_x, start_y, x, y)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            forward_k = delta - k
+            if not odd and -d <= forward_k <= d and x + forward[offset + forward_k] >= n:
+                return 2 * d, (n - x, m - y, n - start_x, m - start_y)
+    raise AssertionError("No middle snake found")
+
+
+def _align(a, b, a_lo, a_hi, b_lo, b_hi, matched, limits):
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        matched.append((a_lo, b_lo))
+        a_lo += 1
+        b_lo += 1
+    suffix = []
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+        suffix.append((a_hi, b_hi))
+    if a_lo < a_hi and b_lo < b_hi:
+        d, (x, y, u, v) = _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi, limits)
+        if d > 1:
+            _align(a, b, a_lo, a_lo + x, b_lo, b_lo + y, matched, limits)
+            matched.extend((a_lo + i, b_lo + i + y - x) for i in range(x, u))
+            _align(a, b, a_lo + u, a_hi, b_lo + v, b_hi, matched, limits)
+        else:
+            # A single insertion or deletion: the shorter side matches in order
+            i, j = a_lo, b_lo
+            while i < a_hi and j < b_hi:
+                if a[i] == b[j]:
+                    matched.append((i, j))
+                    i += 1
+                    j += 1
+                elif a_hi - a_lo > b_hi - b_lo:
+                    i += 1
+                else:
+                    j += 1
+    matched.extend(reversed(suffix))
+
+
+def matches(a, b, limits=None):
+    """
+    Return the (i, j) index pairs of a longest common subsequence of a and
+    b. Raises TooExpensive if the given Limits are exceeded.
+    """
+    matched = []
+    _align(a, b, 0, len(a), 0, len(b), matched, limits)
+    return matched
+
+
+def opcodes(a, b, limits=None):
+    """
+    Return (tag, a_lo, a_hi, b_lo, b_hi) tuples describing how to turn a
+    into b, with the same tags as difflib: 'equal', 'replace', 'delete' and
+    'insert'.
+    """
+    codes = []
+    i = j = 0
+    for match_i, match_j in matches(a, b, limits) + [(len(a), len(b))]:
+        if i < match_i and j < match_j:
+            codes.append(('replace', i, match_i, j, match_j))
+        elif i < match_i:
+            codes.append(('delete', i, match_i, j, j))
+        elif j < match_j:
+            codes.append(('insert', i, i, j, match_j))
+        if match_i < len(a):
+            if codes and codes[-1][0] == 'equal':
+                codes[-1] = ('equal', codes[-1][1], match_i + 1, codes[-1][3], match_j + 1)
+            else:
+                codes.append(('equal', match_i, match_i + 1, match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return codes
+
+
+
+def increasing_subsequence(sequence):
+    """
+    Return the indexes of a longest strictly increasing subsequence of
+    sequence, in O(n log n).
+    """
+    tails = []      # tails[k]: index of the smallest last value of an increasing run of length k + 1
+    previous = [None] * len(sequence)
+    for i, value in enumerate(sequence):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sequence[tails[mid]] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            previous[i] = tails[lo - 1]
+        if lo == len(tails):
+            tails.append(i)
+        else:
+            tails[lo] = i
+    indexes = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        indexes.append(i)
+        i = previous[i]
+    indexes.reverse()
+    return indexes
@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+"""
+Diffing NumPy arrays as a whole, rather than one element at a time.
+
+Shapes and dtypes are compared first, then all elements at once, and only
+the differing elements are turned into differences, at the same paths
+DiffLists would give them (e.g. [2][0]). Differences stop after
+max_array_diffs elements, followed by a count of the rest.
+
+Options:
+
+rtol=X, atol=X          Elements match when |actual - expected| <= atol + rtol * |expected|
+max_array_diffs=N       Report at most N differing elements per array
+
+NumPy is optional: without it this module still imports, and DiffArrays
+never applies.
+"""
+
+import hashlib
+
+from .difference import CHANGED, Difference
+from .differ import make_differ
+from .implementations import ImplementationBase
+from .options import option_value
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DiffArrays(ImplementationBase):
+    diffs_types = (numpy.ndarray,) if numpy is not None else ()
+
+    MAX_ARRAY_DIFFS = 100       # max_array_diffs=
+
+    def diff(self, expected, actual):
+        if not isinstance(expected, numpy.ndarray):
+            return self.changed(expected, actual)
+        diffs = []
+        if expected.dtype != actual.dtype:
+            diffs += self.different("expected dtype %s, got dtype %s" % (expected.dtype, actual.dtype),
+                                    kind=CHANGED, expected=expected, actual=actual)
+        if expected.shape != actual.shape:
+            return diffs + self.different("expected shape %r, got shape %r" % (expected.shape, actual.shape),
+                                          kind=CHANGED, expected=expected, actual=actual)
+        different = self.mismatches(expected, actual)
+        if not different.any():
+            return diffs
+        positions = numpy.flatnonzero(different)
+        limit = int(option_value(self.options, 'max_array_diffs', self.MAX_ARRAY_DIFFS))
+        shown = positions[:limit]
+        expected_values = expected.ravel()[shown].tolist()
+        actual_values = actual.ravel()[shown].tolist()
+        indexes = zip(*numpy.unravel_index(shown, expected.shape)) if expected.ndim else [()] * len(shown)
+        for index, expected_value, actual_value in zip(indexes, expected_values, actual_values):
+            path = ''.join("[%r]" % int(i) for i in index)
+            diffs.append(Difference(self.path + path if path else self.path, None, CHANGED, expected_value, actual_value))
+        if len(positions) > limit:
+            diffs += self.different("%d more elements differ (%d of %d in all)" % (
+                len(positions) - limit, len(positions), expected.size), kind=CHANGED, expected=expected, actual=actual)
+        return diffs
+
+    def mismatches(self, expected, actual):
+        """Boolean array of the elements that differ"""
+        rtol = option_value(self.options, 'rtol')
+        atol = option_value(self.options, 'atol')
+        if (rtol is not None or atol is not None) and self.numeric(expected) and self.numeric(actual):
+            return ~numpy.isclose(actual, expected, rtol=float(rtol or 0), atol=float(atol or 0))
+        # Arrays that can't be compared element by element give a single verdict
+        return numpy.broadcast_to(numpy.asarray(expected != actual, dtype=bool), expected.shape)
+
+    @staticmethod
+    def numeric(array):
+        return array.dtype.kind in 'biufc'
+
+    def fingerprint(self, array):
+        if array.dtype.hasobject:
+            return None
+        if array.dtype.kind in 'fc' and numpy.isnan(array).any():
+            # nan never equals anything
+            return None
+        contents = numpy.ascontiguousarray(array)
+        return 'a' + hashlib.sha1('%s\0%r\0%s' % (array.dtype.str, array.shape, contents.tostring())).hexdigest()
+
+    def canonical(self, array):
+        if 'ignore' not in self.options and (option_value(self.options, 'rtol') is not None
+                                             or option_value(self.options, 'atol') is not None):
+            # Arrays within tolerance of each other have different hashes
+            return None
+        return ImplementationBase.canonical(self, array)
+
+    def summary(self, array):
+        return DiffArrays, frozenset([array.shape, array.dtype.str])
+
+
+array_differ = make_differ(DiffArrays)
@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+"""
+Diffing within a time or node budget.
+
+A budgeted diff walks the trees with an explicit stack, and every node
+diffed or hashed is charged to the budget. When it runs out, the walk
+stops and returns the differences found so far, followed by Unexplored
+markers for the node it was about to diff and the nodes it was part way
+through. Their continuation resumes the walk from where it stopped, with a
+new budget, and finds the rest of the differences.
+
+The node count is checked before each node the walk descends into, so a
+single node's own work (e.g. matching up unordered children) can go over
+it, but every budget makes some progress. The deadline is checked at every
+node, however deep in such work: a node interrupted half way is diffed
+again from the start on resuming, and the differences it had already
+reported are skipped. So that resuming makes progress, the node's own work
+is then done without checking the deadline (its children still are).
+"""
+
+import time
+
+from . import implementations as impl
+from .difference import Difference
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class Budget(object):
+    """Up to max_nodes nodes, until deadline (a time.time() value)"""
+    def __init__(self, deadline=None, max_nodes=None):
+        self.deadline = deadline
+        self.max_nodes = max_nodes
+        self.nodes = 0
+
+    def spend(self):
+        self.nodes += 1
+        if self.deadline is not None and time.time() > self.deadline:
+            raise BudgetExhausted("deadline passed")
+
+    def check_nodes(self):
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            raise BudgetExhausted("node budget of %d exhausted" % self.max_nodes)
+
+
+class Unexplored(Difference):
+    """Marks a node that a budgeted diff did not (fully) compare"""
+    __slots__ = ()
+
+    def __repr__(self):
+        return "Unexplored(%s: %r)" % (self.path_string, self.message)
+
+
+class PartialDiff(list):
+    """
+    The differences a budgeted diff found. Unless complete, the last ones
+    are Unexplored markers, and continuation.resume() finds the rest.
+    """
+    def __init__(self, diffs, unexplored, continuation):
+        list.__init__(self, diffs + unexplored)
+        self.unexplored = unexplored
+        self.continuation = continuation
+
+    @property
+    def complete(self):
+        return self.continuation is None
+
+    def resume(self, deadline=None, max_nodes=None):
+        return self.continuation.resume(deadline, max_nodes)
+
+
+class Continuation(object):
+    def __init__(self, run, expected, actual, options, path):
+        self.run = run
+        # Frames of (node's steps, node's Descend, differences produced
+        # before it, whether its work is exempt from the budget)
+        self.stack = []
+        self.pending = impl.Descend(expected, actual, options, path)
+        # The node interrupted half way, to be done again
+        self.redo = None
+        # Differences produced (counting those produced again by nodes being
+        # redone) and reported so far
+        self.produced = self.reported = 0
+
+    def resume(self, deadline=None, max_nodes=None):
+        """Carry on diffing within a new budget, returning a PartialDiff"""
+        run = self.run
+        run.budget = Budget(deadline, max_nodes)
+        try:
+            diffs = self.walk(run.budget)
+        except BudgetExhausted, e:
+            return PartialDiff(self.diffs, self.markers(str(e)), self)
+        finally:
+            run.budget = None
+        return PartialDiff(diffs, [], None)
+
+    def walk(self, budget):
+        run, stack = self.run, self.stack
+        self.diffs = diffs = []
+        while self.pending is not None or stack:
+            if self.pending is not None:
+                budget.check_nodes()
+                node = self.pending
+                exempt = node is self.redo
+                run.budget = None if exempt else budget
+                try:
+                    steps = run.steps(node.expected, node.actual, node.options, node.path)
+                except BudgetExhausted:
+                    self.redo = node
+                    raise
+                self.pending = None
+                stack.append((iter(steps), node, self.produced, exempt))
+                continue
+            steps, node, produced, exempt = stack[-1]
+            run.budget = None if exempt else budget
+            try:
+                step = next(steps)
+            except StopIteration:
+                stack.pop()
+                continue
+            except BudgetExhausted:
+                # The node's steps are gone: do it again, from the start
+                stack.pop()
+                self.pending = self.redo = node
+                self.produced = produced
+                raise
+            if isinstance(step, impl.Descend):
+                self.pending = step
+            else:
+                self.produced += 1
+                if self.produced > self.reported:
+                    self.reported += 1
+                    diffs.append(step)
+        return diffs
+
+    def markers(self, reason):
+        markers = [Unexplored(node.path, "only partly compared: %s" % reason) for steps, node, produced, exempt in self.stack]
+        if self.pending is not None:
+            markers.append(Unexplored(self.pending.path, "not compared: %s" % reason))
+        return markers
@@ -0,0 +1,268 @@
+from __future__ import absolute_import
+"""
+Deltas: the changes that turn one tree into another, as data.
+
+Differ.delta(expected, actual) returns a Delta, a list of operations. Each
+is a tuple of its name and the path of the node it changes, given as the
+list of keys and indexes leading to it (rather than a path string):
+
+('replace', path, value)    Put value at path ([] replacing the whole tree)
+('add', path, value)        Insert value into a list at path, or add a dict key
+('remove', path)            Delete the list element or dict key at path
+('move', path, index)       Move a list's element at index to path
+
+Indexes of removed elements and moved elements' sources count from the
+start of the list as it was, those of added elements and moves'
+destinations as it ends up. Deltas of JSON-like trees serialize to compact
+JSON (Delta.dumps() and Delta.loads(), which gives ascii-only strings back
+as str, as jsonfile does); any others can be pickled.
+
+apply_delta(tree, delta) patches the expected tree in place, leaving it
+matching actual under the options the delta was made with.
+
+Only lists, dicts and other containers with __setitem__ (such as NumPy
+arrays) are patched in place. A change inside anything else - a tuple, a
+string, an XML document - replaces the child of the nearest patchable
+node whole. So does a change inside children matched up regardless of
+their key (ignore_key), or inside elements of an aligned list that grew or
+shrank, as their indexes don't line up with those of the expected tree.
+"""
+
+import ast
+import copy
+import json
+
+from .difference import CHANGED, MISSING, UNEXPECTED
+from .path import as_path
+
+# Operations
+REPLACE = 'replace'
+ADD = 'add'
+REMOVE = 'remove'
+MOVE = 'move'
+
+
+class DeltaError(ValueError):
+    pass
+
+
+class Delta(list):
+    def dumps(self):
+        """The delta as compact JSON"""
+        return json.dumps(self, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, text):
+        """The delta dumped as JSON by dumps()"""
+        from .jsonfile import plain
+        return cls(tuple(operation) for operation in plain(json.loads(text)))
+
+
+def segment_keys(segment):
+    """
+    The keys a path segment such as "['a']" or "[2][0]" stands for, or
+    None if it doesn't stand for keys
+    """
+    try:
+        node = ast.parse('_' + segment, mode='eval').body
+    except SyntaxError:
+        return None
+    keys = []
+    while isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Index):
+        try:
+            keys.append(ast.literal_eval(node.slice.value))
+        except ValueError:
+            return None
+        node = node.value
+    if not (isinstance(node, ast.Name) and node.id == '_'):
+        return None
+    keys.reverse()
+    return keys
+
+
+def patchable(node):
+    return hasattr(type(node), '__setitem__')
+
+
+class _Change(object):
+    """A difference worked out as an operation, with what make_delta needs to know about it"""
+    __slots__ = ('operation', 'keys', 'container', 'aligned', 'nodes', 'expected')
+
+    def __init__(self, operation, keys, container, aligned, nodes, expected):
+        self.operation = operation
+        self.keys = keys
+        self.container = container  # The actual node holding the one changed
+        self.aligned = aligned      # Lengths of the keys of aligned lists' elements above
+        self.nodes = nodes          # The actual nodes along keys
+        self.expected = expected
+
+
+class _DeltaMaker(object):
+    def __init__(self, run, actual, options):
+        self.run = run
+        self.actual = actual
+        self.options = options
+        self.segments = {}
+
+    def keys(self, path):
+        """Yield (key, path of the segment, if the key starts it) along path, then None if it has a segment that isn't keys"""
+        path = as_path(path)
+        prefix = path
+        paths = []
+        while prefix.parent is not None:
+            paths.append(prefix)
+            prefix = prefix.parent
+        for segment_path in reversed(paths):
+            segment = segment_path.segment
+            if segment not in self.segments:
+                self.segments[segment] = segment_keys(segment)
+            keys = self.segments[segment]
+            if keys is None:
+                yield None
+                return
+            for position, key in enumerate(keys):
+                yield key, segment_path if position == 0 else None
+
+    def change(self, difference):
+        keys, nodes, aligned = [], [self.actual], []
+        node = self.actual
+        entries = list(self.keys(difference.path))
+        for position, entry in enumerate(entries):
+            if entry is None or not patchable(node):
+                return _Change(REPLACE, keys, None, aligned, nodes, None)
+            key, child_path = entry
+            if child_path is not None:
+                if 'ignore_key' in self.options.at(child_path):
+                    return _Change(REPLACE, keys, None, aligned, nodes, None)
+                if isinstance(node, list) and 'align' in self.options.at(child_path.parent):
+                    aligned.append(len(keys) + 1)
+            if position == len(entries) - 1:
+                break
+            keys.append(key)
+            try:
+                node = node[key]
+            except (LookupError, TypeError):
+                raise DeltaError("no %r in the actual tree, for %r" % (keys, difference))
+            nodes.append(node)
+        else:
+            # The whole tree
+            return _Change(REPLACE, keys, None, aligned, nodes, None) if difference.kind == CHANGED else self.unknown(difference)
+        keys = keys + [key]
+        if difference.kind == CHANGED:
+            nodes.append(difference.actual)
+            return _Change(REPLACE, keys, node, aligned, nodes, None)
+        if difference.kind == UNEXPECTED:
+            nodes.append(difference.actual)
+            return _Change(ADD, keys, node, aligned, nodes, None)
+        if difference.kind == MISSING:
+            return _Change(REMOVE, keys, node, aligned, nodes, difference.expected)
+        self.unknown(difference)
+
+    def unknown(self, difference):
+        raise DeltaError("%r doesn't say what changed" % (difference,))
+
+    def make(self, differences):
+        changes = [self.change(difference) for difference in differences]
+
+        # Elements of aligned lists that grew or shrank are replaced whole
+        resized = set(tuple(change.keys[:-1]) for change in changes
+                            if change.operation in (ADD, REMOVE) and isinstance(change.container, list))
+        for change in changes:
+            for length in change.aligned:
+                if length < len(change.keys) and tuple(change.keys[:length - 1]) in resized:
+                    change.operation = REPLACE
+                    del change.keys[length:], change.nodes[length + 1:]
+                    break
+
+        # A node replaced whole takes any changes inside it with it
+        replaced = set(tuple(change.keys) for change in changes if change.operation == REPLACE)
+        kept, seen = [], set()
+        for change in changes:
+            keys = tuple(change.keys)
+            if any(keys[:length] in replaced for length in range(len(keys))):
+                continue
+            if change.operation == REPLACE:
+                if keys in seen:
+                    continue
+                seen.add(keys)
+            kept.append(change)
+
+        # An element removed from a list and added back elsewhere is moved
+        removed = {}
+        for change in kept:
+            if change.operation == REMOVE and isinstance(change.container, list):
+                fingerprint = self.run.fingerprint(change.expected)
+                if fingerprint is not None:
+                    removed.setdefault((id(change.container), fingerprint), []).append(change)
+        moves = {}
+        for change in kept:
+            if change.operation == ADD and isinstance(change.container, list):
+                fingerprint = self.run.fingerprint(change.nodes[-1])
+                sources = removed.get((id(change.container), fingerprint)) if fingerprint is not None else None
+                if sources:
+                    moves[id(change)] = source = sources.pop(0)
+                    moves[id(source)] = None
+
+        delta = Delta()
+        for change in kept:
+            if id(change) in moves:
+                source = moves[id(change)]
+                if source is not None:
+                    delta.append((MOVE, change.keys, source.keys[-1]))
+            elif change.operation == REMOVE:
+                delta.append((REMOVE, change.keys))
+            else:
+                delta.append((change.operation, change.keys, change.nodes[-1]))
+        return delta
+
+
+def make_delta(run, differences, actual, options):
+    """The Delta of the differences run found between some expected tree and actual"""
+    return _DeltaMaker(run, actual, options).make(differences)
+
+
+def apply_delta(tree, delta):
+    """
+    Patch tree with delta in place, returning it (or the new tree, when the
+    delta replaces it whole). The values put in are copies of the delta's.
+    """
+    root = [tree]
+    def lookup(keys):
+        node = root[0]
+        for key in keys:
+            node = node[key]
+        return node
+    by_depth = {}
+    for operation in delta:
+        if operation[0] not in (REPLACE, ADD, REMOVE, MOVE):
+            raise DeltaError("unknown operation %r" % (operation,))
+        by_depth.setdefault(len(operation[1]), []).append(operation)
+    # Shallower changes first, so that the paths of deeper ones (using the
+    # indexes lists end up with) lead to the right nodes
+    for depth in sorted(by_depth):
+        operations = by_depth[depth]
+        # Removals from the end of each list first, then additions from the
+        # start, so that every index counts as the operation says
+        moving = {}
+        def source(operation):
+            return operation[2] if operation[0] == MOVE else operation[1][-1]
+        for operation in sorted((o for o in operations if o[0] in (REMOVE, MOVE)), key=source, reverse=True):
+            container = lookup(operation[1][:-1])
+            if operation[0] == MOVE:
+                moving[id(operation)] = container[operation[2]]
+            del container[source(operation)]
+        for operation in sorted((o for o in operations if o[0] in (ADD, MOVE)), key=lambda o: o[1][-1]):
+            container = lookup(operation[1][:-1])
+            value = moving[id(operation)] if operation[0] == MOVE else copy.deepcopy(operation[2])
+            if isinstance(container, list):
+                container.insert(operation[1][-1], value)
+            else:
+                container[operation[1][-1]] = value
+        for operation in operations:
+            if operation[0] == REPLACE:
+                value = copy.deepcopy(operation[2])
+                if operation[1]:
+                    lookup(operation[1][:-1])[operation[1][-1]] = value
+                else:
+                    root[0] = value
+    return root[0]
@@ -1,34 +1,443 @@
-from . import implementations as impl
+import copy
+import itertools
+import types
+
+from . import budget as budget_module, delta as delta_module, implementations as impl, merge as merge_module, parallel, stats as stats_module
+from .matcher import LayeredDict, Matcher
+from .memo import ComparisonMemo
+from .options import compile_options
+from .path import as_path, path_string
 
 class Differ(object):
-    def __init__(self, *implementations):
+    running = False
+    # The DiffStats of the run, if it keeps any
+    stats = None
+    # The run's ComparisonMemo, unless memo_size is 0
+    memo = None
+    # The Matcher whose expected tree this differ's runs diff against
+    compiled = None
+    # The Budget each node is charged to, during budgeted diffs
+    budget = None
+    # Children worked through between Progress steps, during async diffs
+    progress_interval = None
+
+    # Fewer top-level children than this are diffed serially, even when
+    # processes are given
+    PARALLEL_THRESHOLD = 1000
+    # Match verdicts remembered per run (see memo.py)
+    MEMO_SIZE = 100000
+
+    def __init__(self, *implementations, **settings):
         self.implementations = implementations
-    
-    
+        # Compare subtrees by hash rather than ==, for deep trees with a slow == (see README)
+        self.use_fingerprints = settings.pop('use_fingerprints', False)
+        # Diff the top-level children in this many processes (see parallel.py)
+        self.processes = settings.pop('processes', None)
+        self.parallel_threshold = settings.pop('parallel_threshold', self.PARALLEL_THRESHOLD)
+        self.chunk_size = settings.pop('chunk_size', None)
+        # 0 turns the memo off
+        self.memo_size = settings.pop('memo_size', self.MEMO_SIZE)
+        if settings:
+            raise TypeError("Unknown differ settings: %s" % ', '.join(settings))
+
+
     def __call__(self, *args, **kw):
         return self.diff(*args, **kw)
-    
-    def diff(self, expected, actual, options={}, path=[]):
-        if not options and actual == expected:
-            return []
+
+    @property
+    def implementations(self):
+        return self._implementations
+
+    @implementations.setter
+    def implementations(self, implementations):
+        self._implementations = implementations
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget which implementation handles which type. Call this after
+        changing the implementations sequence in place.
+        """
+        self.dispatch = {}
+
+    def begin(self, stats=None):
+        """Return a copy of this differ carrying the state of a single diff run"""
+        run = copy.copy(self)
+        run.running = True
+        run.stats = stats
+        if self.compiled is None:
+            run.fingerprints = {}
+            run.canonicals = {}
+        else:
+            run.fingerprints = LayeredDict(self.compiled.fingerprints)
+            run.canonicals = LayeredDict(self.compiled.canonicals)
+        run.fingerprinters = {}
+        run.memo = ComparisonMemo(self.memo_size) if self.memo_size else None
+        return run
+
+    def compile(self, expected, options={}, path=[]):
+        """
+        Return a Matcher diffing actual trees against expected, doing the
+        work that only depends on expected once (see matcher.py). The
+        expected tree must not change while the matcher is in use.
+        """
+        return Matcher(self, expected, options, path)
+
+    def diff(self, expected, actual, options={}, path=[], max_diffs=None, stats=None, deadline=None, max_nodes=None):
+        """
+        Return the list of differences between expected and actual. Pass a
+        stats.DiffStats as stats to find out where the time goes (the
+        diff is then never spread over processes).
+
+        Given a deadline (a time.time() value) or max_nodes, the diff stops
+        when either runs out, and returns a budget.PartialDiff (see
+        budget.py) that can be resumed. max_diffs is then ignored.
+        """
+        if deadline is not None or max_nodes is not None:
+            return self.diff_within(expected, actual, options, path, stats, deadline, max_nodes)
+        if max_diffs is not None:
+            return list(self.iter_diffs(expected, actual, options, path, max_diffs, stats))
+        if not self.running:
+            options = compile_options(options, shared=True)
+            if stats is not None:
+                with stats.phase(stats_module.DIFF, path):
+                    return self.begin(stats).diff(expected, actual, options, path)
+            if self.processes:
+                return parallel.diff_in_pool(self, expected, actual, options, path)
+            return self.begin().diff(expected, actual, options, path)
+        return self.collect(self.steps(expected, actual, compile_options(options), path))
+
+    def diff_within(self, expected, actual, options={}, path=[], stats=None, deadline=None, max_nodes=None):
+        options = compile_options(options, shared=not self.running)
+        run = self if self.running else self.begin(stats)
+        continuation = budget_module.Continuation(run, expected, actual, options, path)
+        return continuation.resume(deadline, max_nodes)
+
+    def iter_diffs(self, expected, actual, options={}, path=[], max_diffs=None, stats=None):
+        """
+        Yield differences one at a time, as soon as they are found. Nothing
+        past the last difference taken is diffed, so stopping early (or
+        passing max_diffs) cuts the traversal short.
+        """
+        options = compile_options(options, shared=not self.running)
+        run = self if self.running else self.begin(stats)
+        diffs = run.walk(run.steps(expected, actual, options, path))
+        if stats is not None and not self.running:
+            diffs = stats.timed(stats_module.DIFF, path, diffs)
+        if max_diffs is not None:
+            diffs = itertools.islice(diffs, max_diffs)
+        return diffs
+
+    def delta(self, expected, actual, options={}):
+        """
+        Return the changes that turn expected into actual, as a delta.Delta
+        that delta.apply_delta() can patch expected with
+        """
+        options = compile_options(options, shared=not self.running)
+        run = self if self.running else self.begin()
+        return delta_module.make_delta(run, run.iter_diffs(expected, actual, options), actual, options)
+
+    def merge(self, base, left, right, options={}, path=[]):
+        """
+        Three-way merge of left and right, both edited from base, in one
+        walk of the three trees: return a merge.Merge of the merged tree
+        and the nodes changed on either side (see merge.py)
+        """
+        options = compile_options(options, shared=not self.running)
+        run = self if self.running else self.begin()
+        return merge_module.Merger(run, options).merge(base, left, right, as_path(path))
+
+    def diff_async(self, expected, actual, options={}, path=[], **kw):
+        """
+        Return an asyncio future of the differences, found a slice of nodes
+        at a time so as not to block the event loop (see aio.DiffTask)
+        """
+        from . import aio
+        return aio.diff_async(self, expected, actual, options, path, **kw)
+
+    def first_difference(self, expected, actual, options={}, path=[]):
+        """Return the first difference found, or None if there are none"""
+        return next(self.iter_diffs(expected, actual, options, path), None)
+
+    def matches(self, expected, actual, options, path):
+        """
+        True if diffing expected and actual at path finds no differences.
+        Verdicts are remembered for the rest of the run.
+        """
+        options = compile_options(options, shared=not self.running)
+        memo = self.memo
+        if memo is None:
+            return self.first_difference(expected, actual, options, path) is None
+        key = memo.key(expected, actual, options, as_path(path))
+        verdict = memo.get(key)
+        if verdict is None:
+            verdict = self.first_difference(expected, actual, options, path) is None
+            memo.put(key, expected, actual, options, verdict)
+        elif self.stats is not None:
+            self.stats.memo_hits += 1
+        return verdict
+
+    def steps(self, expected, actual, options, path):
+        """The steps (see ImplementationBase.steps) of diffing the node at path"""
+        if self.budget is not None:
+            self.budget.spend()
+        stats = self.stats
+        if stats is None:
+            equal = self.equal(expected, actual, options)
+        else:
+            with stats.phase(stats_module.EQUAL, path):
+                equal = self.equal(expected, actual, options)
+        if equal:
+            return ()
+        memo = self.memo
+        if memo is not None and memo.entries:
+            # Known to match from an earlier comparison
+            entry = memo.entries.get(memo.key(expected, actual, options, as_path(path)))
+            if entry is not None and entry[-1]:
+                return ()
+        return self.implementation_steps(expected, actual, options, path)
+
+    def implementation_steps(self, expected, actual, options, path):
+        """The steps of the implementation for actual, without checking for equality first"""
+        impl_class = self.implementation_for(actual)
+        steps = impl_class(self, options, path).steps(expected, actual)
+        if self.stats is not None:
+            return self.stats.timed(impl_class, path, steps)
+        return steps
+
+    def collect(self, steps):
+        """Return the list of differences found by steps, recursing into children"""
+        diffs = []
+        for step in steps:
+            if isinstance(step, impl.Descend):
+                diffs += self.diff(step.expected, step.actual, step.options, step.path)
+            elif not isinstance(step, impl.Progress):
+                diffs.append(step)
+        return diffs
+
+    def walk(self, steps):
+        """
+        Lazily yield the differences found by steps, descending into children
+        with an explicit stack rather than recursion
+        """
+        stack = [iter(steps)]
+        while stack:
+            try:
+                step = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            if isinstance(step, impl.Descend):
+                stack.append(iter(self.steps(step.expected, step.actual, step.options, step.path)))
+            elif not isinstance(step, impl.Progress):
+                yield step
+
+    def implementation_for(self, actual):
+        implementation = self.find_implementation(actual)
+        if implementation is None:
+            raise Exception("No diff implementation found for %r" % (actual,))
+        return implementation
+
+    def find_implementation(self, actual):
+        actual_type = type(actual)
+        if actual_type is types.InstanceType:
+            # Instances of old-style classes all share one type
+            actual_type = actual.__class__
+        try:
+            return self.dispatch[actual_type]
+        except KeyError:
+            pass
+        # Only remember the result when it can only depend on the type
+        cacheable = True
         if hasattr(actual, '__diff_implementation__'):
-            return actual.__diff_implementation__(self, options, path).get_diffs(expected, actual)
-        for impl_class in self.implementations:
-            if impl_class.can_diff(actual):
-                return impl_class(self, options, path).get_diffs(expected, actual)
-        raise Exception("No diff implementation found for %r" % (actual,))
-        
-            
+            implementation = actual.__diff_implementation__
+            cacheable = hasattr(actual_type, '__diff_implementation__')
+        else:
+            implementation = None
+            for impl_class in self.implementations:
+                if getattr(impl_class.can_diff, 'im_func', None) is not impl.ImplementationBase.can_diff.im_func:
+                    cacheable = False
+                if impl_class.can_diff(actual):
+                    implementation = impl_class
+                    break
+        if cacheable:
+            self.dispatch[actual_type] = implementation
+        return implementation
+
+    def equal(self, expected, actual, options):
+        """
+        Cheap check for nodes that can't produce any differences. When
+        fingerprinting is on, subtrees are compared by structural hash
+        instead of deep equality.
+        """
+        if self.use_fingerprints and options.preserves_equality:
+            expected_fingerprint = self.fingerprint(expected)
+            actual_fingerprint = self.fingerprint(actual)
+            if expected_fingerprint is not None and actual_fingerprint is not None:
+                return expected_fingerprint == actual_fingerprint
+        if options:
+            return False
+        try:
+            return bool(actual == expected)
+        except ValueError:
+            # Values without a single truth value for == (like NumPy
+            # arrays), or containing some, need diffing
+            return False
+
+    def fingerprint(self, diffable):
+        """
+        Structural hash of a subtree, computed bottom-up once per object and
+        remembered for the rest of the run. None if some node in the subtree
+        can't be fingerprinted.
+        """
+        key = id(diffable)
+        try:
+            return self.fingerprints[key][1]
+        except KeyError:
+            pass
+        if self.budget is not None:
+            self.budget.spend()
+        impl_class = self.find_implementation(diffable)
+        if impl_class is None:
+            fingerprint = None
+        else:
+            try:
+                fingerprinter = self.fingerprinters[impl_class]
+            except KeyError:
+                fingerprinter = self.fingerprinters[impl_class] = impl_class(self, (), [])
+            fingerprint = fingerprinter.fingerprint(diffable)
+        # Keep a reference to the object so its id can't be reused this run
+        self.fingerprints[key] = (diffable, fingerprint)
+        return fingerprint
+
+    def canonical(self, diffable, options, path):
+        """
+        Option-aware hash of the subtree at path (see ImplementationBase.canonical),
+        remembered for the rest of the run.
+        """
+        key = (id(diffable), path_string(path))
+        try:
+            return self.canonicals[key][1]
+        except KeyError:
+            pass
+        if self.budget is not None:
+            self.budget.spend()
+        impl_class = self.find_implementation(diffable)
+        if impl_class is None:
+            canonical = None
+        else:
+            canonical = impl_class(self, options, path).canonical(diffable)
+        self.canonicals[key] = (diffable, canonical)
+        return canonical
+
+    def summary(self, diffable, options, path):
+        """Similarity summary of the node at path (see ImplementationBase.summary)"""
+        impl_class = self.find_implementation(diffable)
+        if impl_class is None:
+            return None, frozenset()
+        return impl_class(self, options, path).summary(diffable)
+
+
+
+class IterativeDiffer(Differ):
+    """
+    A differ that walks the trees with an explicit stack of steps instead of
+    recursing, so that very deep trees don't hit the recursion limit. It
+    uses the same implementations, and finds the same differences.
+    """
+    def collect(self, steps):
+        return list(self.walk(steps))
+
+    # After == runs out of stack on some node, don't bother trying it again
+    # until this many levels further down
+    EQUALITY_RETRY_DEPTH = 256
+
+    def begin(self, stats=None):
+        run = Differ.begin(self, stats)
+        run.retry_equality_at = 0
+        return run
+
+    def steps(self, expected, actual, options, path):
+        if len(path) < self.retry_equality_at:
+            return self.implementation_steps(expected, actual, options, path)
+        try:
+            return Differ.steps(self, expected, actual, options, path)
+        except RuntimeError:
+            # Too deep for ==, so walk the trees instead
+            self.retry_equality_at = len(path) + self.EQUALITY_RETRY_DEPTH
+            return self.implementation_steps(expected, actual, options, path)
+
+    def fingerprint(self, diffable):
+        # Fingerprint children bottom-up first, so that the implementations'
+        # fingerprint() only ever finds already known child fingerprints
+        if id(diffable) not in self.fingerprints:
+            stack = [(diffable, None)]
+            while stack:
+                node, children = stack[-1]
+                if children is None:
+                    impl_class = self.find_implementation(node)
+                    if impl_class is not None and issubclass(impl_class, impl.ChildDiffingMixing):
+                        children = iter(impl_class(self, (), []).path_and_child(node))
+                    else:
+                        children = iter(())
+                    stack[-1] = (node, children)
+                for path, child in children:
+                    if id(child) not in self.fingerprints:
+                        stack.append((child, None))
+                        break
+                else:
+                    stack.pop()
+                    Differ.fingerprint(self, node)
+        return Differ.fingerprint(self, diffable)
+
+    def canonical(self, diffable, options, path):
+        # Like fingerprint(), work out children's canonical hashes bottom-up
+        # first, stopping at the first child without one as the node then
+        # has none either
+        if (id(diffable), path_string(path)) not in self.canonicals:
+            stack = [(diffable, path, None)]
+            while stack:
+                node, node_path, children = stack[-1]
+                if children is None:
+                    children = iter(self.canonical_children(node, options, node_path))
+                    stack[-1] = (node, node_path, children)
+                pending = None
+                for child, child_path in children:
+                    key = (id(child), path_string(child_path))
+                    if key not in self.canonicals:
+                        pending = (child, child_path, None)
+                        break
+                    if self.canonicals[key][1] is None:
+                        break
+                if pending is not None:
+                    stack.append(pending)
+                else:
+                    stack.pop()
+                    Differ.canonical(self, node, options, node_path)
+        return Differ.canonical(self, diffable, options, path)
 
+    def canonical_children(self, diffable, options, path):
+        """The (child, path) pairs whose canonical hashes that of diffable is made of"""
+        impl_class = self.find_implementation(diffable)
+        if impl_class is None or not issubclass(impl_class, impl.ChildDiffingMixing):
+            return
+        implementation = impl_class(self, options, path)
+        if 'assert_includes' in implementation.options or 'ignore' in implementation.options:
+            return
+        for child_path, child in implementation.filtered_path_and_child(diffable):
+            with implementation.diffing_child(child_path) as node:
+                yield child, node.path
 
 
-def make_differ(*implementations):
+def make_differ(*implementations, **settings):
     """Generate a fancy differ with extra implementations"""
-    return Differ(
+    differ_class = IterativeDiffer if settings.pop('iterative', False) else Differ
+    return differ_class(
                     impl.DiffPrimitives,
                     impl.DiffNumbers,
                     impl.DiffText,
                     impl.DiffLists,
                     impl.DiffDicts,
-                    *implementations
-            )
\ No newline at end of file
+                    *implementations,
+                    **settings
+            )
@@ -2,11 +2,61 @@ from __future__ import absolute_import
 
 
 
+from .path import path_string
+
+# Kinds of difference, for those that say what changed (see delta.py)
+CHANGED = 'changed'         # expected replaced by actual
+UNEXPECTED = 'unexpected'   # actual where nothing was expected
+MISSING = 'missing'         # expected, but nothing there
+
+# Messages of the differences that don't bring their own
+MESSAGES = {
+    CHANGED: "expected %s, got %s",
+    UNEXPECTED: "unexpected value: %s",
+    MISSING: "expected %s, got nothing",
+}
+
+
 class Difference(object):
-    def __init__(self, path, message):
+    """
+    A difference at a path. Those made without a message (e.g. by
+    ImplementationBase.changed()) only render one, from their kind and
+    values, when it is asked for.
+    """
+    __slots__ = ('path', '_message', 'kind', 'expected', 'actual')
+
+    # Values' reprs in rendered messages are cut short beyond this length
+    MAX_REPR = 1000
+
+    def __init__(self, path, message=None, kind=None, expected=None, actual=None):
         self.path = path
-        self.message = message
-    
+        self._message = message
+        self.kind = kind
+        self.expected = expected
+        self.actual = actual
+
+    @property
+    def message(self):
+        if self._message is not None:
+            return self._message
+        return self.render()
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+
+    def render(self, max_repr=None):
+        """The message of a difference made without one"""
+        if max_repr is None:
+            max_repr = self.MAX_REPR
+        if self.kind == CHANGED:
+            values = (bounded_repr(self.expected, max_repr), bounded_repr(self.actual, max_repr))
+        elif self.kind == UNEXPECTED:
+            values = (bounded_repr(self.actual, max_repr),)
+        else:
+            values = (bounded_repr(self.expected, max_repr),)
+        return MESSAGES[self.kind] % values
+
     def __unicode__(self):
         return u"%s: %s" % (self.path_string, self.message)
 
@@ -16,17 +66,69 @@ class Difference(object):
     def __repr__(self):
     	return "Difference(%s: %r)" % (self.path_string, self.message)
 
-    
+
 
     @property
     def __diff_implementation__(self):
-    	from .implementations import ImplementationBase, ChildDiffingMixing
-    	class DiffImplementation(ChildDiffingMixing, ImplementationBase):
-    	    def path_and_child(self, diffable):
-    	        yield ".path", diffable.path_string
-    	        yield ".message", diffable.message
-    	return DiffImplementation
+    	from .implementations import DiffDifferences
+    	return DiffDifferences
 
     @property
     def path_string(self):
-        return ''.join(self.path)
\ No newline at end of file
+        return path_string(self.path)
+
+
+class _Syntax(str):
+    """Punctuation in bounded_repr's output, as opposed to a value"""
+
+
+def _items(container):
+    """The punctuation and values making up the repr of a non-empty list, tuple or dict"""
+    if type(container) is dict:
+        yield _Syntax('{')
+        for position, (key, value) in enumerate(container.iteritems()):
+            if position:
+                yield _Syntax(', ')
+            yield key
+            yield _Syntax(': ')
+            yield value
+        yield _Syntax('}')
+        return
+    yield _Syntax('[' if type(container) is list else '(')
+    for position, value in enumerate(container):
+        if position:
+            yield _Syntax(', ')
+        yield value
+    if type(container) is list:
+        yield _Syntax(']')
+    else:
+        yield _Syntax(',)' if len(container) == 1 else ')')
+
+
+def bounded_repr(value, max_length):
+    """
+    repr(value), cut short with '...' beyond max_length characters. Lists,
+    tuples and dicts are only repr'd as far as that, however big they are.
+    """
+    pieces = []
+    length = 0
+    stack = [iter((value,))]
+    while stack and length <= max_length:
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if type(item) is _Syntax:
+            piece = item
+        elif type(item) in (list, tuple, dict) and item:
+            stack.append(_items(item))
+            continue
+        else:
+            piece = repr(item)
+        pieces.append(piece)
+        length += len(piece)
+    text = ''.join(pieces)
+    if len(text) > max_length:
+        return text[:max_length] + '...'
+    return text
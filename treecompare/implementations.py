@@ -1,29 +1,69 @@
 from __future__ import absolute_import, with_statement
 
-from contextlib import contextmanager
+import hashlib
+import itertools
 import re
+import time
+
+from .difference import CHANGED, MISSING, UNEXPECTED, Difference
+from . import alignment, matching, stats, textdiff
+from .options import compile_options, option_value
+from .path import as_path
+
+
+class Descend(object):
+    """
+    A request, yielded by ImplementationBase.steps(), for the differ to diff
+    expected and actual at path
+    """
+    __slots__ = ('expected', 'actual', 'options', 'path')
+
+    def __init__(self, expected, actual, options, path):
+        self.expected = expected
+        self.actual = actual
+        self.options = options
+        self.path = path
+
+
+class Progress(object):
+    """
+    Yielded by ImplementationBase.steps() after every differ.progress_interval
+    children worked through at once (such as when splitting or hashing the
+    children of a wide node), so that a DiffTask can hand control back to its
+    event loop in the middle of a node (see aio.py). Only yielded when
+    progress_interval is set; other walkers skip them.
+    """
+    __slots__ = ('nodes',)
+
+    def __init__(self, nodes):
+        self.nodes = nodes
 
-from .difference import Difference
 
 class ImplementationBase(object):
     def __init__(self, differ, options, path):
         self.differ = differ
-        if isinstance(options, (dict, tuple)):
-            self.differ_options = options
-        else:
-            self.differ_options = (options,)
-        self.path = path
+        self.differ_options = compile_options(options)
+        self.path = as_path(path)
+        self._parent = None
+        self._free_child = None
 
 
     @property
     def options(self):
-        options = self.differ_options
-        if isinstance(self.differ_options, dict):
-            options = ()
-            for pattern, opts in self.differ_options.iteritems():
-                if re.search(pattern, self.path_string):
-                    options += opts if isinstance(opts, tuple) else (opts,)
-        return options
+        try:
+            return self._options
+        except AttributeError:
+            if self.differ.stats is None:
+                self._options = self.differ_options.at(self.path)
+            else:
+                self._options = self.differ.stats.resolve_options(self.differ_options, self.path)
+            return self._options
+
+    def timed(self, phase):
+        """Context manager timing a phase of the work at this node, if the run keeps stats"""
+        if self.differ.stats is None:
+            return stats.NOT_TIMED
+        return self.differ.stats.phase(phase, self.path)
     
     @classmethod
     def can_diff(cls, object):
@@ -34,7 +74,34 @@ class ImplementationBase(object):
     
     def diff(self, expected, actual):
         raise NotImplementedError
+
+    def fingerprint(self, diffable):
+        """
+        Return a structural hash of diffable (equal hashes meaning no
+        differences), or None if this implementation can't provide one.
+        """
+        return None
+
+    def canonical(self, diffable):
+        """
+        Like fingerprint(), but taking the options in effect at this node
+        into account: diffables with equal canonical hashes should match.
+        """
+        if 'assert_includes' in self.options:
+            return None
+        if 'ignore' in self.options:
+            return 'I'
+        return self.fingerprint(diffable)
     
+    def summary(self, diffable):
+        """
+        Return a (tag, tokens) pair cheaply describing diffable, used to
+        estimate how similar unordered children are before pairing them up
+        for a full diff. Only nodes with equal tags are considered similar
+        at all; beyond that, the more tokens they share the better.
+        """
+        return self.__class__, frozenset()
+
     def get_diffs(self, expected, actual):
         """
         Calls out to self.diff(), performaing some global processing:
@@ -42,61 +109,173 @@ class ImplementationBase(object):
             - check for 'ignore' option
             - handle 'assert_includes' option
         """
-        #print self.path_string, self.options, expected, actual
+        return self.differ.collect(self.steps(expected, actual))
+
+    def steps(self, expected, actual):
+        """
+        Generator version of get_diffs(): yields each Difference found, and
+        a Descend request for each child that needs diffing, which the differ
+        resolves either recursively or with an explicit stack.
+        """
         if 'ignore' in self.options:
-            return []
+            return
         if 'assert_includes' in self.options and isinstance(expected, tuple):
-            if any([self.matches(option, actual) for i, option in enumerate(expected)]):
+            if any(self.matches(option, actual) for option in expected):
                 # At least one match, no diff!
-                return []
-            else:
-                return self.different("%r not included in %r" % (actual,expected))
+                return
+            for difference in self.different("%r not included in %r" % (actual,expected), kind=CHANGED, expected=expected, actual=actual):
+                yield difference
+            return
 
+        for step in self.diff_steps(expected, actual):
+            yield step
+
+    def diff_steps(self, expected, actual):
+        """
+        The steps of self.diff(). Override to yield Descend requests instead
+        of diffing children directly.
+        """
         return self.diff(expected, actual) or []
 
     
-    def different(self, message_or_path, message=None):
+    def different(self, message_or_path, message=None, kind=None, expected=None, actual=None):
         """
         Call as either:
             self.different(message)         returns a difference for the current node
             self.different(path, message)   returns a difference added to the current path
+        Differences that can be applied as deltas also give their kind
+        (CHANGED, UNEXPECTED or MISSING) and the expected and actual values.
         """
         if message is None:
             message = message_or_path
             path = self.path
         else:
             path = self.path + message_or_path
-        return [Difference(path, message)]
+        return [Difference(path, message, kind, expected, actual)]
+
+    def changed(self, expected, actual):
+        """A difference for the current node, whose message is only rendered if asked for"""
+        return [Difference(self.path, None, CHANGED, expected, actual)]
+
+    def unexpected(self, actual):
+        return [Difference(self.path, None, UNEXPECTED, None, actual)]
+
+    def missing(self, expected):
+        return [Difference(self.path, None, MISSING, expected, None)]
 
     def diff_child(self, new_path, expected, actual):
-        return self.differ.diff(expected, actual, self.differ_options, self.path + [new_path])
+        return self.differ.diff(expected, actual, self.differ_options, self.path.child(new_path))
 
     def continue_diff(self, expected, actual):
         return self.differ.diff(expected, actual, self.differ_options, self.path)
 
+    def descend(self, expected, actual):
+        """Steps version of continue_diff()"""
+        return Descend(expected, actual, self.differ_options, self.path)
+
     def matches(self, expected, actual):
-        return not self.continue_diff(expected, actual)
+        with self.timed(stats.MATCHES):
+            return self.differ.matches(expected, actual, self.differ_options, self.path)
 
     def path_context(self, new_path):
-        return self.__class__(self.differ, self.differ_options, self.path+[new_path])
+        return self.__class__(self.differ, self.differ_options, self.path.child(new_path))
 
-    @contextmanager
     def diffing_child(self, new_path):
-        yield self.path_context(new_path)
+        """
+        Context manager giving a node of this class at new_path. Nodes are
+        handed back on exit and reused for the next sibling, so they must not
+        be used outside of the with block.
+        """
+        child = self._free_child
+        if child is None:
+            child = self.path_context(new_path)
+        else:
+            self._free_child = None
+            child.path = self.path.child(new_path)
+            child.__dict__.pop('_options', None)
+        child._parent = self
+        return child
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._parent is not None:
+            self._parent._free_child = self
+            self._parent = None
 
     @property
     def path_string(self):
-        return ''.join(self.path)
+        return self.path.string
+
+    def setting(self, option, default, convert=int):
+        value = option_value(self.options, option)
+        return default if value is None else convert(value)
+
+    def alignment_limits(self, cost_option, max_cost, seconds_option, max_seconds):
+        """
+        alignment.Limits for aligning something at this node, from 'name=value'
+        options or the given defaults, and ending by the differ's deadline
+        """
+        max_seconds = self.setting(seconds_option, max_seconds, float)
+        deadline = time.time() + max_seconds if max_seconds is not None else None
+        budget = self.differ.budget
+        if budget is not None and budget.deadline is not None:
+            deadline = min(deadline, budget.deadline) if deadline is not None else budget.deadline
+        return alignment.Limits(max_cost=self.setting(cost_option, max_cost), deadline=deadline)
     
 class DiffPrimitives(ImplementationBase):
     diffs_types = (type(None), bool)
     
     def diff(self, expected, actual):
         if expected != actual:
-            return self.different("expected %r, got %r" % (expected, actual))
+            return self.changed(expected, actual)
+
+    def fingerprint(self, value):
+        if value is None:
+            return 'N'
+        if not isinstance(value, (int, long, float)):
+            # Subclasses diffing other types have no fingerprint unless they provide one
+            return None
+        if isinstance(value, float):
+            if value != value:
+                # nan never equals anything
+                return None
+            if not value.is_integer():
+                return 'n%r' % value
+        # bools, ints, longs and integral floats compare equal to each other
+        return 'n%d' % value
 
 class DiffNumbers(DiffPrimitives):
     diffs_types = (int, long, float)
+
+    def diff(self, expected, actual):
+        tolerance = option_value(self.options, 'approx')
+        if tolerance is not None and type(expected) in NUMBER_TYPES and close(expected, actual, float(tolerance)):
+            return
+        return DiffPrimitives.diff(self, expected, actual)
+
+    def canonical(self, value):
+        if 'ignore' not in self.options and option_value(self.options, 'approx') is not None:
+            # Numbers within tolerance of each other have different hashes
+            return None
+        return DiffPrimitives.canonical(self, value)
+
+
+# Stands for a missing child in bulk diffs
+NOTHING = object()
+
+# Exact types (not subclasses) whose values can be compared in bulk
+NUMBER_TYPES = frozenset([int, long, float, bool])
+PRIMITIVE_TYPES = NUMBER_TYPES | frozenset([type(None), str, unicode])
+
+
+def close(expected, actual, tolerance):
+    """
+    True if two numbers are within tolerance of each other, or within
+    tolerance times the larger of them (the 'approx=' option)
+    """
+    return abs(actual - expected) <= tolerance * max(1.0, abs(expected), abs(actual))
     
 
 class DiffText(DiffPrimitives):
@@ -104,26 +283,91 @@ class DiffText(DiffPrimitives):
     diffs_types = basestring
     def diff(self, expected, actual):
         if not isinstance(expected, basestring):
-            return self.different("expected %r, got %r" % (expected, actual))
-        expected_comparable, actual_comparable = expected, actual
-        if 'ignore_case' in self.options:
-            expected_comparable, actual_comparable = expected_comparable.lower(), actual_comparable.lower()
-        if 'ignore_spacing' in self.options:
-            expected_comparable, actual_comparable = self.normalize_spacing(expected_comparable), self.normalize_spacing(actual_comparable)
-        elif 'ignore_line_whitespace' in self.options:
-            expected_comparable, actual_comparable = self.normalize_line_spacing(expected_comparable), self.normalize_line_spacing(actual_comparable)
+            return self.changed(expected, actual)
+        expected_comparable, actual_comparable = self.comparable(expected), self.comparable(actual)
         if expected_comparable != actual_comparable:
             try:
                 import difflib
             except ImportError:
                 difflib = False
             else:
-                if difflib and len(expected) + len(actual) > self.NDIFF_THRESHOLD:
-                    diffs = difflib.ndiff(expected_comparable.splitlines(True)+[], actual_comparable.splitlines(True)+[],)
-                    return self.different("expected %r, got %r - diff:\n%s" % (expected, actual, '\n'.join(diffs)))
+                if difflib and len(expected) + len(actual) > self.NDIFF_THRESHOLD and self.differ.stats is not None:
+                    self.differ.stats.text_bytes += len(expected) + len(actual)
+                if difflib and len(expected) + len(actual) > self.TEXT_DIFF_THRESHOLD:
+                    with self.timed(stats.TEXT_DIFF):
+                        return self.different(self.large_text_diff(expected, actual, expected_comparable, actual_comparable),
+                                              kind=CHANGED, expected=expected, actual=actual)
+                elif difflib and len(expected) + len(actual) > self.NDIFF_THRESHOLD:
+                    with self.timed(stats.TEXT_DIFF):
+                        diffs = difflib.ndiff(expected_comparable.splitlines(True)+[], actual_comparable.splitlines(True)+[],)
+                        return self.different("expected %r, got %r - diff:\n%s" % (expected, actual, '\n'.join(diffs)),
+                                              kind=CHANGED, expected=expected, actual=actual)
                 else:
-                    return self.different("expected %r, got %r" % (expected, actual))
-    
+                    return self.changed(expected, actual)
+
+    # Texts longer than this (together) get a bounded unified diff with
+    # abbreviated reprs instead of a full ndiff. The limits below can be
+    # changed in subclasses, or per node with 'name=value' options such as
+    # 'text_diff_lines=50'.
+    TEXT_DIFF_THRESHOLD = 2000
+    MAX_REPR = 80                # text_repr=
+    CONTEXT_LINES = 3            # text_context=
+    MAX_DIFF_LINES = 200         # text_diff_lines=
+    MAX_DIFF_COST = 2000000      # text_diff_cost=, diagonals explored aligning lines
+    MAX_DIFF_SECONDS = 1.0       # text_diff_seconds=
+    INTRALINE_LINES = 20
+    INTRALINE_LINE_LENGTH = 500
+
+    def large_text_diff(self, expected, actual, expected_comparable, actual_comparable):
+        """Describe how two long texts differ, within the configured limits"""
+        max_repr = self.setting('text_repr', self.MAX_REPR)
+        message = "expected %s (%d characters), got %s (%d characters)" % (
+            textdiff.truncated_repr(expected, max_repr), len(expected),
+            textdiff.truncated_repr(actual, max_repr), len(actual))
+        limits = self.alignment_limits('text_diff_cost', self.MAX_DIFF_COST, 'text_diff_seconds', self.MAX_DIFF_SECONDS)
+        try:
+            lines = textdiff.unified_diff(
+                expected_comparable.splitlines(), actual_comparable.splitlines(),
+                context=self.setting('text_context', self.CONTEXT_LINES),
+                max_lines=self.setting('text_diff_lines', self.MAX_DIFF_LINES),
+                intraline_lines=self.INTRALINE_LINES,
+                intraline_length=self.INTRALINE_LINE_LENGTH,
+                limits=limits)
+        except alignment.TooExpensive, e:
+            return "%s - diff skipped: %s" % (message, e)
+        return "%s - diff:\n%s" % (message, '\n'.join(lines))
+
+    def comparable(self, text):
+        """Normalize text according to the options at this node"""
+        if 'ignore_case' in self.options:
+            text = text.lower()
+        if 'ignore_spacing' in self.options:
+            text = self.normalize_spacing(text)
+        elif 'ignore_line_whitespace' in self.options:
+            text = self.normalize_line_spacing(text)
+        return text
+
+    SUMMARY_WORDS = 256
+
+    def summary(self, text):
+        return DiffText, frozenset(self.comparable(text).split()[:self.SUMMARY_WORDS])
+
+    def canonical(self, text):
+        if 'assert_includes' in self.options or 'ignore' in self.options:
+            return DiffPrimitives.canonical(self, text)
+        return self.fingerprint(self.comparable(text))
+
+    def fingerprint(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        else:
+            try:
+                text.decode('ascii')
+            except UnicodeDecodeError:
+                # Non-ascii byte strings never equal unicode strings
+                return 'b' + hashlib.sha1(text).hexdigest()
+        return 's' + hashlib.sha1(text).hexdigest()
+
     def normalize_spacing(self, text):
         normalized = re.sub(r'([^\w])', ' \\1 ', text)
         normalized = re.sub(r'[\s\n\r]+', ' ', normalized)
@@ -168,79 +412,471 @@ class ChildDiffingMixing(object):
 
         return filter(None, map(get_keyd, children)), unkeyed
     
+    def fingerprint(self, diffable):
+        keyed = []
+        for path, child in self.path_and_child(diffable):
+            child_fingerprint = self.differ.fingerprint(child)
+            if child_fingerprint is None:
+                return None
+            keyed.append((path, child_fingerprint))
+        return self.hash_children(diffable, keyed, [])
+
+    def canonical(self, diffable):
+        if 'assert_includes' in self.options or 'ignore' in self.options:
+            return ImplementationBase.canonical(self, diffable)
+        keyed, unkeyed = [], []
+        for path, child in self.filtered_path_and_child(diffable):
+            with self.diffing_child(path) as node:
+                child_canonical = self.differ.canonical(child, self.differ_options, node.path)
+                if child_canonical is None:
+                    return None
+                if 'ignore_key' in node.options:
+                    unkeyed.append(child_canonical)
+                else:
+                    keyed.append((path, child_canonical))
+        return self.hash_children(diffable, keyed, unkeyed)
+
+    def hash_children(self, diffable, keyed, unkeyed):
+        """
+        Combine the hashes of keyed (path, hash) and unkeyed children. Both
+        are sorted first, so neither the iteration order of dicts nor the
+        order of unkeyed children affects the result.
+        """
+        diffable_type = self.hashed_type(diffable)
+        entries = sorted([
+            "%s\0%s" % (path.encode('utf-8') if isinstance(path, unicode) else path, child_hash)
+            for path, child_hash in keyed
+        ])
+        entries.insert(0, "%s.%s" % (diffable_type.__module__, diffable_type.__name__))
+        if unkeyed:
+            entries.append('')
+            entries.extend(sorted(unkeyed))
+        return 'c' + hashlib.sha1('\n'.join(entries)).hexdigest()
+    
+    def hashed_type(self, diffable):
+        """
+        The type diffable's hash stands for: the first of diffs_types it's
+        an instance of, so that subclasses diff() finds equal to their base
+        (like an OrderedDict and a dict with the same items) hash the same
+        """
+        diffs_types = getattr(self, 'diffs_types', ())
+        for diffs_type in diffs_types if isinstance(diffs_types, tuple) else (diffs_types,):
+            if isinstance(diffable, diffs_type):
+                return diffs_type
+        return type(diffable)
+
+    def pair_unmatched(self, unmatched_expected, unmatched_actual):
+        """
+        Pair each unmatched actual (path, child) with the unmatched expected
+        (path, child) it most resembles, or None when there are more actuals
+        than expecteds. Yields (actual path, actual child, expected) in
+        actual order.
+        """
+        def summaries(children):
+            return [self.differ.summary(child, self.differ_options, self.path.child(path)) for path, child in children]
+        def weight(row, col):
+            # Prefer pairs at the same key when all else is equal
+            same_key = unmatched_actual[row][0] == unmatched_expected[col][0]
+            return 2 * matching.similarity(expected_summaries[col], actual_summaries[row]) + same_key
+        with self.timed(stats.PAIRING):
+            expected_summaries, actual_summaries = summaries(unmatched_expected), summaries(unmatched_actual)
+            pairs = dict(matching.pair(len(unmatched_actual), len(unmatched_expected), weight,
+                            matching.candidate_columns(actual_summaries, expected_summaries)))
+        for row, (path, child) in enumerate(unmatched_actual):
+            yield path, child, unmatched_expected[pairs[row]] if row in pairs else None
+
+    def summary(self, diffable):
+        tokens = set()
+        for path, child in self.filtered_path_and_child(diffable):
+            with self.diffing_child(path) as node:
+                canonical = self.differ.canonical(child, self.differ_options, node.path)
+                if 'ignore_key' in node.options:
+                    tokens.add(('*', canonical))
+                else:
+                    tokens.add(path)
+                    tokens.add((path, canonical))
+        return type(diffable), frozenset(tokens)
+
+    def keyed_and_unkeyed(self, diffable):
+        """
+        Split diffable's children into keyed ones and those for whom
+        ignore_key applies, leaving out ignored ones. Equivalent to
+        split_keyed_unkeyed(filtered_path_and_child(diffable)), but
+        only works out each child's options once.
+        """
+        keyed, unkeyed = [], []
+        for step in self.keyed_and_unkeyed_steps(diffable, keyed, unkeyed):
+            pass
+        return keyed, unkeyed
+
+    def keyed_and_unkeyed_steps(self, diffable, keyed, unkeyed):
+        """Steps version of keyed_and_unkeyed(), filling in the given lists"""
+        interval = self.differ.progress_interval
+        for count, (path, child) in enumerate(self.path_and_child(diffable), 1):
+            with self.diffing_child(path) as node:
+                options = node.options
+            if 'ignore' not in options:
+                (unkeyed if 'ignore_key' in options else keyed).append((path, child))
+            if interval is not None and count % interval == 0:
+                yield Progress(interval)
+
     def filtered_path_and_child(self, diffable):
         for path, child in self.path_and_child(diffable):
             with self.diffing_child(path) as node:
-                if 'ignore' not in node.options:
-                    yield path, child
+                ignored = 'ignore' in node.options
+            if not ignored:
+                yield path, child
 
     def diff(self, expected, actual):
-        diffs = []
-        if not isinstance(actual, type(expected)):
-            return self.different("expected %r, got %r" % (expected, actual))
-        expected_children = list(self.filtered_path_and_child(expected))
-        actual_children = list(self.filtered_path_and_child(actual))
+        return self.differ.collect(self.diff_children(expected, actual))
+
+    def diff_steps(self, expected, actual):
+        if getattr(self.__class__.diff, 'im_func', None) is not ChildDiffingMixing.diff.im_func:
+            # diff() is overridden, so it has the final say
+            return ImplementationBase.diff_steps(self, expected, actual)
+        return self.diff_children(expected, actual)
+
+    def bulk_comparable(self, expected_children, actual_children):
+        """
+        True if children can be compared in bulk with == (see
+        DiffLists.bulk_diff): all of them are primitives, and the options
+        are the same for every path, don't reorder children and can't make
+        equal values differ.
+        """
+        options = self.differ_options
+        if options.scoped is not None or not options.preserves_equality:
+            return False
+        if 'ignore_key' in options.unscoped or 'align' in options.unscoped:
+            return False
+        return set(itertools.imap(type, itertools.chain(expected_children, actual_children))) <= PRIMITIVE_TYPES
 
-        keyed_expected, unkeyed_expected = self.split_keyed_unkeyed(expected_children)
-        keyed_actual, unkeyed_actual = self.split_keyed_unkeyed(actual_children)
+    def bulk_mismatches(self, pairs):
+        """
+        The (key, expected, actual) triples of pairs whose values differ,
+        allowing for 'approx=' (an expected of NOTHING always differs)
+        """
+        tolerance = option_value(self.options, 'approx')
+        if tolerance is None:
+            return [(key, e, a) for key, e, a in pairs if e != a]
+        tolerance = float(tolerance)
+        return [(key, e, a) for key, e, a in pairs
+                    if e != a and not (type(e) in NUMBER_TYPES and type(a) in NUMBER_TYPES and close(e, a, tolerance))]
+
+    def bulk_steps(self, mismatches, missing):
+        """
+        The steps of a bulk diff, in the order diff_children would give
+        them: mismatched (key, expected, actual) children are diffed as
+        usual (or reported as unexpected, for an expected of NOTHING), then
+        missing (key, expected) children are reported
+        """
+        for key, expected_child, actual_child in mismatches:
+            with self.diffing_child("[%r]" % (key,)) as child:
+                if expected_child is NOTHING:
+                    for difference in child.unexpected(actual_child):
+                        yield difference
+                else:
+                    yield child.descend(expected_child, actual_child)
+        for key, expected_child in missing:
+            with self.diffing_child("[%r]" % (key,)) as child:
+                for difference in child.missing(expected_child):
+                    yield difference
+
+    def diff_children(self, expected, actual):
+        """Yield the steps of diffing expected's and actual's children"""
+        if not isinstance(actual, type(expected)):
+            for difference in self.changed(expected, actual):
+                yield difference
+            return
+        index = []
+        for step in self.expected_index_steps(expected, index):
+            yield step
+        keyed_expected, unkeyed_expected, expected_lookup = index
+        keyed_actual, unkeyed_actual = [], []
+        for step in self.keyed_and_unkeyed_steps(actual, keyed_actual, unkeyed_actual):
+            yield step
         # First check keyed elements in lockstep, based on actual:
         # (unkeyed elements are all 'True', so they'll never be different)
 
-
-        expected_lookup = dict(keyed_expected)
         for path, actual_object in keyed_actual:
             with self.diffing_child(path) as child:
                 if path in expected_lookup:
-                    diffs += child.continue_diff(expected_lookup[path], actual_object)
+                    yield child.descend(expected_lookup[path], actual_object)
                 else:
-                    diffs += child.different("unexpected value: %r" % actual_object)
+                    for difference in child.unexpected(actual_object):
+                        yield difference
 
-        # Now check unekeyed elements using broad search...
-        # Attempt to match each actual to each expected, keeping track
-        # of unmatched elements
-        unmatched_expected = dict(unkeyed_expected)
+        unmatched_expected = {}
+        if unkeyed_expected or unkeyed_actual:
+            for step in self.diff_unkeyed(unkeyed_expected, unkeyed_actual, unmatched_expected):
+                yield step
+
+        # And finally, add all missing expectations:
+        keyed_actual_paths = set(path for path, child in keyed_actual)
+        for path, expected_object in keyed_expected + unkeyed_expected:
+            if path in unmatched_expected or (path in expected_lookup and path not in keyed_actual_paths):
+                with self.diffing_child(path) as node:
+                    for difference in node.missing(expected_object):
+                        yield difference
+
+    def expected_index(self, expected):
+        """
+        keyed_and_unkeyed(expected), and a dict of the keyed children. A
+        compiled matcher (see Differ.compile) has these worked out already.
+        The lists must not be changed.
+        """
+        index = []
+        for step in self.expected_index_steps(expected, index):
+            pass
+        return tuple(index)
+
+    def expected_index_steps(self, expected, index):
+        """Steps version of expected_index(), filling in the index list"""
+        compiled = self.differ.compiled
+        if compiled is not None:
+            compiled_index = compiled.index(expected, self.differ_options, self.path)
+            if compiled_index is not None:
+                index.extend(compiled_index)
+                return
+        keyed, unkeyed = [], []
+        for step in self.keyed_and_unkeyed_steps(expected, keyed, unkeyed):
+            yield step
+        index.extend((keyed, unkeyed, dict(keyed)))
+
+    def expected_buckets(self, unkeyed_expected):
+        """
+        The canonical hash of each unkeyed expected child (by path), and
+        the paths of the children with each hash
+        """
+        found = []
+        for step in self.expected_buckets_steps(unkeyed_expected, found):
+            pass
+        return tuple(found)
+
+    def expected_buckets_steps(self, unkeyed_expected, found):
+        """Steps version of expected_buckets(), filling in the found list"""
+        compiled = self.differ.compiled
+        if compiled is not None and id(unkeyed_expected) in compiled.buckets:
+            found.extend(compiled.buckets[id(unkeyed_expected)])
+            return
+        canonicals, buckets = {}, {}
+        interval = self.differ.progress_interval
+        for count, (path, expected_child) in enumerate(unkeyed_expected, 1):
+            with self.diffing_child(path) as node:
+                canonical = self.differ.canonical(expected_child, self.differ_options, node.path)
+                canonicals[path] = canonical
+                if canonical is not None:
+                    buckets.setdefault(canonical, []).append(path)
+            if interval is not None and count % interval == 0:
+                yield Progress(interval)
+        found.extend((canonicals, buckets))
+
+    def diff_unkeyed(self, unkeyed_expected, unkeyed_actual, unmatched_expected):
+        """
+        Yield the steps of diffing children for whom ignore_key applies,
+        leaving the expected ones that found no match in unmatched_expected
+        """
+        # Now check unekeyed elements. Candidates are first bucketed by
+        # their canonical hash, so that exact matches pair up without
+        # comparing every actual to every expected...
+        unmatched_expected.update(unkeyed_expected)
+        found = []
+        for step in self.expected_buckets_steps(unkeyed_expected, found):
+            yield step
+        canonicals, buckets = found
+        def no_exact_match(path_and_child):
+            path, actual_child = path_and_child
+            with self.diffing_child(path) as node:
+                canonical = self.differ.canonical(actual_child, self.differ_options, node.path)
+            # (equal hashes meaning a match, without diffing the pair)
+            for expected_path in buckets.get(canonical, ()) if canonical is not None else ():
+                if expected_path in unmatched_expected:
+                    del unmatched_expected[expected_path]
+                    return False
+            return True
+        interval = self.differ.progress_interval
+        unmatched_actual = []
+        for count, path_and_child in enumerate(unkeyed_actual, 1):
+            if no_exact_match(path_and_child):
+                unmatched_actual.append(path_and_child)
+            if interval is not None and count % interval == 0:
+                yield Progress(interval)
+
+        # ...but different hashes don't mean different children (nor do
+        # missing ones), so what's left is tried against every expected left
+        remaining_expected = [(path, child) for path, child in unkeyed_expected if path in unmatched_expected]
         def no_match(path_and_child):
             path, actual_child = path_and_child
             with self.diffing_child(path) as node:
-                for path, expected_child in unmatched_expected.iteritems():
-                    if node.matches(expected_child, actual_child):
-                        del unmatched_expected[path]
+                for expected_path, expected_child in remaining_expected:
+                    if expected_path in unmatched_expected and node.matches(expected_child, actual_child):
+                        del unmatched_expected[expected_path]
                         return False
-                return True
-        unmatched_actual = filter(no_match, unkeyed_actual)
-         
-        # Now for each unmatched element we try to get the 'deepest'
-        # difference and report that (presumably it's the more useful
-        # one)
-        for path, ua in unmatched_actual:
+            return True
+        remaining_actual, unmatched_actual = unmatched_actual, []
+        for count, path_and_child in enumerate(remaining_actual, 1):
+            if not unmatched_expected or no_match(path_and_child):
+                unmatched_actual.append(path_and_child)
+            if interval is not None and count % interval == 0:
+                yield Progress(interval)
+
+        # Pair up what's left by estimated similarity, and report the
+        # differences of each chosen pair
+        remaining_expected = [(path, child) for path, child in unkeyed_expected if path in unmatched_expected]
+        for path, ua, expected in self.pair_unmatched(remaining_expected, unmatched_actual):
             with self.diffing_child(path) as node:
-                if unmatched_expected:
-                    diffs_to_all = [(p, node.continue_diff(ue, ua)) for p, ue in unmatched_expected.iteritems()]
-                    bdf, best_diff = max(diffs_to_all, key= lambda diffs: sum([len(d.path) for d in diffs[1]]))
-                    del unmatched_expected[bdf]
-                    diffs += best_diff
+                if expected is not None:
+                    expected_path, ue = expected
+                    del unmatched_expected[expected_path]
+                    yield node.descend(ue, ua)
                 else:
-                    diffs += node.different("unexpected value: %r" % ua)
+                    for difference in node.unexpected(ua):
+                        yield difference
 
-        # And finally, add all missing expectations:
-        for path in set(unmatched_expected.keys() + dict(keyed_expected).keys()) - set(dict(unmatched_actual + keyed_actual).keys()):
-            with self.diffing_child(path) as node:
-                expected_object = dict(expected_children)[path]
-                diffs += node.different("expected %r, got nothing" % (expected_object,))
-            
 
-        return diffs
 
+class DiffDifferences(ChildDiffingMixing, ImplementationBase):
+    diffs_types = Difference
 
+    def path_and_child(self, diffable):
+        yield ".path", diffable.path_string
+        yield ".message", diffable.message
 
 
 class DiffLists(ChildDiffingMixing, ImplementationBase):
     diffs_types = (list, tuple)
 
+    # Limits of aligning elements ('align'), beyond which they are paired
+    # up by index instead. Like DiffText's, they can be changed in
+    # subclasses or per node.
+    MAX_ALIGN_COST = 2000000     # align_cost=, diagonals explored
+    MAX_ALIGN_SECONDS = 1.0      # align_seconds=
+
     def path_and_child(self, diffable):
         for i, child in enumerate(diffable):
             yield "[%r]" % i, child
 
+    def diff_children(self, expected, actual):
+        if 'align' in self.options and isinstance(actual, type(expected)):
+            return self.diff_aligned(expected, actual)
+        if (isinstance(expected, (list, tuple)) and isinstance(actual, type(expected))
+                and self.path_and_child.im_func is DiffLists.path_and_child.im_func
+                and self.bulk_comparable(expected, actual)):
+            return self.bulk_diff(expected, actual)
+        return ChildDiffingMixing.diff_children(self, expected, actual)
+
+    def bulk_diff(self, expected, actual):
+        """
+        Diff lists of primitives without the per-child machinery: only the
+        elements that differ get a path and a diff of their own
+        """
+        common = min(len(expected), len(actual))
+        mismatches = self.bulk_mismatches(itertools.izip(itertools.count(), expected, actual))
+        mismatches += [(i, NOTHING, child) for i, child in enumerate(actual[common:], common)]
+        return self.bulk_steps(mismatches, enumerate(expected[common:], common))
+
+    def diff_aligned(self, expected, actual):
+        """
+        Align expected and actual elements by equality or, failing that,
+        their canonical hashes, so that insertions and deletions are reported
+        at their real indexes, and only aligned elements that differ are
+        diffed further.
+        """
+        expected_children = list(self.path_and_child(expected))
+        actual_children = list(self.path_and_child(actual))
+        # Elements equal at either end align as they are, and only those
+        # alignment can't tell apart by == get hashed
+        self.use_equality = self.differ_options.preserves_equality
+        common = min(len(expected_children), len(actual_children))
+        start = 0
+        while start < common and self.same_elements(expected_children[start][1], actual_children[start][1]):
+            start += 1
+        end = 0
+        while end < common - start and self.same_elements(expected_children[-1 - end][1], actual_children[-1 - end][1]):
+            end += 1
+        expected_tokens = [_AlignedElement(self, path, child) for path, child in expected_children[start:len(expected_children) - end]]
+        actual_tokens = [_AlignedElement(self, path, child) for path, child in actual_children[start:len(actual_children) - end]]
+        limits = self.alignment_limits('align_cost', self.MAX_ALIGN_COST, 'align_seconds', self.MAX_ALIGN_SECONDS)
+        try:
+            codes = alignment.opcodes(expected_tokens, actual_tokens, limits)
+        except alignment.TooExpensive:
+            # Pair elements up by index, as without 'align'
+            for step in ChildDiffingMixing.diff_children(self, expected, actual):
+                yield step
+            return
+        for tag, e_lo, e_hi, a_lo, a_hi in codes:
+            if tag == 'equal':
+                continue
+            e_lo, e_hi, a_lo, a_hi = e_lo + start, e_hi + start, a_lo + start, a_hi + start
+            unpaired_expected = expected_children[e_lo:e_hi]
+            if e_hi - e_lo == a_hi - a_lo:
+                # Elements replaced in place
+                pairs = zip(actual_children[a_lo:a_hi], unpaired_expected)
+            else:
+                pairs = [((path, child), expected) for path, child, expected
+                            in self.pair_unmatched(unpaired_expected, actual_children[a_lo:a_hi])]
+            for (path, actual_child), expected in pairs:
+                with self.diffing_child(path) as child:
+                    if expected is not None:
+                        unpaired_expected.remove(expected)
+                        yield child.descend(expected[1], actual_child)
+                    elif 'ignore' not in child.options:
+                        for difference in child.unexpected(actual_child):
+                            yield difference
+            for path, expected_child in unpaired_expected:
+                with self.diffing_child(path) as child:
+                    if 'ignore' not in child.options:
+                        for difference in child.missing(expected_child):
+                            yield difference
+
+
+    def same_elements(self, expected, actual):
+        """True if expected and actual are the same object, or == when that means no differences"""
+        if expected is actual:
+            return True
+        if not self.use_equality:
+            return False
+        try:
+            return bool(expected == actual)
+        except ValueError:
+            return False
+        except RuntimeError:
+            # Too deep for == (see IterativeDiffer), so leave it to hashes
+            self.use_equality = False
+            return False
+
+
+class _AlignedElement(object):
+    """
+    An element of a list diffed with 'align', as alignment compares it:
+    equal to another when DiffLists.same_elements() says so, or when their
+    canonical hashes are equal. Those are only worked out when needed.
+    """
+    __slots__ = ('implementation', 'path', 'child', 'hashed', 'canonical_hash')
+
+    def __init__(self, implementation, path, child):
+        self.implementation = implementation
+        self.path = path
+        self.child = child
+        self.hashed = False
+
+    def canonical(self):
+        if not self.hashed:
+            implementation = self.implementation
+            self.canonical_hash = implementation.differ.canonical(
+                self.child, implementation.differ_options, implementation.path.child(self.path))
+            self.hashed = True
+        return self.canonical_hash
+
+    def __eq__(self, other):
+        if self.implementation.same_elements(self.child, other.child):
+            return True
+        # Elements without a canonical hash never align with anything else
+        canonical = self.canonical()
+        return canonical is not None and canonical == other.canonical()
+
+    def __ne__(self, other):
+        return not self == other
+
 
 class DiffDicts(ChildDiffingMixing, ImplementationBase):
     diffs_types = dict
@@ -248,3 +884,16 @@ class DiffDicts(ChildDiffingMixing, ImplementationBase):
     def path_and_child(self, diffable):
         for key, child in diffable.iteritems():
             yield "[%r]" % key, child
+
+    def diff_children(self, expected, actual):
+        if (isinstance(expected, dict) and isinstance(actual, type(expected))
+                and self.path_and_child.im_func is DiffDicts.path_and_child.im_func
+                and self.bulk_comparable(expected.itervalues(), actual.itervalues())):
+            return self.bulk_diff(expected, actual)
+        return ChildDiffingMixing.diff_children(self, expected, actual)
+
+    def bulk_diff(self, expected, actual):
+        """Like DiffLists.bulk_diff, for dicts of primitives"""
+        mismatches = self.bulk_mismatches((key, expected.get(key, NOTHING), value) for key, value in actual.iteritems())
+        missing = [(key, value) for key, value in expected.iteritems() if key not in actual]
+        return self.bulk_steps(mismatches, missing)
@@ -0,0 +1,337 @@
+from __future__ import absolute_import
+"""
+Diffing JSON and NDJSON files without loading them.
+
+Files are memory-mapped, and each object or array is a lazy node standing
+for a span of the file: its children are only scanned for when it needs
+diffing, and two nodes whose text is byte for byte the same are equal
+without being looked into. Values are only decoded (materialized) when a
+difference has to show them.
+"""
+
+import json
+import mmap
+import re
+
+from .differ import IterativeDiffer, make_differ
+from .implementations import DiffDicts, DiffLists
+
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+SCALAR = re.compile(r'[^ \t\r\n,\]}]+')
+# Strings (skipped whole), brackets and unterminated strings inside containers
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|([\[{])|([\]}])|(")', re.S)
+OPENING, CLOSING, UNTERMINATED = 1, 2, 3
+
+# Span comparisons are done this many bytes at a time
+COMPARE_CHUNK = 1 << 20
+
+
+class JSONSyntaxError(ValueError):
+    pass
+
+
+def plain(value):
+    """Decoded JSON with ascii-only strings turned into str, as paths and messages show them"""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return dict((plain(key), plain(item)) for key, item in value.iteritems())
+    return value
+
+
+def decode_string(buf, start, end):
+    """Decode the JSON string at buf[start:end]"""
+    text = buf[start + 1:end - 1]
+    if '\\' in text:
+        return plain(json.loads(buf[start:end]))
+    try:
+        text.decode('ascii')
+        return text
+    except UnicodeDecodeError:
+        return text.decode('utf-8')
+
+
+def skip_whitespace(buf, pos):
+    return WHITESPACE.match(buf, pos).end()
+
+
+def skip_value(buf, pos):
+    """Return the end of the JSON value starting at pos"""
+    char = buf[pos:pos + 1]
+    if char == '"':
+        match = STRING.match(buf, pos)
+        if match is None:
+            raise JSONSyntaxError("Unterminated string at %d" % pos)
+        return match.end()
+    if char in ('{', '['):
+        depth = 0
+        for match in TOKEN.finditer(buf, pos):
+            kind = match.lastindex
+            if kind == OPENING:
+                depth += 1
+            elif kind == CLOSING:
+                depth -= 1
+                if not depth:
+                    return match.end()
+            elif kind == UNTERMINATED:
+                break
+        raise JSONSyntaxError("Unterminated %s at %d" % (char, pos))
+    match = SCALAR.match(buf, pos)
+    if match is None:
+        raise JSONSyntaxError("Expected a value at %d" % pos)
+    return match.end()
+
+
+def expect(buf, pos, chars):
+    """Skip whitespace, check the next character is one of chars, and return it and the position after it"""
+    pos = skip_whitespace(buf, pos)
+    char = buf[pos:pos + 1]
+    if not char or char not in chars:
+        raise JSONSyntaxError("Expected %s at %d, found %r" % (' or '.join(chars), pos, char))
+    return char, pos + 1
+
+
+def check_end(pos, end):
+    # The end of a top-level value is only found when its members are read
+    if pos != end:
+        raise JSONSyntaxError("Extra data at %d" % pos)
+
+
+def spans_equal(buf, start, end, other_buf, other_start, other_end):
+    if end - start != other_end - other_start:
+        return False
+    for offset in xrange(0, end - start, COMPARE_CHUNK):
+        length = min(COMPARE_CHUNK, end - start - offset)
+        if buf[start + offset:start + offset + length] != other_buf[other_start + offset:other_start + offset + length]:
+            return False
+    return True
+
+
+def node(buf, start, end):
+    """The value at buf[start:end]: a lazy node for objects and arrays, decoded otherwise"""
+    char = buf[start:start + 1]
+    if char == '{':
+        return JSONObject(buf, start, end)
+    if char == '[':
+        return JSONArray(buf, start, end)
+    if char == '"':
+        return decode_string(buf, start, end)
+    try:
+        return plain(json.loads(buf[start:end]))
+    except ValueError, e:
+        raise JSONSyntaxError("%s at %d" % (e, start))
+
+
+class JSONNode(object):
+    """A JSON object or array, standing for buf[start:end]"""
+    __slots__ = ('buf', 'start', 'end')
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def value(self):
+        """Decode the whole node"""
+        return plain(json.loads(self.buf[self.start:self.end]))
+
+    def same_text(self, other):
+        return spans_equal(self.buf, self.start, self.end, other.buf, other.start, other.end)
+
+    def __eq__(self, other):
+        # Nodes are only known to be equal by their text: differently
+        # formatted equal values have to be diffed to find they don't differ
+        if isinstance(other, JSONNode):
+            return self.same_text(other)
+        return self.value() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return repr(self.value())
+
+
+class JSONObject(JSONNode):
+    __slots__ = ()
+
+    def spans(self):
+        """Yield the decoded key and value span of each member"""
+        buf = self.buf
+        pos = skip_whitespace(buf, self.start + 1)
+        if buf[pos:pos + 1] == '}':
+            check_end(pos + 1, self.end)
+            return
+        while True:
+            pos = skip_whitespace(buf, pos)
+            if buf[pos:pos + 1] != '"':
+                raise JSONSyntaxError("Expected a key at %d" % pos)
+            key_end = skip_value(buf, pos)
+            key = decode_string(buf, pos, key_end)
+            char, pos = expect(buf, key_end, ':')
+            start = skip_whitespace(buf, pos)
+            pos = skip_value(buf, start)
+            yield key, start, pos
+            char, pos = expect(buf, pos, ',}')
+            if char == '}':
+                check_end(pos, self.end)
+                return
+
+    def iteritems(self):
+        for key, start, end in self.spans():
+            yield key, node(self.buf, start, end)
+
+    def get(self, key, default=None):
+        for member_key, start, end in self.spans():
+            if member_key == key:
+                return node(self.buf, start, end)
+        return default
+
+
+class JSONArray(JSONNode):
+    __slots__ = ()
+
+    def spans(self):
+        buf = self.buf
+        pos = skip_whitespace(buf, self.start + 1)
+        if buf[pos:pos + 1] == ']':
+            check_end(pos + 1, self.end)
+            return
+        while True:
+            start = skip_whitespace(buf, pos)
+            pos = skip_value(buf, start)
+            yield start, pos
+            char, pos = expect(buf, pos, ',]')
+            if char == ']':
+                check_end(pos, self.end)
+                return
+
+    def __iter__(self):
+        for start, end in self.spans():
+            yield node(self.buf, start, end)
+
+
+class Records(object):
+    """The records (one JSON value per line) of an NDJSON buffer"""
+    def __init__(self, buf):
+        self.buf = buf
+
+    def spans(self):
+        buf = self.buf
+        pos = skip_whitespace(buf, 0)
+        while pos < len(buf):
+            end = skip_value(buf, pos)
+            yield pos, end
+            pos = skip_whitespace(buf, end)
+
+    def __iter__(self):
+        for start, end in self.spans():
+            yield node(self.buf, start, end)
+
+    def __repr__(self):
+        return "<%d NDJSON records>" % sum(1 for span in self.spans())
+
+
+class KeyedRecords(object):
+    """
+    NDJSON records keyed by the value of one of their fields, or by their
+    position for those without a (scalar) value for it
+    """
+    def __init__(self, buf, key):
+        self.records = Records(buf)
+        self.key = key
+
+    def iteritems(self):
+        for position, record in enumerate(self.records):
+            key = record.get(self.key) if isinstance(record, JSONObject) else None
+            if key is None or isinstance(key, JSONNode):
+                key = "<record %d>" % position
+            yield key, record
+
+    def __repr__(self):
+        return "<NDJSON records by %r>" % (self.key,)
+
+
+class DiffJSONObject(DiffDicts):
+    diffs_types = (JSONObject, KeyedRecords)
+
+
+class DiffJSONArray(DiffLists):
+    diffs_types = (JSONArray, Records)
+
+
+class JSONDiffer(IterativeDiffer):
+    def equal(self, expected, actual, options):
+        # The same text is the same value, whatever the options (bar
+        # assert_includes) say
+        if isinstance(expected, JSONNode) and isinstance(actual, JSONNode) and options.preserves_equality:
+            if expected.same_text(actual):
+                return True
+        return IterativeDiffer.equal(self, expected, actual, options)
+
+
+json_differ = JSONDiffer(*(make_differ().implementations + (DiffJSONObject, DiffJSONArray)))
+
+
+def map_file(f):
+    """Memory-map an open file for reading (empty files become an empty string)"""
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files can't be mapped
+        return ''
+
+
+def load(buf):
+    """The top-level value of a JSON buffer"""
+    start = skip_whitespace(buf, 0)
+    if start == len(buf):
+        raise JSONSyntaxError("No JSON value found")
+    closing = {'{': '}', '[': ']'}.get(buf[start])
+    if closing is None:
+        end = skip_value(buf, start)
+    else:
+        # Rather than scanning the whole file for the end of the value,
+        # take the end of the file, as long as it closes the value
+        end = len(buf)
+        while buf[end - 1] in ' \t\r\n':
+            end -= 1
+        if buf[end - 1] != closing:
+            raise JSONSyntaxError("Expected %s at %d" % (closing, end - 1))
+    if skip_whitespace(buf, end) != len(buf):
+        raise JSONSyntaxError("Extra data at %d" % end)
+    return node(buf, start, end)
+
+
+def load_records(buf, key=None):
+    """The records of an NDJSON buffer, keyed by their key field if one is given"""
+    return Records(buf) if key is None else KeyedRecords(buf, key)
+
+
+def iter_file_diffs(expected_file, actual_file, options={}, ndjson=False, key=None, max_diffs=None):
+    """
+    Yield the differences between two open JSON (or with ndjson, NDJSON)
+    files. NDJSON records are matched by line, or by the value of their
+    key field if one is given.
+    """
+    buffers = map(map_file, (expected_file, actual_file))
+    if ndjson or key is not None:
+        expected, actual = [load_records(buf, key) for buf in buffers]
+    else:
+        expected, actual = map(load, buffers)
+    return json_differ.iter_diffs(expected, actual, options, max_diffs=max_diffs)
+
+
+def diff_files(expected_path, actual_path, *args, **kw):
+    """Return the list of differences between two JSON or NDJSON files (see iter_file_diffs)"""
+    with open(expected_path, 'rb') as expected_file:
+        with open(actual_path, 'rb') as actual_file:
+            return list(iter_file_diffs(expected_file, actual_file, *args, **kw))
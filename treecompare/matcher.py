@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+"""
+Diffing many actual trees against the same expected tree.
+
+Differ.compile(expected, options) returns a Matcher, which works out the
+parts of diffing that only depend on the expected tree once: the options
+at each expected path, each node's keyed and unkeyed children, the hash
+buckets used to match up unkeyed children, and (for differs using them)
+subtree fingerprints. Each matcher.diff(actual) then reuses them, and only
+pays for walking the actual tree.
+"""
+
+import copy
+
+from . import implementations as impl
+from .options import compile_options
+from .path import as_path
+
+
+class LayeredDict(dict):
+    """A dict falling back on a base dict for the keys it doesn't have, without copying it"""
+    def __init__(self, base):
+        dict.__init__(self)
+        self.base = base
+
+    def __missing__(self, key):
+        return self.base[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.base
+
+
+class Matcher(object):
+    def __init__(self, differ, expected, options={}, path=[]):
+        self.expected = expected
+        self.options = compile_options(options)
+        self.path = as_path(path)
+        # (id(node), scope) -> (node, keyed children, unkeyed children, keyed lookup)
+        self.indexes = {}
+        # id(unkeyed children list) -> (canonicals, buckets), see ChildDiffingMixing.expected_buckets
+        self.buckets = {}
+
+        run = differ.begin()
+        if differ.use_fingerprints:
+            run.fingerprint(expected)
+        self.analyze(run)
+        # Runs resolve the paths of their actual trees too, but only
+        # those of the expected tree are worth keeping across runs
+        self.options.pin()
+        # Only ever holding expected nodes, these can be shared by all runs
+        self.fingerprints = run.fingerprints
+        self.canonicals = run.canonicals
+
+        # Runs of this differ look up what was worked out here
+        self.differ = copy.copy(differ)
+        self.differ.compiled = self
+        self.differ.processes = None
+
+    def key(self, expected, path):
+        # Without scoped options, a node's children are the same at any path
+        return id(expected), None if self.options.scoped is None else path.string
+
+    def analyze(self, run):
+        """Index the children of every node of the expected tree"""
+        stack = [(self.expected, self.path)]
+        while stack:
+            node, path = stack.pop()
+            impl_class = run.find_implementation(node)
+            if impl_class is None or not issubclass(impl_class, impl.ChildDiffingMixing):
+                continue
+            implementation = impl_class(run, self.options, path)
+            if 'ignore' in implementation.options:
+                continue
+            keyed, unkeyed = implementation.keyed_and_unkeyed(node)
+            self.indexes[self.key(node, path)] = (node, keyed, unkeyed, dict(keyed))
+            if unkeyed:
+                self.buckets[id(unkeyed)] = implementation.expected_buckets(unkeyed)
+            for child_path, child in keyed + unkeyed:
+                stack.append((child, path.child(child_path)))
+
+    def index(self, expected, options, path):
+        """The keyed and unkeyed children of expected at path, and a lookup of the keyed ones, if known"""
+        if options is not self.options:
+            return None
+        index = self.indexes.get(self.key(expected, path))
+        return index[1:] if index is not None else None
+
+    def diff(self, actual, max_diffs=None, stats=None):
+        """Return the list of differences between the expected tree and actual"""
+        return self.differ.diff(self.expected, actual, self.options, self.path, max_diffs, stats)
+
+    def iter_diffs(self, actual, max_diffs=None, stats=None):
+        return self.differ.iter_diffs(self.expected, actual, self.options, self.path, max_diffs, stats)
+
+    def first_difference(self, actual):
+        return self.differ.first_difference(self.expected, actual, self.options, self.path)
+
+    def matches(self, actual):
+        return self.first_difference(actual) is None
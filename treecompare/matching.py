@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+"""
+Pairing of unordered (ignore_key) children that have no exact match.
+
+Candidates are scored with a cheap similarity estimate built from node
+summaries (see ImplementationBase.summary), and only the chosen pairs are
+fully diffed afterwards.
+"""
+
+# Problems with at most this many (row, column) pairs are solved optimally
+EXHAUSTIVE_LIMIT = 2500
+
+# Larger problems only score this many candidates per row...
+CANDIDATES_PER_ROW = 16
+# ...found through summary tokens shared by at most this many columns
+COMMON_TOKEN_LIMIT = 64
+
+
+def similarity(summary, other):
+    """
+    Score two node summaries from 0 (different kinds of node) to 1001
+    (same kind, identical summary tokens)
+    """
+    tag, tokens = summary
+    other_tag, other_tokens = other
+    if tag != other_tag:
+        return 0
+    union = len(tokens | other_tokens)
+    if not union:
+        return 1
+    return 1 + len(tokens & other_tokens) * 1000 // union
+
+
+def hungarian(weights):
+    """
+    Maximum weight assignment for a matrix of integer weights with no more
+    rows than columns. Returns the column assigned to each row.
+    """
+    rows, cols = len(weights), len(weights[0])
+    top = max(max(row) for row in weights)
+    infinity = float('inf')
+    u, v = [0] * (rows + 1), [0] * (cols + 1)
+    assigned, way = [0] * (cols + 1), [0] * (cols + 1)
+    for row in range(1, rows + 1):
+        assigned[0] = row
+        col = 0
+        min_slack = [infinity] * (cols + 1)
+        used = [False] * (cols + 1)
+        while True:
+            used[col] = True
+            current_row = assigned[col]
+            row_weights = weights[current_row - 1]
+            delta, next_col = infinity, None
+            for j in range(1, cols + 1):
+                if not used[j]:
+                    slack = top - row_weights[j - 1] - u[current_row] - v[j]
+                    if slack < min_slack[j]:
+                        min_slack[j], way[j] = slack, col
+                    if min_slack[j] < delta:
+                        delta, next_col = min_slack[j], j
+            for j in range(cols + 1):
+                if used[j]:
+                    u[assigned[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_slack[j] -= delta
+            col = next_col
+            if assigned[col] == 0:
+                break
+        while col:
+            previous = way[col]
+            assigned[col] = assigned[previous]
+            col = previous
+    assignment = [None] * rows
+    for col in range(1, cols + 1):
+        if assigned[col]:
+            assignment[assigned[col] - 1] = col - 1
+    return assignment
+
+
+def candidate_columns(row_summaries, col_summaries):
+    """
+    Return a function giving the most promising columns for a row: those
+    sharing the most summary tokens with it, ignoring tokens so common
+    they say nothing.
+    """
+    postings = {}
+    for col, (tag, tokens) in enumerate(col_summaries):
+        for token in tokens:
+            postings.setdefault((tag, token), []).append(col)
+    def candidates(row):
+        tag, tokens = row_summaries[row]
+        shared = {}
+        for token in tokens:
+            cols = postings.get((tag, token), ())
+            if len(cols) <= COMMON_TOKEN_LIMIT:
+                for col in cols:
+                    shared[col] = shared.get(col, 0) + 1
+        best = sorted(shared.iteritems(), key=lambda (col, count): (-count, col))
+        return [col for col, count in best[:CANDIDATES_PER_ROW]]
+    return candidates
+
+
+def pair(rows, cols, weight, candidates=None):
+    """
+    Pair up min(rows, cols) row and column indexes, maximizing the total
+    weight(row, col). Small problems are solved optimally; larger ones
+    greedily, scoring only the candidates(row) columns of each row. Rows
+    and columns left without a candidate are paired up in order.
+
+    Returns a sorted list of (row, col) pairs.
+    """
+    if not rows or not cols:
+        return []
+    if rows * cols <= EXHAUSTIVE_LIMIT:
+        if rows <= cols:
+            weights = [[weight(row, col) for col in range(cols)] for row in range(rows)]
+            return list(enumerate(hungarian(weights)))
+        weights = [[weight(row, col) for row in range(rows)] for col in range(cols)]
+        return sorted((row, col) for col, row in enumerate(hungarian(weights)))
+
+    edges = []
+    for row in range(rows):
+        for col in (candidates(row) if candidates else range(cols)):
+            edges.append((-weight(row, col), row, col))
+    edges.sort()
+    pairs, paired_rows, paired_cols = [], set(), set()
+    for negative_weight, row, col in edges:
+        if row not in paired_rows and col not in paired_cols:
+            pairs.append((row, col))
+            paired_rows.add(row)
+            paired_cols.add(col)
+    leftover_cols = iter([col for col in range(cols) if col not in paired_cols])
+    for row in range(rows):
+        if row not in paired_rows:
+            col = next(leftover_cols, None)
+            if col is None:
+                break
+            pairs.append((row, col))
+    return sorted(pairs)
@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+"""
+Remembering which subtrees matched during a diff run.
+
+Unordered matching compares the same (expected, actual) pair more than
+once: when looking for its exact match, again when it is diffed in full
+after pairing, and for every parent pair that a shared subtree turns up
+under. The memo keeps the verdict of each comparison, keyed by the
+identity of both objects and the options in effect, so repeats don't walk
+the subtrees again.
+"""
+
+from collections import OrderedDict
+
+
+class ComparisonMemo(object):
+    """
+    Match verdicts of (expected, actual) pairs for a single run, the least
+    recently used ones being forgotten beyond max_size entries
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(expected, actual, options, path):
+        # Without scoped options, the verdict is the same at any path
+        scope = None if options.scoped is None else path.string
+        return id(expected), id(actual), id(options), scope
+
+    def get(self, key):
+        """The remembered verdict for key, or None"""
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = entry
+        return entry[-1]
+
+    def put(self, key, expected, actual, options, verdict):
+        # The entry holds on to the objects, so that their ids can't be reused
+        self.entries[key] = (expected, actual, options, verdict)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,365 @@
+from __future__ import absolute_import
+"""
+Three-way merges: reconciling two trees edited from a common base.
+
+Differ.merge(base, left, right, options) walks the three trees together,
+and classifies each node that changed as:
+
+LEFT        changed on the left only (the left side is taken)
+RIGHT       changed on the right only (the right side is taken)
+BOTH        changed the same way on both sides
+CONFLICT    changed differently on both sides (the left side is kept)
+
+Two sides of a node are the same when they are identical, have the same
+fingerprint (for differs using them), are equal or, given options that
+could make them match anyway, when they match. Subtrees the same on all
+three sides are UNCHANGED, and taken without walking them.
+
+Nodes changed differently on both sides are merged child by child when
+all three are lists, tuples or dicts of the same type, with the children's
+paths and options diff would use: keyed children are merged by key (list
+elements by index, or by aligning them with the base for the 'align'
+option, when changes are reported at their index in the merged list),
+and children for whom ignore_key applies as a multiset. Anything else is
+a conflict. Ignored children never count as changes, and are
+taken from the left when their parent is merged child by child.
+
+The result is a Merge of the merged tree, and MergeChanges for the nodes
+that changed. A child missing on some side (deleted, or only added on the
+other sides) is NOTHING there.
+"""
+
+import collections
+import copy
+
+from . import alignment, implementations as impl
+from .delta import segment_keys
+from .path import as_path, path_string
+
+# States of nodes
+UNCHANGED = 'unchanged'
+LEFT = 'left'
+RIGHT = 'right'
+BOTH = 'both'
+CONFLICT = 'conflict'
+
+NOTHING = impl.NOTHING
+
+
+class MergeChange(object):
+    """A node that changed on some side, and how"""
+    __slots__ = ('path', 'state', 'base', 'left', 'right')
+
+    def __init__(self, path, state, base, left, right):
+        self.path = path
+        self.state = state
+        self.base = base
+        self.left = left
+        self.right = right
+
+    @property
+    def path_string(self):
+        return path_string(self.path)
+
+    def __repr__(self):
+        return "MergeChange(%s: %s)" % (self.path_string, self.state)
+
+
+class Merge(object):
+    def __init__(self, merged, changes):
+        self.merged = merged
+        self.changes = changes
+
+    @property
+    def conflicts(self):
+        return [change for change in self.changes if change.state == CONFLICT]
+
+    @property
+    def clean(self):
+        return not self.conflicts
+
+    def state(self, path):
+        """
+        The state of the node at path: that of the change at it or the
+        nearest node above it, UNCHANGED if nothing at or below it changed,
+        or None if only nodes below it did
+        """
+        segments = as_path(path).segments()
+        state, depth, below = UNCHANGED, -1, False
+        for change in self.changes:
+            change_segments = as_path(change.path).segments()
+            if segments[:len(change_segments)] == change_segments:
+                if len(change_segments) > depth:
+                    state, depth = change.state, len(change_segments)
+            elif change_segments[:len(segments)] == segments:
+                below = True
+        if depth < 0 and below:
+            return None
+        return state
+
+
+class _Assembly(object):
+    """A container being merged, put together once its children are"""
+    def __init__(self, template, target, index):
+        self.template = template
+        self.target = target
+        self.index = index
+        self.keys = []
+        self.orders = []
+        self.values = []
+
+    def slot(self, key, order, value=None):
+        """Make room for a child, returning its index in self.values"""
+        self.keys.append(key)
+        self.orders.append(order)
+        self.values.append(value)
+        return len(self.values) - 1
+
+    def finish(self):
+        template = self.template
+        items = [(order, key, value) for order, key, value in zip(self.orders, self.keys, self.values)
+                    if value is not NOTHING]
+        if isinstance(template, dict):
+            if type(template) is dict:
+                merged = {}
+            else:
+                merged = copy.copy(template)
+                merged.clear()
+            for order, key, value in items:
+                merged[key] = value
+        else:
+            items.sort(key=lambda item: item[0])
+            values = [value for order, key, value in items]
+            if type(template) is tuple:
+                merged = tuple(values)
+            elif type(template) is list:
+                merged = values
+            else:
+                merged = copy.copy(template)
+                merged[:] = values
+        self.target[self.index] = merged
+
+
+class Merger(object):
+    def __init__(self, run, options):
+        self.run = run
+        self.options = options
+        self.changes = []
+        self.segments = {}
+
+    def merge(self, base, left, right, path):
+        result = [None]
+        # Nodes to merge, as (base, left, right, path, target, index) with
+        # the merged node going to target[index], and _Assemblies to finish
+        stack = [(base, left, right, path, result, 0)]
+        while stack:
+            frame = stack.pop()
+            if isinstance(frame, _Assembly):
+                frame.finish()
+            else:
+                self.merge_node(stack, *frame)
+        return Merge(result[0], self.changes)
+
+    def same(self, a, b, path):
+        if a is b:
+            return True
+        if a is NOTHING or b is NOTHING:
+            return False
+        options = self.options
+        if options.preserves_equality:
+            if self.run.use_fingerprints:
+                a_fingerprint, b_fingerprint = self.run.fingerprint(a), self.run.fingerprint(b)
+                if a_fingerprint is not None and a_fingerprint == b_fingerprint:
+                    return True
+            try:
+                if a == b:
+                    return True
+                if not options:
+                    return False
+            except ValueError:
+                # No single truth value for == (like NumPy arrays)
+                pass
+        return self.run.matches(a, b, options, path)
+
+    def changed(self, path, state, base, left, right):
+        self.changes.append(MergeChange(path, state, base, left, right))
+
+    def merge_node(self, stack, base, left, right, path, target, index):
+        if 'ignore' in self.options.at(path):
+            target[index] = left
+            return
+        if self.same(base, left, path):
+            if not self.same(base, right, path):
+                self.changed(path, RIGHT, base, left, right)
+                left = right
+        elif self.same(base, right, path):
+            self.changed(path, LEFT, base, left, right)
+        elif self.same(left, right, path):
+            self.changed(path, BOTH, base, left, right)
+        elif self.merge_children(stack, base, left, right, path, target, index):
+            return
+        else:
+            self.changed(path, CONFLICT, base, left, right)
+        target[index] = left
+
+    def children(self, node, tree):
+        """(segment, key, child, options) for each of tree's children, or None if their paths aren't keys"""
+        children = []
+        for segment, child in node.path_and_child(tree):
+            if segment not in self.segments:
+                self.segments[segment] = segment_keys(segment)
+            keys = self.segments[segment]
+            if keys is None or len(keys) != 1:
+                return None
+            with node.diffing_child(segment) as child_node:
+                options = child_node.options
+            children.append((segment, keys[0], child, options))
+        return children
+
+    def merge_children(self, stack, base, left, right, path, target, index):
+        """Merge the children of a node changed differently on both sides, or return False if they can't be"""
+        container_type = type(left)
+        if not (type(base) is container_type and type(right) is container_type):
+            return False
+        if not (issubclass(container_type, (list, dict)) or container_type is tuple):
+            return False
+        impl_class = self.run.find_implementation(left)
+        if impl_class is None or not issubclass(impl_class, impl.ChildDiffingMixing):
+            return False
+        node = impl_class(self.run, self.options, path)
+        sides = [self.children(node, tree) for tree in (base, left, right)]
+        if None in sides:
+            return False
+        aligned = not isinstance(left, dict) and 'align' in node.options
+
+        def split(children):
+            keyed, unkeyed = collections.OrderedDict(), []
+            for segment, key, child, options in children:
+                if 'ignore_key' in options and 'ignore' not in options:
+                    unkeyed.append((segment, key, child))
+                else:
+                    keyed[segment] = (segment, key, child)
+            return keyed, unkeyed
+        (base_keyed, base_unkeyed), (left_keyed, left_unkeyed), (right_keyed, right_unkeyed) = map(split, sides)
+
+        merged_unkeyed = self.merge_unkeyed(path, base_unkeyed, left_unkeyed, right_unkeyed)
+        if merged_unkeyed is None:
+            return False
+        assembly = _Assembly(left, target, index)
+        stack.append(assembly)
+        for position, (segment, key, child) in enumerate(merged_unkeyed):
+            assembly.slot(key, (1, position), child)
+        if aligned:
+            self.merge_aligned(stack, assembly, path, base_keyed.values(), left_keyed.values(), right_keyed.values())
+            return True
+        segments = list(left_keyed)
+        segments += [segment for segment in right_keyed if segment not in left_keyed]
+        segments += [segment for segment in base_keyed if segment not in left_keyed and segment not in right_keyed]
+        for segment in segments:
+            entries = [side.get(segment) for side in (base_keyed, left_keyed, right_keyed)]
+            key = next(entry[1] for entry in entries if entry is not None)
+            children = [entry[2] if entry is not None else NOTHING for entry in entries]
+            slot = assembly.slot(key, (0, key))
+            stack.append((children[0], children[1], children[2], path.child(segment), assembly.values, slot))
+        return True
+
+    def merge_unkeyed(self, path, base, left, right):
+        """
+        Merge children matched up regardless of their key as multisets of
+        their canonical hashes, None if some have none. For each hash, the
+        left's count of children is kept unless only the right changed it.
+        """
+        if not (base or left or right):
+            return []
+        def counts(children):
+            hashes = [self.run.canonical(child, self.options, path.child(segment)) for segment, key, child in children]
+            by_hash = collections.OrderedDict()
+            for child_hash, entry in zip(hashes, children):
+                by_hash.setdefault(child_hash, []).append(entry)
+            return by_hash
+        base_hashes, left_hashes, right_hashes = counts(base), counts(left), counts(right)
+        if None in base_hashes or None in left_hashes or None in right_hashes:
+            return None
+        merged = []
+        keep = {}
+        for child_hash in list(left_hashes) + [h for h in right_hashes if h not in left_hashes] + list(base_hashes):
+            if child_hash in keep:
+                continue
+            sides = [hashes.get(child_hash, []) for hashes in (base_hashes, left_hashes, right_hashes)]
+            b, l, r = map(len, sides)
+            if l == b and r == b:
+                keep[child_hash] = l
+                continue
+            if l == b:
+                state, keep[child_hash] = RIGHT, r
+            elif r == b:
+                state, keep[child_hash] = LEFT, l
+            elif l == r:
+                state, keep[child_hash] = BOTH, l
+            else:
+                state, keep[child_hash] = CONFLICT, max(0, l + r - b)
+            segment = next(entries[0][0] for entries in sides if entries)
+            self.changed(path.child(segment), state, *[entries[0][2] if entries else NOTHING for entries in sides])
+        for child_hash, entries in left_hashes.iteritems():
+            merged += entries[:keep[child_hash]]
+        for child_hash, entries in right_hashes.iteritems():
+            extra = keep[child_hash] - len(left_hashes.get(child_hash, ()))
+            if extra > 0:
+                merged += entries[-extra:]
+        return merged
+
+    def merge_aligned(self, stack, assembly, path, base, left, right):
+        """
+        Merge aligned lists' elements like diff3: runs of elements unchanged
+        on both sides anchor the merge, and each stretch between anchors is
+        taken from the side that changed it, merged element by element if
+        both changed it but kept its length, or else is a conflict. Changes
+        are reported at their index in the merged list, as elements inserted
+        or removed before them shift the sides' indexes.
+        """
+        def tokens(children):
+            # Elements without a canonical hash never align with anything
+            return [self.run.canonical(child, self.options, path.child(segment)) or object()
+                        for segment, key, child in children]
+        def anchors(base_tokens, side_tokens):
+            return dict((b, s) for tag, b_lo, b_hi, s_lo, s_hi in alignment.opcodes(base_tokens, side_tokens)
+                            if tag == 'equal' for b, s in zip(range(b_lo, b_hi), range(s_lo, s_hi)))
+        base_tokens, left_tokens, right_tokens = tokens(base), tokens(left), tokens(right)
+        left_anchors, right_anchors = anchors(base_tokens, left_tokens), anchors(base_tokens, right_tokens)
+        stable = [(b, left_anchors[b], right_anchors[b]) for b in range(len(base))
+                    if b in left_anchors and b in right_anchors]
+        position = [0]
+        def take(children):
+            for segment, key, child in children:
+                assembly.slot(key, (0, position[0]), child)
+                position[0] += 1
+        b_from = l_from = r_from = 0
+        for b_to, l_to, r_to in stable + [(len(base), len(left), len(right))]:
+            base_run, left_run, right_run = base[b_from:b_to], left[l_from:l_to], right[r_from:r_to]
+            if base_run or left_run or right_run:
+                base_run_tokens = base_tokens[b_from:b_to]
+                left_same = left_tokens[l_from:l_to] == base_run_tokens
+                right_same = right_tokens[r_from:r_to] == base_run_tokens
+                segment = '[%r]' % position[0]
+                values = [[entry[2] for entry in run] for run in (base_run, left_run, right_run)]
+                if left_same:
+                    if not right_same:
+                        self.changed(path.child(segment), RIGHT, *values)
+                    take(right_run)
+                elif right_same:
+                    self.changed(path.child(segment), LEFT, *values)
+                    take(left_run)
+                elif left_tokens[l_from:l_to] == right_tokens[r_from:r_to]:
+                    self.changed(path.child(segment), BOTH, *values)
+                    take(left_run)
+                elif len(base_run) == len(left_run) == len(right_run):
+                    for (b_segment, b_key, b_child), (segment, key, child), (r_segment, r_key, r_child) in zip(base_run, left_run, right_run):
+                        slot = assembly.slot(key, (0, position[0]))
+                        stack.append((b_child, child, r_child, path.child('[%r]' % position[0]), assembly.values, slot))
+                        position[0] += 1
+                else:
+                    self.changed(path.child(segment), CONFLICT, *values)
+                    take(left_run)
+            if b_to < len(base):
+                take(left[l_to:l_to + 1])
+            b_from, l_from, r_from = b_to + 1, l_to + 1, r_to + 1
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+import re
+
+from .path import path_string
+
+
+class Options(object):
+    """
+    Matching options compiled for a single diff run.
+
+    The options spec given to ``diff()`` is either a single option, a tuple of
+    options, or a dict mapping path regexes to options. Scoped patterns are
+    compiled once, and the option set for each path is worked out once and
+    remembered for the rest of the run.
+
+    Options shared by many runs (a Matcher's, or options compiled ahead and
+    passed to several diffs) remember the paths pinned by pin() for good,
+    and at most MAX_RESOLVED others. A single run's options remember every
+    path, however big the run.
+    """
+    MAX_RESOLVED = 100000
+
+    def __init__(self, spec):
+        self.spec = spec
+        if isinstance(spec, dict) and spec:
+            self.scoped = [(re.compile(pattern), opts if isinstance(opts, tuple) else (opts,))
+                            for pattern, opts in spec.iteritems()]
+            self.unscoped = None
+        else:
+            self.scoped = None
+            if isinstance(spec, dict):
+                self.unscoped = ()
+            else:
+                self.unscoped = spec if isinstance(spec, tuple) else (spec,)
+        self.resolved = {}
+        self.pinned = {}
+        # Set once the options outlive a run (see compile_options())
+        self.shared = False
+        # Pattern searches done resolving paths (see stats.py)
+        self.searches = 0
+
+    def __getstate__(self):
+        # Workers work out the options of their own paths
+        state = self.__dict__.copy()
+        state['resolved'], state['pinned'] = {}, {}
+        return state
+
+    def __nonzero__(self):
+        return bool(self.spec)
+
+    @property
+    def preserves_equality(self):
+        """
+        True unless some option can make equal subtrees differ
+        (only 'assert_includes' does, as it compares against a tuple)
+        """
+        if self.scoped is None:
+            return 'assert_includes' not in self.unscoped
+        return not any('assert_includes' in opts for pattern, opts in self.scoped)
+
+    def at(self, path):
+        """Return the tuple of options that apply to the given path segments"""
+        if self.scoped is None:
+            return self.unscoped
+        return self.resolve(path_string(path))
+
+    def resolve(self, path_string):
+        """Return the tuple of options that apply to the given path"""
+        if self.scoped is None:
+            return self.unscoped
+        try:
+            return self.resolved[path_string]
+        except KeyError:
+            options = ()
+            self.searches += len(self.scoped)
+            for pattern, opts in self.scoped:
+                if pattern.search(path_string):
+                    options += opts
+            if self.shared and len(self.resolved) >= len(self.pinned) + self.MAX_RESOLVED:
+                # Forget all but the pinned paths
+                self.resolved = dict(self.pinned)
+            self.resolved[path_string] = options
+            return options
+
+    def pin(self):
+        """Remember the paths resolved so far for good (see MAX_RESOLVED)"""
+        self.pinned = dict(self.resolved)
+        self.shared = True
+
+
+def compile_options(spec, shared=False):
+    """
+    Compile an options spec, passing already compiled options through.
+    shared is true when the spec comes from outside the run it is compiled
+    for: options compiled already then outlive the run, and are marked so.
+    """
+    if isinstance(spec, Options):
+        if shared:
+            spec.shared = True
+        return spec
+    return Options(spec)
+
+
+def option_value(options, name, default=None):
+    """
+    Return the value of a 'name=value' option from a tuple of options, or
+    default if it isn't given. Values are strings.
+    """
+    prefix = name + '='
+    for option in options:
+        if isinstance(option, basestring) and option.startswith(prefix):
+            return option[len(prefix):]
+    return default
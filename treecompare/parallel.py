@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+"""
+Diffing the top-level children of large trees in a process pool.
+
+The top-level node is diffed as usual in this process, up to the point
+where it asks for its children to be diffed (its Descend steps). Those are
+split into chunks and diffed by the pool's workers, each given the differ
+and the compiled options, and the results are put back in the order a
+serial diff would give them. Workers only send back each difference's path
+below the child, kind and message, not the (possibly big) expected and
+actual values, which the differences rebuilt here go without.
+"""
+
+import copy
+import multiprocessing
+
+from . import implementations as impl
+from .difference import Difference
+
+
+def diff_chunk(args):
+    """
+    Diff a chunk of (expected, actual, path) children in a worker, giving
+    each child's differences as (segments below path, kind, message)
+    """
+    differ, options, children = args
+    run = differ.begin()
+    return [[(list(diff.path)[len(path):], diff.kind, diff.message)
+                for diff in run.diff(expected, actual, options, path)]
+            for expected, actual, path in children]
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def diff_in_pool(differ, expected, actual, options, path):
+    """
+    Diff expected and actual with differ (a differ not yet running),
+    diffing the top-level children in differ.processes worker processes
+    if there are at least differ.parallel_threshold of them
+    """
+    run = differ.begin()
+    if run.equal(expected, actual, options):
+        return []
+    steps = list(run.steps(expected, actual, options, path))
+    descends = [step for step in steps if isinstance(step, impl.Descend)]
+    if len(descends) < differ.parallel_threshold:
+        return run.collect(steps)
+
+    # A few chunks per process, so that uneven chunks even out
+    chunk_size = differ.chunk_size or -(-len(descends) // (differ.processes * 4))
+    # The dispatch cache can hold unpicklable types (like NoneType)
+    shipped = copy.copy(differ)
+    shipped.invalidate()
+    tasks = [(shipped, options, [(step.expected, step.actual, step.path) for step in chunk])
+                for chunk in chunks(descends, chunk_size)]
+    pool = multiprocessing.Pool(differ.processes)
+    try:
+        results = pool.map(diff_chunk, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    child_diffs = iter([diffs for chunk_results in results for diffs in chunk_results])
+    diffs = []
+    for step in steps:
+        if isinstance(step, impl.Descend):
+            diffs += [Difference(step.path + segments, message, kind)
+                        for segments, kind, message in next(child_diffs)]
+        else:
+            diffs.append(step)
+    return diffs
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+
+
+class Path(object):
+    """
+    A node's path: its last segment plus its parent's path, which is shared
+    rather than copied. Behaves like the list of segment strings it stands
+    for, and only joins them into a string when asked, remembering the
+    result.
+    """
+    __slots__ = ('parent', 'segment', 'length', '_string')
+
+    def __init__(self, parent=None, segment=None):
+        self.parent = parent
+        self.segment = segment
+        self.length = parent.length + 1 if parent is not None else 0
+        self._string = None
+
+    def child(self, segment):
+        return Path(self, segment)
+
+    def __add__(self, segments):
+        if isinstance(segments, basestring):
+            return Path(self, segments)
+        path = self
+        for segment in segments:
+            path = Path(path, segment)
+        return path
+
+    def __radd__(self, segments):
+        return as_path(segments) + self
+
+    @property
+    def string(self):
+        if self._string is None:
+            # Join up from the nearest ancestor that already has its string
+            # (without recursing, as paths can be very deep)
+            unjoined = []
+            path = self
+            while path._string is None and path.parent is not None:
+                unjoined.append(path)
+                path = path.parent
+            if path._string is None:
+                path._string = ''
+            string = path._string
+            for path in reversed(unjoined):
+                string += path.segment
+                path._string = string
+        return self._string
+
+    def __str__(self):
+        return str(self.string)
+
+    def __unicode__(self):
+        return unicode(self.string)
+
+    def __repr__(self):
+        return "Path(%r)" % (list(self),)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.segments())
+
+    def segments(self):
+        segments = []
+        path = self
+        while path.parent is not None:
+            segments.append(path.segment)
+            path = path.parent
+        segments.reverse()
+        return segments
+
+    def __getitem__(self, index):
+        return self.segments()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, Path):
+            return self.length == other.length and self.string == other.string and self.segments() == other.segments()
+        if isinstance(other, (list, tuple)):
+            return self.segments() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(tuple(self.segments()))
+
+
+ROOT = Path()
+
+
+def as_path(segments):
+    """Turn a list of segments into a Path, passing Paths through"""
+    if isinstance(segments, Path):
+        return segments
+    if isinstance(segments, basestring):
+        return Path(ROOT, segments) if segments else ROOT
+    return ROOT + segments
+
+
+def path_string(segments):
+    """Join path segments, using the remembered string of Paths"""
+    if isinstance(segments, Path):
+        return segments.string
+    return ''.join(segments)
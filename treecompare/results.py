@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+"""
+Keeping very many differences compactly.
+
+A DifferenceTable stores differences column by column: paths (whose
+parents are shared between siblings), arrays of small codes standing for
+each difference's class, kind and message, and references to the
+expected and actual values. Messages are stored once however many
+differences repeat them, and those of differences made without one are
+only rendered when asked for. Indexing or iterating a table gives back
+Difference objects.
+
+    table = DifferenceTable(diff.iter_diffs(expected, actual))
+    table.count_by_prefix(1)        # {"['users']": 99012, "['groups']": 988}
+    table.message_counts()[:10]     # the most repeated messages
+"""
+
+import array
+
+from .path import as_path
+
+
+class _Codes(object):
+    """A column of values drawn from a small set, stored as an array of codes"""
+    def __init__(self):
+        self.values = []
+        self.indexes = {}
+        self.codes = array.array('l')
+
+    def append(self, value):
+        try:
+            code = self.indexes[value]
+        except KeyError:
+            code = self.indexes[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+
+def prefix(path, depth):
+    """The string of path's first depth segments"""
+    path = as_path(path)
+    while path.length > depth:
+        path = path.parent
+    return path.string
+
+
+class DifferenceTable(object):
+    def __init__(self, differences=()):
+        self.paths = []
+        self.classes = _Codes()
+        self.kinds = _Codes()
+        self.messages = _Codes()
+        self.expected = []
+        self.actual = []
+        self.extend(differences)
+
+    def append(self, difference):
+        self.paths.append(difference.path)
+        self.classes.append(type(difference))
+        self.kinds.append(difference.kind)
+        self.messages.append(difference._message)
+        self.expected.append(difference.expected)
+        self.actual.append(difference.actual)
+
+    def extend(self, differences):
+        for difference in differences:
+            self.append(difference)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return DifferenceTable(self[i] for i in xrange(*row.indices(len(self))))
+        if row < 0:
+            row += len(self)
+        return self.classes[row](self.paths[row], self.messages[row], self.kinds[row], self.expected[row], self.actual[row])
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield self[row]
+
+    def __repr__(self):
+        return "<DifferenceTable of %d differences>" % len(self)
+
+    def message(self, row):
+        """The message of the difference at row, rendered if need be"""
+        message = self.messages[row]
+        if message is None:
+            message = self[row].message
+        return message
+
+    def count(self, key):
+        """Count the differences by key(difference)"""
+        counts = {}
+        for difference in self:
+            value = key(difference)
+            counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def group(self, key):
+        """Split the differences by key(difference), into a dict of DifferenceTables"""
+        groups = {}
+        for difference in self:
+            value = key(difference)
+            if value not in groups:
+                groups[value] = DifferenceTable()
+            groups[value].append(difference)
+        return groups
+
+    def count_by_prefix(self, depth=1):
+        """Count the differences by the string of their paths' first depth segments"""
+        counts = {}
+        for path in self.paths:
+            key = prefix(path, depth)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def group_by_prefix(self, depth=1):
+        return self.group(lambda difference: prefix(difference.path, depth))
+
+    def count_by_kind(self):
+        counts = {}
+        for code in self.kinds.codes:
+            kind = self.kinds.values[code]
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def message_counts(self):
+        """(message, count) pairs of the distinct messages, most repeated first"""
+        counts = {}
+        for row, code in enumerate(self.messages.codes):
+            message = self.messages.values[code]
+            if message is None:
+                message = self.message(row)
+            counts[message] = counts.get(message, 0) + 1
+        return sorted(counts.iteritems(), key=lambda item: (-item[1], item[0]))
+
+    def unique(self):
+        """A table of the first difference with each distinct message"""
+        seen = set()
+        table = DifferenceTable()
+        for row in xrange(len(self)):
+            message = self.message(row)
+            if message not in seen:
+                seen.add(message)
+                table.append(self[row])
+        return table
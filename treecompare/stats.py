@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+"""
+Opt-in statistics about where a diff run spends its time.
+
+Pass a DiffStats to diff() (or iter_diffs()) and it records, for each
+implementation class, the nodes it diffed and the time spent in them, and
+the same for the phases of work done within nodes: equality checks,
+option resolution, matches() calls, text diffs and the pairing of
+unordered children. Times are exclusive - a node's time leaves out the
+nodes and phases nested in it - and are also totalled by path prefix, up
+to the given depth.
+
+The results are available as a report dict, as profile data that pstats
+can read (pstats.Stats(stats) or dump_pstats()), and as folded stacks for
+flame graph tools.
+"""
+
+import marshal
+import time
+
+from .path import as_path
+
+# Phases (the other frames are implementation classes)
+DIFF = 'diff'
+EQUAL = 'equal'
+OPTIONS = 'options'
+MATCHES = 'matches'
+TEXT_DIFF = 'text_diff'
+PAIRING = 'pairing'
+
+
+class DiffStats(object):
+    def __init__(self, depth=2, clock=time.time):
+        self.depth = depth
+        self.clock = clock
+        self.calls = {}         # frame -> calls (nodes, for implementations)
+        self.own = {}           # frame -> exclusive seconds
+        self.inclusive = {}     # frame -> seconds, nested frames included
+        self.edges = {}         # (caller frame, frame) -> [calls, own, inclusive]
+        self.by_prefix = {}     # (path prefix, frame) -> exclusive seconds
+        self.regex_searches = 0
+        self.text_bytes = 0
+        self.memo_hits = 0
+        self.stack = []         # [frame, prefix, start, nested seconds]
+        self.active = {}        # frame -> times it is on the stack
+        self.prefixes = {}      # id(path) -> (path, prefix), for paths deeper than depth
+
+    def prefix(self, path):
+        """The segments of path, cut at depth"""
+        path = as_path(path)
+        unknown = []
+        while path.length > self.depth and id(path) not in self.prefixes:
+            unknown.append(path)
+            path = path.parent
+        if path.length > self.depth:
+            prefix = self.prefixes[id(path)][1]
+        else:
+            prefix = tuple(path.segments())
+        for path in unknown:
+            # Keep the path, so that its id isn't reused
+            self.prefixes[id(path)] = (path, prefix)
+        return prefix
+
+    def enter(self, frame, path):
+        self.stack.append([frame, self.prefix(path), self.clock(), 0.0])
+        self.active[frame] = self.active.get(frame, 0) + 1
+
+    def leave(self, calls=1):
+        frame, prefix, start, nested = self.stack.pop()
+        elapsed = self.clock() - start
+        own = elapsed - nested
+        self.active[frame] -= 1
+        # Recursive frames only count the time of their outermost call
+        inclusive = elapsed if not self.active[frame] else 0.0
+        caller = None
+        if self.stack:
+            self.stack[-1][3] += elapsed
+            caller = self.stack[-1][0]
+        self.calls[frame] = self.calls.get(frame, 0) + calls
+        self.own[frame] = self.own.get(frame, 0.0) + own
+        self.inclusive[frame] = self.inclusive.get(frame, 0.0) + inclusive
+        edge = self.edges.setdefault((caller, frame), [0, 0.0, 0.0])
+        edge[0] += calls
+        edge[1] += own
+        edge[2] += inclusive
+        self.by_prefix[prefix, frame] = self.by_prefix.get((prefix, frame), 0.0) + own
+
+    def phase(self, frame, path):
+        """Context manager timing a phase of the work at path"""
+        return _Phase(self, frame, path)
+
+    def timed(self, frame, path, steps):
+        """Time the advancing of a node's steps, counting one call for the node"""
+        steps = iter(steps)
+        calls = 1
+        while True:
+            self.enter(frame, path)
+            try:
+                step = next(steps)
+            except StopIteration:
+                self.leave(calls)
+                return
+            except:
+                self.leave(calls)
+                raise
+            self.leave(calls)
+            calls = 0
+            yield step
+
+    def resolve_options(self, options, path):
+        """options.at(path), counting the regex searches it takes"""
+        self.enter(OPTIONS, path)
+        searches = options.searches
+        try:
+            return options.at(path)
+        finally:
+            self.regex_searches += options.searches - searches
+            self.leave()
+
+    @staticmethod
+    def name(frame):
+        return frame if isinstance(frame, basestring) else frame.__name__
+
+    def report(self):
+        """The statistics as a dict of plain values"""
+        def totals(frames):
+            return dict((self.name(frame), {
+                'calls': self.calls[frame],
+                'seconds': self.own[frame],
+                'cumulative': self.inclusive[frame],
+            }) for frame in frames)
+        paths = {}
+        for (prefix, frame), seconds in self.by_prefix.iteritems():
+            for length in range(len(prefix) + 1):
+                key = ''.join(prefix[:length])
+                paths[key] = paths.get(key, 0.0) + seconds
+        phases = set([DIFF, EQUAL, OPTIONS, MATCHES, TEXT_DIFF, PAIRING])
+        return {
+            'seconds': sum(self.own.itervalues()),
+            'nodes': sum(calls for frame, calls in self.calls.iteritems() if frame not in phases),
+            'implementations': totals(frame for frame in self.calls if frame not in phases),
+            'phases': totals(frame for frame in self.calls if frame in phases),
+            'regex_searches': self.regex_searches,
+            'text_bytes': self.text_bytes,
+            'memo_hits': self.memo_hits,
+            'paths': paths,
+        }
+
+    @classmethod
+    def label(cls, frame):
+        """The pstats (file, line, function) label of a frame"""
+        if isinstance(frame, basestring):
+            return ('treecompare', 0, frame)
+        return (frame.__module__, 0, frame.__name__)
+
+    def pstats_data(self):
+        """The statistics in the form profile.Profile gives pstats"""
+        data = {}
+        for frame, calls in self.calls.iteritems():
+            data[self.label(frame)] = (calls, calls, self.own[frame], self.inclusive[frame], {})
+        for (caller, frame), (calls, own, inclusive) in self.edges.iteritems():
+            if caller is not None:
+                data[self.label(frame)][4][self.label(caller)] = (calls, calls, own, inclusive)
+        return data
+
+    def create_stats(self):
+        # Lets pstats.Stats(diff_stats) load the statistics directly
+        self.stats = self.pstats_data()
+
+    def dump_pstats(self, filename):
+        """Write the statistics to a file pstats.Stats(filename) can load"""
+        with open(filename, 'wb') as f:
+            marshal.dump(self.pstats_data(), f)
+
+    def folded(self):
+        """
+        The exclusive times in the folded stack format of flame graph tools:
+        one 'segment;segment;frame microseconds' line per path prefix and frame
+        """
+        lines = []
+        for (prefix, frame), seconds in sorted(self.by_prefix.iteritems()):
+            frames = [segment.replace(';', ',') for segment in prefix] + [self.name(frame)]
+            lines.append("%s %d" % (';'.join(frames), round(seconds * 1e6)))
+        return lines
+
+
+class _Phase(object):
+    __slots__ = ('stats', 'frame', 'path')
+
+    def __init__(self, stats, frame, path):
+        self.stats = stats
+        self.frame = frame
+        self.path = path
+
+    def __enter__(self):
+        self.stats.enter(self.frame, self.path)
+
+    def __exit__(self, *exc_info):
+        self.stats.leave()
+
+
+class _NotTimed(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NOT_TIMED = _NotTimed()
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+"""
+Bounded-cost line diffs for large texts. Lines are aligned by hash using
+Myers' algorithm, within a cost and time limit, and only the changed
+hunks are shown (with intraline detail for small ones).
+"""
+
+import difflib
+import repr as reprlib
+
+from . import alignment
+
+
+def truncated_repr(value, max_length):
+    """repr() of value, abbreviated with '...' beyond max_length characters"""
+    shortener = reprlib.Repr()
+    shortener.maxstring = shortener.maxother = max_length
+    return shortener.repr(value)
+
+
+def grouped_opcodes(codes, context):
+    """
+    Group opcodes into hunks with up to context lines of unchanged text
+    around each change, like difflib.SequenceMatcher.get_grouped_opcodes
+    """
+    codes = list(codes)
+    if not codes:
+        return
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def unified_diff(expected_lines, actual_lines, context=3, max_lines=200,
+                 intraline_lines=20, intraline_length=500, limits=None):
+    """
+    Return the lines of a unified-style diff between two lists of lines,
+    cut short after max_lines. Replaced blocks of at most intraline_lines
+    lines (each at most intraline_length long) get difflib's intraline
+    markers. Raises alignment.TooExpensive when limits are exceeded.
+    """
+    ids = {}
+    expected_ids = [ids.setdefault(line, len(ids)) for line in expected_lines]
+    actual_ids = [ids.setdefault(line, len(ids)) for line in actual_lines]
+    codes = alignment.opcodes(expected_ids, actual_ids, limits)
+
+    output = []
+    for group in grouped_opcodes(codes, context):
+        first, last = group[0], group[-1]
+        output.append("@@ -%d,%d +%d,%d @@" % (first[1] + 1, last[2] - first[1], first[3] + 1, last[4] - first[3]))
+        for tag, i1, i2, j1, j2 in group:
+            removed, added = expected_lines[i1:i2], actual_lines[j1:j2]
+            if tag == 'equal':
+                lines = [' ' + line for line in removed]
+            elif (tag == 'replace' and len(removed) + len(added) <= intraline_lines
+                    and max(map(len, removed + added)) <= intraline_length):
+                lines = [line[0] + line[2:] for line in difflib.ndiff(removed, added)]
+            else:
+                lines = ['-' + line for line in removed] + ['+' + line for line in added]
+            output.extend(line.rstrip('\r\n') for line in lines)
+        if len(output) > max_lines:
+            remaining = len(output) - max_lines
+            del output[max_lines:]
+            output.append("... (diff truncated, %d more lines in this hunk)" % remaining)
+            break
+    return output
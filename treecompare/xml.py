@@ -2,11 +2,149 @@ from __future__ import absolute_import
 
 from .implementations import ChildDiffingMixing, ImplementationBase
 from .differ import make_differ
+from .options import option_value
+from . import alignment
 
 import xml.dom.minidom as dom
+import xml.dom.pulldom as pulldom
+import xml.sax
+import xml.sax.handler
+import hashlib
+import itertools
 import re
+from StringIO import StringIO
 
-class DiffXMLDocument(ChildDiffingMixing, ImplementationBase):
+# The identity used by a bare 'match_identity' option
+DEFAULT_IDENTITY = '@id|@name'
+
+_identity_expressions = {}
+
+def parse_identity(expression):
+	"""
+	Parse an identity expression: alternatives separated by '|', each a
+	list of terms separated by ',', where '@name' stands for an attribute
+	and 'name' for the text of the first child element of that name.
+	"""
+	try:
+		return _identity_expressions[expression]
+	except KeyError:
+		alternatives = [[term.strip() for term in alternative.split(',')] for alternative in expression.split('|')]
+		_identity_expressions[expression] = alternatives
+		return alternatives
+
+
+def element_text(element, tag):
+	"""Text of element's first child element with the given tag, or None if there is none"""
+	for child in element.childNodes:
+		if getattr(child, 'tagName', None) == tag:
+			return u''.join(node.data for node in child.childNodes if node.nodeType in (node.TEXT_NODE, node.CDATA_SECTION_NODE))
+	return None
+
+
+def element_identity(element, alternatives):
+	"""
+	Return the identity predicates of element (like "[@id='7']") under the
+	first alternative whose terms are all present, or None
+	"""
+	for terms in alternatives:
+		predicates = []
+		for term in terms:
+			if term.startswith('@'):
+				value = element.getAttribute(term[1:]) if element.hasAttribute(term[1:]) else None
+			else:
+				value = element_text(element, term)
+			if value is None:
+				break
+			predicates.append(u"[%s='%s']" % (term, value))
+		else:
+			return u''.join(predicates)
+	return None
+
+
+class XMLChildrenMixing(ChildDiffingMixing):
+	"""
+	Keys child nodes by their index in the parent, or with the
+	match_identity option, child elements by their tag and identity
+	"""
+	@property
+	def identity_expression(self):
+		"""The identity child elements are matched by at this node, or None"""
+		expression = option_value(self.options, 'match_identity')
+		if expression is None and 'match_identity' in self.options:
+			expression = DEFAULT_IDENTITY
+		return expression
+
+	def child_nodes(self, node):
+		"""
+		Yield the (path, child, index) of each child node. Children with
+		an identity are keyed by it (with a count appended to repeats),
+		and the rest by their index among the children without one.
+		"""
+		expression = self.identity_expression
+		alternatives = parse_identity(expression) if expression is not None else None
+		repeats = {}
+		unidentified = 0
+		for i, child in enumerate(node.childNodes):
+			identity = None
+			if alternatives is not None and hasattr(child, 'tagName'):
+				identity = element_identity(child, alternatives)
+			if identity is not None:
+				path = u"/<%s%s>" % (child.tagName, identity)
+				repeats[path] = repeat = repeats.get(path, 0) + 1
+				if repeat > 1:
+					path = u"/<%s%s[%d]>" % (child.tagName, identity, repeat)
+				yield path, child, i
+				continue
+			position = i if alternatives is None else unidentified
+			unidentified += 1
+			if hasattr(child, 'tagName'):
+				yield "/%d<%s>" % (position, child.tagName), child, i
+			else:
+				yield "/%d:text" % position, child.data, i
+
+	def identified_children(self, node):
+		"""The (path, index) of each child keyed by its identity"""
+		return [(path, i) for path, child, i in self.child_nodes(node) if path.startswith('/<')]
+
+	def diff_children(self, expected, actual):
+		for step in ChildDiffingMixing.diff_children(self, expected, actual):
+			yield step
+		if self.identity_expression is not None and isinstance(actual, type(expected)):
+			for difference in self.moves(expected, actual):
+				yield difference
+
+	def moves(self, expected, actual):
+		"""
+		Yield a difference for each identified child found in both, but
+		out of order relative to its siblings. The fewest moves are
+		reported: those children not in the longest run left in order.
+		"""
+		actual_indexes = dict(self.identified_children(actual))
+		common = []
+		for path, expected_index in self.identified_children(expected):
+			if path in actual_indexes:
+				with self.diffing_child(path) as child:
+					options = child.options
+				if 'ignore' not in options and 'ignore_key' not in options:
+					common.append((path, expected_index, actual_indexes[path]))
+		in_order = set(alignment.increasing_subsequence([actual_index for path, expected_index, actual_index in common]))
+		for position, (path, expected_index, actual_index) in enumerate(common):
+			if position not in in_order:
+				with self.diffing_child(path) as child:
+					for difference in child.different("moved from index %d to %d" % (expected_index, actual_index)):
+						yield difference
+
+	def canonical(self, diffable):
+		canonical = ChildDiffingMixing.canonical(self, diffable)
+		if canonical is None or 'ignore' in self.options or self.identity_expression is None:
+			return canonical
+		# Keyed children are hashed in sorted order, so add the order of
+		# the identified ones
+		order = u'\n'.join(path for path, i in self.identified_children(diffable))
+		return 'c' + hashlib.sha1(canonical + '\n' + order.encode('utf-8')).hexdigest()
+
+
+class DiffXMLDocument(XMLChildrenMixing, ImplementationBase):
 	diffs_types = dom.Document
 
 	def path_and_child(self, doc):
@@ -14,33 +152,330 @@ class DiffXMLDocument(ChildDiffingMixing, ImplementationBase):
 		yield "?xml@encoding", doc.encoding
 		yield "?xml@standalone", doc.standalone
 
-		for i, child in enumerate(doc.childNodes):
-			if hasattr(child, 'tagName'):
-				yield "/%d<%s>" % (i, child.tagName), child
-			else:
-				yield "/%d:text" % i, child.data
+		for path, child, i in self.child_nodes(doc):
+			yield path, child
 
 
-class DiffXMLElement(ChildDiffingMixing, ImplementationBase):
+class DiffXMLElement(XMLChildrenMixing, ImplementationBase):
 	diffs_types = dom.Element
 	def path_and_child(self, el):
 		yield ":tag", el.tagName
 		for name, value in el.attributes.items():
 			yield "@%s" % name, value
 
-		for i, child in enumerate(el.childNodes):
-			if hasattr(child, 'tagName'):
-				yield "/%d<%s>" % (i, child.tagName), child
-			else:
-				yield "/%d:text" % i, child.data
+		for path, child, i in self.child_nodes(el):
+			yield path, child
 				
 
 
 
 
+# Events added to pulldom's, for CDATA sections (whose node is their text)
+CDATA_START, CDATA_END, CDATA_SECTION = 'CDATA_START', 'CDATA_END', 'CDATA_SECTION'
+
+XML_DECLARATION = re.compile(r"""^(?:\xef\xbb\xbf)?<\?xml\s+version\s*=\s*["']([^"']*)["']"""
+	r"""(?:\s+encoding\s*=\s*["']([^"']*)["'])?(?:\s+standalone\s*=\s*["'](yes|no)["'])?\s*\?>""")
+
+
+class _PullDOM(pulldom.PullDOM):
+	"""PullDOM that is also the lexical handler, reporting CDATA sections"""
+	def _add_event(self, event):
+		self.lastEvent[1] = [event, None]
+		self.lastEvent = self.lastEvent[1]
+
+	def startCDATA(self):
+		self._add_event((CDATA_START, None))
+
+	def endCDATA(self):
+		self._add_event((CDATA_END, None))
+
+	def startDTD(self, name, public_id, system_id):
+		pass
+
+	def endDTD(self):
+		pass
+
+	def startEntity(self, name):
+		pass
+
+	def endEntity(self, name):
+		pass
+
+
+class _DOMEventStream(pulldom.DOMEventStream):
+	def reset(self):
+		self.pulldom = _PullDOM()
+		self.parser.setFeature(xml.sax.handler.feature_namespaces, 1)
+		self.parser.setContentHandler(self.pulldom)
+		self.parser.setProperty(xml.sax.handler.property_lexical_handler, self.pulldom)
+
+
+class _RecordingReader(object):
+	"""File wrapper remembering the first chunk read, for the XML declaration"""
+	def __init__(self, stream):
+		self.stream = stream
+		self.head = None
+
+	def read(self, size):
+		data = self.stream.read(size)
+		if self.head is None:
+			self.head = data
+		return data
+
+
+class XMLStream(object):
+	"""
+	The pull events of an XML document (a string or file object), with
+	adjacent text merged the way minidom does, and the depth of the current
+	element tracked. Only the element being read is held in memory.
+	"""
+	def __init__(self, source):
+		if isinstance(source, basestring):
+			source = StringIO(source)
+		self.source = _RecordingReader(source)
+		parser = xml.sax.make_parser()
+		parser.setFeature(xml.sax.handler.feature_external_ges, False)
+		self.events = _DOMEventStream(self.source, parser, pulldom.default_bufsize)
+		self.pushed_back = None
+		self.depth = 0
+		event, self.document = self.events.getEvent()
+		assert event == pulldom.START_DOCUMENT
+
+	def declaration(self):
+		"""Return the version, encoding and standalone values minidom would give the document"""
+		match = XML_DECLARATION.match(self.source.head or '')
+		if match is None:
+			return None, None, None
+		version, encoding, standalone = [
+			value.decode('utf-8') if isinstance(value, str) else value for value in match.groups()]
+		return version, encoding, None if standalone is None else standalone == 'yes'
+
+	def read_event(self):
+		if self.pushed_back is not None:
+			event, self.pushed_back = self.pushed_back, None
+			return event
+		return self.events.getEvent() or (None, None)
+
+	def next(self):
+		"""
+		Return the next (event, node) pair, or (None, None) at the end.
+		Text comes as (pulldom.CHARACTERS, text), and CDATA sections as
+		(CDATA_SECTION, text).
+		"""
+		event, node = self.read_event()
+		if event == pulldom.CHARACTERS:
+			text = [node.data]
+			while True:
+				event, node = self.read_event()
+				if event != pulldom.CHARACTERS:
+					self.pushed_back = event, node
+					return pulldom.CHARACTERS, u''.join(text)
+				text.append(node.data)
+		if event == CDATA_START:
+			text = []
+			event, node = self.read_event()
+			while event == pulldom.CHARACTERS:
+				text.append(node.data)
+				event, node = self.read_event()
+			if not text:
+				# Empty sections make no node
+				return self.next()
+			return CDATA_SECTION, u''.join(text)
+		if event == pulldom.START_ELEMENT:
+			self.depth += 1
+		elif event == pulldom.END_ELEMENT:
+			self.depth -= 1
+		elif event == pulldom.END_DOCUMENT:
+			return None, None
+		return event, node
+
+	def skip(self, depth):
+		"""Read past the end of the element whose content is at depth"""
+		while self.depth >= depth:
+			if self.next()[0] is None:
+				break
+
+	def expand(self, element, depth):
+		"""Read the rest of element (whose content is at depth) into a minidom subtree"""
+		parents = [element]
+		while self.depth >= depth:
+			event, node = self.next()
+			if event is None:
+				break
+			elif event == pulldom.START_ELEMENT:
+				parents[-1].appendChild(node)
+				parents.append(node)
+			elif event == pulldom.END_ELEMENT:
+				parents.pop()
+			elif event == pulldom.CHARACTERS:
+				parents[-1].appendChild(self.document.createTextNode(node))
+			elif event == CDATA_SECTION:
+				parents[-1].appendChild(self.document.createCDATASection(node))
+			else:
+				parents[-1].appendChild(node)
+		return element
+
+
+class StreamedNode(object):
+	"""A document or element whose children are read from an XMLStream as they are diffed"""
+	def __init__(self, stream, depth):
+		self.stream = stream
+		self.depth = depth
+
+	def header(self):
+		"""Return the (path, value) pairs known without reading any children"""
+		raise NotImplementedError
+
+	def children(self):
+		"""
+		Yield each child's (path, child), reading it from the stream. A
+		child element's remaining content is skipped when the next child
+		is asked for.
+		"""
+		stream = self.stream
+		child = None
+		for i in itertools.count():
+			if child is not None:
+				stream.skip(child.depth)
+			event, node = stream.next()
+			if event is None or event == pulldom.END_ELEMENT:
+				return
+			if event == pulldom.START_ELEMENT:
+				child = StreamedElement(stream, stream.depth, node)
+				yield "/%d<%s>" % (i, node.tagName), child
+			else:
+				child = None
+				yield "/%d:text" % i, node if isinstance(node, basestring) else node.data
+
+
+class StreamedDocument(StreamedNode):
+	def __init__(self, source):
+		StreamedNode.__init__(self, XMLStream(source), 0)
+
+	def header(self):
+		version, encoding, standalone = self.stream.declaration()
+		return [("?xml@version", version), ("?xml@encoding", encoding), ("?xml@standalone", standalone)]
+
+
+class StreamedElement(StreamedNode):
+	def __init__(self, stream, depth, element):
+		StreamedNode.__init__(self, stream, depth)
+		self.element = element
+		self.tagName = element.tagName
+
+	def header(self):
+		return [(":tag", self.tagName)] + [("@%s" % name, value) for name, value in self.element.attributes.items()]
+
+	def expand(self):
+		"""Read the rest of this element into memory, returning it as a minidom Element"""
+		return self.stream.expand(self.element, self.depth)
+
+	def __repr__(self):
+		return "<DOM Element: %s at %#x>" % (self.tagName, id(self))
+
+
+class StreamedChildrenMixing(ChildDiffingMixing):
+	"""
+	Diffs the children of two StreamedNodes in lockstep, as they are read.
+	Only children for whom ignore_key applies are read into memory, to be
+	matched up once all their siblings have been seen.
+	"""
+	def path_and_child(self, node):
+		return node.header()
+
+	def fingerprint(self, node):
+		# Would mean reading the whole subtree
+		return None
+
+	def canonical(self, node):
+		return ImplementationBase.canonical(self, node)
+
+	def summary(self, node):
+		return ImplementationBase.summary(self, node)
+
+	def diff_children(self, expected, actual):
+		for step in ChildDiffingMixing.diff_children(self, expected, actual):
+			yield step
+		if not isinstance(actual, type(expected)):
+			return
+		unkeyed_expected, unkeyed_actual = [], []
+		pairs = itertools.izip_longest(
+				self.keyed_children(expected, unkeyed_expected),
+				self.keyed_children(actual, unkeyed_actual),
+				fillvalue=(None, None))
+		for (expected_path, expected_child), (actual_path, actual_child) in pairs:
+			if actual_path is not None and actual_path == expected_path:
+				with self.diffing_child(actual_path) as child:
+					yield child.descend(expected_child, actual_child)
+				continue
+			if actual_path is not None:
+				with self.diffing_child(actual_path) as child:
+					for difference in child.unexpected(actual_child):
+						yield difference
+			if expected_path is not None:
+				with self.diffing_child(expected_path) as child:
+					for difference in child.missing(expected_child):
+						yield difference
+
+		if unkeyed_expected or unkeyed_actual:
+			unmatched_expected = {}
+			for step in self.diff_unkeyed(unkeyed_expected, unkeyed_actual, unmatched_expected):
+				yield step
+			for path, expected_child in unkeyed_expected:
+				if path in unmatched_expected:
+					with self.diffing_child(path) as child:
+						for difference in child.missing(expected_child):
+							yield difference
+
+	def keyed_children(self, node, unkeyed):
+		"""
+		Yield node's children like StreamedNode.children(), but with
+		(None, None) in place of ignored ones and those for whom ignore_key
+		applies, which are read into memory and added to unkeyed instead
+		"""
+		for path, child in node.children():
+			with self.diffing_child(path) as child_node:
+				options = child_node.options
+			if 'ignore' in options:
+				yield None, None
+			elif 'ignore_key' in options:
+				unkeyed.append((path, child.expand() if isinstance(child, StreamedElement) else child))
+				yield None, None
+			else:
+				yield path, child
+
+
+class DiffStreamedXMLDocument(StreamedChildrenMixing, ImplementationBase):
+	diffs_types = StreamedDocument
+
+
+class DiffStreamedXMLElement(StreamedChildrenMixing, ImplementationBase):
+	diffs_types = StreamedElement
+
+
+xml_differ = make_differ(
+		DiffXMLDocument,
+		DiffXMLElement
+	)
+
+streaming_xml_differ = make_differ(
+		DiffStreamedXMLDocument,
+		DiffStreamedXMLElement,
+		DiffXMLDocument,
+		DiffXMLElement,
+		iterative=True
+	)
+
+
 def diff_xml(expected, actual, *args, **kw):
 	xmls = map(dom.parseString, (expected,actual))
-	return make_differ(
-			DiffXMLDocument,
-			DiffXMLElement
-		)(*(tuple(xmls) + args), **kw)
\ No newline at end of file
+	return xml_differ(*(tuple(xmls) + args), **kw)
+
+
+def diff_xml_stream(expected, actual, *args, **kw):
+	"""
+	Like diff_xml(), but for documents (strings or file objects) too large
+	to parse into memory: both are read incrementally, in lockstep.
+	"""
+	documents = map(StreamedDocument, (expected, actual))
+	return streaming_xml_differ(*(tuple(documents) + args), **kw)